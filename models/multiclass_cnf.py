@@ -2,8 +2,8 @@ from __future__ import division, print_function, absolute_import
 
 import numpy as np
 from tefla.core.lr_policy import PolyDecayPolicy
+from tefla.core.metrics import AccuracyAccumulator, KappaAccumulator
 from tefla.da.standardizer import SamplewiseStandardizer
-from tefla.utils import util
 
 cnf = {
     'name': __name__.split('.')[-1],
@@ -27,5 +27,5 @@ cnf = {
     'num_epochs': 451,
     'lr_policy': PolyDecayPolicy(0.00005),
     'classification': True,
-    'validation_scores': [('validation accuracy', util.accuracy_wrapper), ('validation kappa', util.kappa_wrapper)],
+    'validation_scores': [('validation accuracy', AccuracyAccumulator()), ('validation kappa', KappaAccumulator(5))],
 }
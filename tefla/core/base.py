@@ -11,6 +11,8 @@ import numpy as np
 from ..da.iterator import BatchIterator
 from .lr_policy import NoDecayPolicy
 from .losses import kappa_log_loss_clipped, segment_loss
+from .metrics import BatchAverage, as_accumulator
+from .validation_schedule import ValidationSchedule
 from . import summary
 from . import logger as log
 import tensorflow as tf
@@ -23,6 +25,9 @@ VALIDATION_EPOCH_SUMMARIES = 'validation_epoch_summaries'
 
 
 class Base(object):
+    # whether the training loop of the learner implements these cnf settings
+    supports_accum_steps = False
+    supports_validation_schedule = False
 
     def __init__(self, model, cnf, training_iterator=BatchIterator(32, False),
                  validation_iterator=BatchIterator(128, False), num_classes=5, start_epoch=1, resume_lr=0.01, classification=True, clip_norm=True, norm_threshold=5, n_iters_per_epoch=1094, gpu_memory_fraction=0.94, is_summary=False, log_file_name='/tmp/deepcnn.log', verbosity=0, loss_type='softmax_cross_entropy', label_smoothing=0.009, weights_dir='weights'):
@@ -36,8 +41,21 @@ class Base(object):
         self.lr_policy.base_lr = resume_lr
         self.lr_policy.n_iters_per_epoch = n_iters_per_epoch
         self.validation_metrics_def = self.cnf.get('validation_scores', [])
+        self.validation_schedule = self.cnf.get('validation_schedule', ValidationSchedule())
+        if not (self.supports_validation_schedule or self.validation_schedule.is_default()):
+            raise ValueError('%s does not support validation_schedule, got %s' %
+                             (type(self).__name__, self.validation_schedule))
+        # metric functions which are not accumulators are metric ops of the validation towers
+        self.validation_accumulators = [as_accumulator(metric_function)
+                                        for _, metric_function in self.validation_metrics_def]
         self.clip_norm = clip_norm
         self.norm_threshold = norm_threshold
+        # number of micro-batches whose gradients are accumulated per optimizer step
+        self.accum_steps = cnf.get('accum_steps', 1)
+        if self.accum_steps < 1:
+            raise ValueError('accum_steps must be at least 1, got %s' % self.accum_steps)
+        if self.accum_steps > 1 and not self.supports_accum_steps:
+            raise ValueError('%s does not support accum_steps, got %s' % (type(self).__name__, self.accum_steps))
         self.gradient_multipliers = None
         self.gpu_memory_fraction = gpu_memory_fraction
         self.is_summary = is_summary
@@ -216,6 +234,26 @@ class Base(object):
         else:
             return y if self.classification else y.reshape(-1, 1).astype(np.float32)
 
+    def _graph_validation_metrics(self):
+        """Metric functions of the validation_scores computed by the validation towers"""
+        return [accumulator.metric_function for accumulator in self.validation_accumulators
+                if isinstance(accumulator, BatchAverage)]
+
+    def _update_validation_accumulators(self, graph_scores, predictions, targets):
+        """Adds a validation batch to the accumulators
+
+        Args:
+            graph_scores: batch scores of the `_graph_validation_metrics`, in order
+            predictions: batch predictions, for the streaming accumulators
+            targets: batch targets, for the streaming accumulators
+        """
+        graph_scores = iter(graph_scores)
+        for accumulator in self.validation_accumulators:
+            if isinstance(accumulator, BatchAverage):
+                accumulator.add(next(graph_scores), len(targets))
+            else:
+                accumulator.update(predictions, targets)
+
     def _average_gradients(self, tower_grads):
         average_grads = []
         for grad_and_vars in zip(*tower_grads):
@@ -276,9 +314,65 @@ class Base(object):
                 list(zip(grads, tvars)), gradient_noise_scale=gradient_noise_scale)
         if gate_gradients == GATE_GRAPH:
             grads = tf.tuple(grads)
+        return self._clip_grads_by_global_norm(list(zip(grads, tvars)), global_norm=global_norm)
+
+    def _clip_grads_by_global_norm(self, grads_and_vars, global_norm=8):
+        """Clips the gradients by their global norm.
+
+        Args:
+            grads_and_vars: A list of gradient to variable pairs (tuples).
+            global_norm: the maximum global norm
+
+        Returns:
+            A list of clipped gradient to variable pairs.
+         """
+        grads, tvars = zip(*grads_and_vars)
         grads, _ = tf.clip_by_global_norm(grads, global_norm)
-        grads_and_vars = list(zip(grads, tvars))
-        return grads_and_vars
+        return list(zip(grads, tvars))
+
+    def _accumulate_gradients(self, grads_and_vars, opt, clip_norm=False, clip_by_global_norm=False, max_norm=5):
+        """Accumulates the gradients over micro-batches, to apply them once.
+
+        The gradients are summed into non trainable local variables; the apply op
+        averages the sums over the accumulated micro-batches, clips them, applies
+        them with `opt` and resets the accumulators.
+
+        Args:
+            grads_and_vars: A list of gradient to variable pairs (tuples), of a micro-batch.
+            opt: optimizer
+            clip_norm: bool, clip the accumulated gradients by norm
+            clip_by_global_norm: bool, clip the accumulated gradients by their global norm
+            max_norm: the maximum norm value.
+
+        Returns:
+            A tuple of the accumulate op, to run for every micro-batch, and the apply op.
+         """
+        grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+        with tf.name_scope('gradient_accumulation'):
+            num_accumulated = tf.Variable(0.0, trainable=False, collections=[
+                                          tf.GraphKeys.LOCAL_VARIABLES], name='num_accumulated')
+            accumulators = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False,
+                                        collections=[tf.GraphKeys.LOCAL_VARIABLES], name='accumulator')
+                            for _, var in grads_and_vars]
+            accumulate_op = tf.group(
+                num_accumulated.assign_add(1.0),
+                *[accumulator.assign_add(tf.convert_to_tensor(grad))
+                  for accumulator, (grad, _) in zip(accumulators, grads_and_vars)])
+            count = tf.maximum(num_accumulated, 1.0)
+            accumulated_grads_and_vars = [(accumulator / count, var)
+                                          for accumulator, (_, var) in zip(accumulators, grads_and_vars)]
+            if clip_by_global_norm:
+                accumulated_grads_and_vars = self._clip_grads_by_global_norm(
+                    accumulated_grads_and_vars, global_norm=max_norm)
+            elif clip_norm:
+                accumulated_grads_and_vars = self._clip_grad_norms(
+                    accumulated_grads_and_vars, max_norm=max_norm)
+            apply_gradients_op = opt.apply_gradients(accumulated_grads_and_vars)
+            with tf.control_dependencies([apply_gradients_op]):
+                apply_op = tf.group(
+                    num_accumulated.assign(0.0),
+                    *[accumulator.assign(tf.zeros_like(accumulator)) for accumulator in accumulators])
+        return accumulate_op, apply_op
 
     def _multiply_gradients(self, grads_and_vars, gradient_multipliers):
         """Multiply specified gradients.
@@ -0,0 +1,188 @@
+"""Checkpoint writing off the training thread"""
+from __future__ import division, print_function, absolute_import
+
+import Queue
+import glob
+import logging
+import math
+import os
+import threading
+import time
+
+import tensorflow as tf
+
+logger = logging.getLogger('tefla')
+
+
+class CheckpointManager(object):
+    """Writes the epoch checkpoints on a background thread
+
+    `save` snapshots the variable values to host memory and returns, a writer
+    thread saves them with a private host side graph, under the names of the
+    training variables, so that the checkpoints are restored by the usual
+    `tf.train.Saver`. Once written, only the best `keep_best` checkpoints by
+    `metric` and the last `keep_last` ones are kept; all of them are kept if
+    neither is given. The writer session only uses the cpu, it does not claim
+    any gpu memory. Used as a context manager, the queued checkpoints are
+    written and the writer stopped on exit, errors included.
+
+    Args:
+        var_list: list of variables to save, all the global variables by default
+        weights_dir: string, checkpoints directory
+        keep_best: int, number of best checkpoints to keep
+        keep_last: int, number of most recent checkpoints to keep, at least 1 when pruning,
+            so that a training can be resumed from its last epoch
+        metric: string, name of the metric ranking the checkpoints, e.g.: `validation_loss`
+            or the name of a validation score
+        mode: string, `min` or `max`, whether lower or higher metric values are better
+        max_pending: int, max number of snapshots waiting to be written, `save` blocks beyond
+        filename: string, checkpoint file name pattern, formatted with the epoch
+    """
+
+    def __init__(self, var_list=None, weights_dir='weights', keep_best=None, keep_last=None,
+                 metric='validation_loss', mode='min', max_pending=1, filename='model-epoch-%d.ckpt'):
+        if mode not in ('min', 'max'):
+            raise ValueError('Unknown checkpoint metric mode: %s' % mode)
+        self.var_list = var_list if var_list is not None else tf.global_variables()
+        self.weights_dir = weights_dir
+        self.keep_best = keep_best
+        self.keep_last = keep_last
+        self.metric = metric
+        self.mode = mode
+        self.filename = filename
+        self.checkpoints = {}
+        self.write_times = []
+        self.error = None
+        self.lock = threading.Lock()
+        self._build_writer()
+        self.queue = Queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _build_writer(self):
+        self.graph = tf.Graph()
+        self.placeholders = []
+        variables = {}
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            for var in self.var_list:
+                placeholder = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+                variables[var.op.name] = tf.Variable(placeholder, trainable=False, collections=[])
+                self.placeholders.append(placeholder)
+            self.initializers = [variables[var.op.name].initializer for var in self.var_list]
+            self.saver = tf.train.Saver(variables, max_to_keep=None)
+        # the first session initializing the gpus sets the memory fraction of the process
+        self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # do not hide the training error behind a checkpoint write error
+        try:
+            self.close()
+        except Exception:
+            logger.exception('Checkpoint writer failed while handling an error')
+
+    def save(self, sess, epoch, metrics=None):
+        """Snapshots the variables and queues the checkpoint write
+
+        Args:
+            sess: training session
+            epoch: int, epoch number, formatted in the checkpoint file name
+            metrics: dict, epoch metrics, the checkpoint is ranked by `metrics[self.metric]`
+
+        Returns:
+            the checkpoint path
+        """
+        self._raise_error()
+        path = os.path.join(self.weights_dir, self.filename % epoch)
+        score = (metrics or {}).get(self.metric)
+        if score is not None and math.isnan(score):
+            score = None
+        values = sess.run(self.var_list)
+        self.queue.put((epoch, path, values, score))
+        return path
+
+    def wait(self):
+        """Blocks until the queued checkpoints are written"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        """Writes the queued checkpoints and stops the writer thread"""
+        self.queue.put(None)
+        self.thread.join()
+        self.sess.close()
+        self._raise_error()
+
+    def best_checkpoint(self):
+        """Path of the best written checkpoint, None if none has a metric"""
+        with self.lock:
+            ranked = self._ranked_epochs()
+            return self.checkpoints[ranked[0]][0] if ranked else None
+
+    @staticmethod
+    def epoch_metrics(epoch_info):
+        """Metrics of a training history entry, the validation scores by name included
+
+        Epochs validated on a subset are not ranked against full validations.
+        """
+        if epoch_info.get('validation_subset'):
+            return {}
+        return dict(epoch_info, **epoch_info.get('validation_metrics', {}))
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                logger.exception('Checkpoint write failed')
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, epoch, path, values, score):
+        tic = time.time()
+        self.sess.run(self.initializers, feed_dict=dict(zip(self.placeholders, values)))
+        self.saver.save(self.sess, path, write_meta_graph=False, write_state=False)
+        duration = time.time() - tic
+        self.write_times.append(duration)
+        logger.info('Checkpoint %s written in %.2fs' % (path, duration))
+        with self.lock:
+            self.checkpoints[epoch] = (path, score)
+            self._prune()
+
+    def _ranked_epochs(self):
+        scored = [(score, epoch) for epoch, (_, score) in self.checkpoints.items() if score is not None]
+        sign = 1 if self.mode == 'min' else -1
+        return [epoch for score, epoch in sorted(scored, key=lambda s: (sign * s[0], s[1]))]
+
+    def retained_epochs(self):
+        """Epochs whose checkpoints are kept"""
+        epochs = sorted(self.checkpoints)
+        if self.keep_best is None and self.keep_last is None:
+            return set(epochs)
+        keep = set(epochs[-max(self.keep_last or 0, 1):])
+        keep.update(self._ranked_epochs()[:self.keep_best or 0])
+        return keep
+
+    def _prune(self):
+        retained = self.retained_epochs()
+        for epoch in sorted(self.checkpoints):
+            if epoch not in retained:
+                path = self.checkpoints.pop(epoch)[0]
+                for fname in glob.glob(path) + glob.glob(path + '.*'):
+                    os.remove(fname)
+                logger.debug('Removed checkpoint %s' % path)
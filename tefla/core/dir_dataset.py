@@ -1,9 +1,12 @@
 """A dataset based on files in a training and validation directory, and corresponding label files."""
 from __future__ import division, print_function, absolute_import
 
+import json
 import logging
+import os
 
 import numpy as np
+from PIL import Image
 
 from . import data_load_ops as data
 
@@ -75,3 +78,150 @@ class DataSet(object):
         logger.info("Data: Class balance weights: %s" % self.balance_weights())
         logger.info("Data: #Validation images: %d" %
                     self.num_validation_files())
+
+
+class MemmapDataSet(DataSet):
+    """A `DataSet` packed into a single memory-mapped uint8 array
+
+    Same layout and API as `DataSet`, but the images of `training_%d` and
+    `validation_%d` are read from one contiguous (N, H, W, 3) uint8 array
+    written by `pack_data_dir` (packed on first use, and packed again when the
+    image files or label files have changed since). `training_X`
+    and `validation_X` are integer indices into that array; pass `preprocessor`
+    to the iterators to resolve them, random access then becomes page cache
+    reads instead of a file open and image decode per sample.
+
+    Args:
+        data_dir: string, dataset directory, as for `DataSet`
+        img_size: int, image size, as for `DataSet`
+        packed_dir: string, directory of the packed dataset,
+            default `data_dir/packed_<img_size>`
+    """
+
+    def __init__(self, data_dir, img_size, packed_dir=None):
+        self.data_dir = data_dir
+        self.packed_dir = packed_dir or "%s/packed_%d" % (data_dir, img_size)
+        meta = _load_meta(self.packed_dir)
+        sources = _source_info(data_dir, img_size)
+        if meta is None or meta.get('sources') != sources:
+            if meta is not None:
+                logger.info('%s changed since it was packed, packing it again' % data_dir)
+            pack_data_dir(data_dir, img_size, self.packed_dir)
+            meta = _load_meta(self.packed_dir)
+        num_training = meta['num_training']
+        labels = np.load(os.path.join(self.packed_dir, 'labels.npy'))
+        self.names = np.load(os.path.join(self.packed_dir, 'names.npy'))
+
+        self._training_files = np.arange(num_training)
+        self._training_labels = labels[:num_training]
+        self._validation_files = np.arange(num_training, len(labels))
+        self._validation_labels = labels[num_training:]
+        self.preprocessor = PackedImageReader(os.path.join(self.packed_dir, 'images.npy'))
+
+
+class PackedImageReader(object):
+    """Preprocessor resolving integer indices into images of a packed dataset
+
+    The array is memory-mapped lazily, once per process, so the reader is
+    cheap to pickle to pool workers.
+
+    Args:
+        images_file: string, path of the packed (N, H, W, 3) uint8 `.npy` file
+    """
+
+    def __init__(self, images_file):
+        self.images_file = images_file
+        self._images = None
+
+    def __call__(self, index):
+        if self._images is None:
+            self._images = np.load(self.images_file, mmap_mode='r')
+        return self._images[index]
+
+    def __getstate__(self):
+        return {'images_file': self.images_file, '_images': None}
+
+
+def _load_meta(packed_dir):
+    meta_file = os.path.join(packed_dir, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        return json.load(f)
+
+
+def _split_files(data_dir, split, img_size):
+    return data.get_image_files("%s/%s_%d" % (data_dir, split, img_size))
+
+
+def _source_info(data_dir, img_size):
+    """Image names per split and newest mtime of the images and label files, to detect stale packs"""
+    info = {}
+    mtimes = []
+    for split in ('training', 'validation'):
+        split_files = _split_files(data_dir, split, img_size)
+        info[split] = [os.path.basename(f) for f in split_files]
+        mtimes.extend(os.path.getmtime(f) for f in split_files)
+        label_file = "%s/%s_labels.csv" % (data_dir, split)
+        if os.path.exists(label_file):
+            mtimes.append(os.path.getmtime(label_file))
+    info['mtime'] = max(mtimes) if mtimes else None
+    return info
+
+
+def pack_data_dir(data_dir, img_size, packed_dir=None):
+    """Packs a `DataSet` directory into a single memory-mapped uint8 array
+
+    Writes `images.npy` (N, H, W, 3) uint8 with the training images followed
+    by the validation images, `labels.npy`, `names.npy` and `meta.json` with
+    the split sizes and the packed file names and newest mtime, used by
+    `MemmapDataSet` to detect a stale pack. All images must have the same size.
+
+    Args:
+        data_dir: string, dataset directory with `training_%d`/`validation_%d` and label files
+        img_size: int, image size
+        packed_dir: string, output directory, default `data_dir/packed_<img_size>`
+
+    Returns:
+        the packed directory
+    """
+    packed_dir = packed_dir or "%s/packed_%d" % (data_dir, img_size)
+    if not os.path.exists(packed_dir):
+        os.makedirs(packed_dir)
+    meta_file = os.path.join(packed_dir, 'meta.json')
+    if os.path.exists(meta_file):
+        # an interrupted repack must not look complete
+        os.remove(meta_file)
+
+    sources = _source_info(data_dir, img_size)
+    files, labels = [], []
+    for split in ('training', 'validation'):
+        split_files = _split_files(data_dir, split, img_size)
+        names = data.get_names(split_files)
+        labels.append(data.get_labels(
+            names, label_file="%s/%s_labels.csv" % (data_dir, split)).astype(np.int32))
+        files.append(split_files)
+    num_training = len(files[0])
+    files = np.concatenate(files)
+    if len(files) == 0:
+        raise ValueError('No images found in %s' % data_dir)
+
+    shape = np.array(Image.open(files[0]).convert('RGB')).shape
+    images = np.lib.format.open_memmap(os.path.join(packed_dir, 'images.npy'), mode='w+', dtype=np.uint8,
+                                       shape=(len(files),) + shape)
+    for i, fname in enumerate(files):
+        img = np.array(Image.open(fname).convert('RGB'))
+        if img.shape != shape:
+            raise ValueError('Image %s has shape %s, expected %s' % (fname, img.shape, shape))
+        images[i] = img
+    images.flush()
+    del images
+
+    np.save(os.path.join(packed_dir, 'labels.npy'), np.concatenate(labels))
+    np.save(os.path.join(packed_dir, 'names.npy'), np.array(data.get_names(files)))
+    # written last, marks the packed dataset as complete
+    with open(meta_file, 'w') as f:
+        json.dump({'num_training': num_training, 'num_validation': len(files) - num_training,
+                   'image_shape': list(shape), 'sources': sources}, f)
+    logger.info('Packed %d images from %s into %s' % (len(files), data_dir, packed_dir))
+    return packed_dir
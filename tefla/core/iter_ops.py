@@ -4,6 +4,7 @@ import functools
 import logging
 
 from .. import convert
+from ..da import data
 from ..da import iterator
 
 logger = logging.getLogger('tefla')
@@ -21,9 +22,13 @@ def create_training_iters(cnf, data_set, standardizer, crop_size, epoch, paralle
         epoch: the current epoch number; used for data balancing
         parallel: iterator type; either parallel or queued
     """
+    parallel_kwargs = {}
     if parallel:
         training_iterator_maker = iterator.BalancingDAIterator
         validation_iterator_maker = iterator.ParallelDAIterator
+        # the trainers are done with a batch before requesting the next one
+        parallel_kwargs['zero_copy'] = cnf.get('zero_copy_batches', False)
+        parallel_kwargs['prefetch'] = cnf.get('prefetch_batches', 0)
         logger.info('Using parallel iterators')
     else:
         training_iterator_maker = iterator.BalancingQueuedDAIterator
@@ -31,7 +36,9 @@ def create_training_iters(cnf, data_set, standardizer, crop_size, epoch, paralle
         # validation_iterator_maker = iterator.QueuedDAIterator
         logger.info('Using queued iterators')
 
-    preprocessor = None
+    # packed datasets hand out indices, resolved by their own preprocessor
+    preprocessor = getattr(data_set, 'preprocessor', None)
+    image_cache = create_image_cache(cnf)
     training_iterator = training_iterator_maker(
         batch_size=cnf['batch_size_train'],
         shuffle=True,
@@ -44,7 +51,12 @@ def create_training_iters(cnf, data_set, standardizer, crop_size, epoch, paralle
         balance_ratio=cnf['balance_ratio'],
         balance_epoch_count=epoch - 1,
         standardizer=standardizer,
-        fill_mode='constant'
+        fill_mode='constant',
+        batch_warp=cnf.get('batch_warp', False),
+        image_cache=image_cache,
+        seed=cnf.get('aug_seed'),
+        streaming=cnf.get('streaming_batches', False),
+        **parallel_kwargs
         # save_to_dir=da_training_preview_dir
     )
 
@@ -55,12 +67,31 @@ def create_training_iters(cnf, data_set, standardizer, crop_size, epoch, paralle
         crop_size=crop_size,
         is_training=False,
         standardizer=standardizer,
-        fill_mode='constant'
+        fill_mode='constant',
+        batch_warp=cnf.get('batch_warp', False),
+        zero_copy=cnf.get('zero_copy_batches', False),
+        prefetch=cnf.get('prefetch_batches', 0),
+        image_cache=image_cache
     )
 
     return training_iterator, validation_iterator
 
 
+def create_image_cache(cnf):
+    """
+    Creates the decoded image cache configured by `image_cache_bytes` and/or `image_cache_dir`
+
+    Args:
+        cnf: configs dict with all training and augmentation params
+
+    Returns:
+        a `DecodedImageCache`, or None if no cache is configured
+    """
+    if not (cnf.get('image_cache_bytes') or cnf.get('image_cache_dir')):
+        return None
+    return data.DecodedImageCache(max_bytes=cnf.get('image_cache_bytes', 0), cache_dir=cnf.get('image_cache_dir'))
+
+
 def convert_preprocessor(im_size):
     return functools.partial(convert.convert, target_size=im_size)
 
@@ -88,7 +119,8 @@ def create_prediction_iter(cnf, standardizer, crop_size, preprocessor=None, sync
         crop_size=crop_size,
         is_training=False,
         standardizer=standardizer,
-        fill_mode='constant'
+        fill_mode='constant',
+        batch_warp=cnf.get('batch_warp', False)
     )
 
     return prediction_iterator
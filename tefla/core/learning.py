@@ -10,6 +10,8 @@ import tensorflow as tf
 
 from .base import Base, BaseMixin
 from . import summary as summary
+from .checkpoint import CheckpointManager
+from .staging import StagedInputs, closing_staged_inputs
 from . import logger as log
 from ..utils import util
 
@@ -40,6 +42,8 @@ class SupervisedLearner(Base, BaseMixin):
         gpu_memory_fraction: amount of gpu memory to use
         is_summary: bool, to write summary or not
     """
+    supports_accum_steps = True
+    supports_validation_schedule = True
 
     def __init__(self, model, cnf, clip_by_global_norm=False, **kwargs):
         self.clip_by_global_norm = clip_by_global_norm
@@ -74,6 +78,10 @@ class SupervisedLearner(Base, BaseMixin):
             self.update_ops = None
             # if update_ops is not None:
             #     regularized_training_loss = control_flow_ops.with_dependencies(update_ops, regularized_training_loss)
+        self.training_step = self.train_op if self.accumulate_op is None else self.accumulate_op
+        if self.staged_inputs is not None and self.update_ops is not None:
+            # the update ops consume the staged batch, they run in the same step
+            self.training_step = tf.group(self.training_step, *self.update_ops)
 
     def _train_loop(self, data_set, weights_from, start_epoch, summary_every):
         training_X, training_y, validation_X, validation_y = \
@@ -83,6 +91,11 @@ class SupervisedLearner(Base, BaseMixin):
         weights_dir = "weights"
         if not os.path.exists(weights_dir):
             os.mkdir(weights_dir)
+        checkpoints = CheckpointManager(
+            weights_dir=weights_dir, keep_best=self.cnf.get('keep_best_checkpoints'),
+            keep_last=self.cnf.get('keep_last_checkpoints'),
+            metric=self.cnf.get('checkpoint_metric', 'validation_loss'),
+            mode=self.cnf.get('checkpoint_metric_mode', 'min'))
         if self.is_summary:
             training_batch_summary_op = tf.merge_all_summaries(
                 key=TRAINING_BATCH_SUMMARIES)
@@ -95,12 +108,13 @@ class SupervisedLearner(Base, BaseMixin):
 
         gpu_options = tf.GPUOptions(
             per_process_gpu_memory_fraction=self.gpu_memory_fraction)
-        with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=True, log_device_placement=False)) as sess:
+        with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options, allow_soft_placement=True, log_device_placement=False)) as sess, checkpoints, \
+                closing_staged_inputs(self.staged_inputs, sess):
             if start_epoch > 1:
                 weights_from = "weights/model-epoch-%d.ckpt" % (
                     start_epoch - 1)
 
-            sess.run(tf.global_variables_initializer())
+            sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
             if weights_from:
                 self._load_weights(sess, saver, weights_from)
 
@@ -115,6 +129,8 @@ class SupervisedLearner(Base, BaseMixin):
             batch_iter_idx = 1
             n_iters_per_epoch = len(
                 data_set.training_X) // self.training_iterator.batch_size
+            # the lr policy counts optimizer steps, not accumulated micro-batches
+            n_iters_per_epoch = int(np.ceil(n_iters_per_epoch / self.accum_steps))
             self.lr_policy.n_iters_per_epoch = n_iters_per_epoch
             for epoch in xrange(start_epoch, self.num_epochs + 1):
                 np.random.seed(epoch + seed_delta)
@@ -123,16 +139,21 @@ class SupervisedLearner(Base, BaseMixin):
                 training_losses = []
                 batch_train_sizes = []
 
-                for batch_num, (Xb, yb) in enumerate(self.training_iterator(training_X, training_y)):
-                    feed_dict_train = {self.inputs: Xb, self.labels: self._adjust_ground_truth(yb),
-                                       self.learning_rate: learning_rate_value}
+                training_batches = self.training_iterator(training_X, training_y)
+                if self.staged_inputs is not None:
+                    training_batches = self.staged_inputs.epoch(
+                        sess, training_batches, lambda Xb, yb: (Xb, self._adjust_ground_truth(yb)))
+                for batch_num, (Xb, yb) in enumerate(training_batches):
+                    feed_dict_train = {self.learning_rate: learning_rate_value}
+                    if self.staged_inputs is None:
+                        feed_dict_train.update({self.inputs: Xb, self.labels: self._adjust_ground_truth(yb)})
 
                     log.debug('1. Loading batch %d data done.' % batch_num)
                     if epoch % summary_every == 0 and self.is_summary:
                         log.debug('2. Running training steps with summary...')
                         training_predictions_e, training_loss_e, summary_str_train, _ = sess.run(
                             [self.training_predictions, self.training_loss, training_batch_summary_op,
-                             self.train_op],
+                             self.training_step],
                             feed_dict=feed_dict_train)
                         train_writer.add_summary(summary_str_train, epoch)
                         train_writer.flush()
@@ -145,7 +166,7 @@ class SupervisedLearner(Base, BaseMixin):
                     else:
                         log.debug(
                             '2. Running training steps without summary...')
-                        training_loss_e, _ = sess.run([self.training_loss, self.train_op],
+                        training_loss_e, _ = sess.run([self.training_loss, self.training_step],
                                                       feed_dict=feed_dict_train)
                         log.debug(
                             '2. Running training steps without summary done.')
@@ -153,16 +174,28 @@ class SupervisedLearner(Base, BaseMixin):
                     training_losses.append(training_loss_e)
                     batch_train_sizes.append(len(Xb))
 
-                    if self.update_ops is not None:
+                    if self.update_ops is not None and self.staged_inputs is None:
                         log.debug('3. Running update ops...')
                         sess.run(self.update_ops, feed_dict=feed_dict_train)
                         log.debug('3. Running update ops done.')
 
+                    if self.accumulate_op is not None:
+                        if (batch_num + 1) % self.accum_steps != 0:
+                            log.debug('4. Training batch %d gradients accumulated.' % batch_num)
+                            continue
+                        sess.run(self.train_op, feed_dict={self.learning_rate: learning_rate_value})
                     learning_rate_value = self.lr_policy.batch_update(
                         learning_rate_value, batch_iter_idx)
                     batch_iter_idx += 1
                     log.debug('4. Training batch %d done.' % batch_num)
 
+                if self.accumulate_op is not None and len(batch_train_sizes) % self.accum_steps != 0:
+                    # applies the gradients of the last micro-batches of the epoch
+                    sess.run(self.train_op, feed_dict={self.learning_rate: learning_rate_value})
+                    learning_rate_value = self.lr_policy.batch_update(
+                        learning_rate_value, batch_iter_idx)
+                    batch_iter_idx += 1
+
                 epoch_training_loss = np.average(
                     training_losses, weights=batch_train_sizes)
 
@@ -176,90 +209,103 @@ class SupervisedLearner(Base, BaseMixin):
                 log.debug('5. Writing epoch summary done.')
 
                 # Validation prediction and metrics
-                validation_losses = []
-                batch_validation_metrics = [[]
-                                            for _, _ in self.validation_metrics_def]
-                epoch_validation_metrics = []
-                batch_validation_sizes = []
-                for batch_num, (validation_Xb, validation_yb) in enumerate(
-                        self.validation_iterator(validation_X, validation_y)):
-                    feed_dict_validation = {self.validation_inputs: validation_Xb,
-                                            self.validation_labels: self._adjust_ground_truth(validation_yb)}
-                    log.debug(
-                        '6. Loading batch %d validation data done.' % batch_num)
-
-                    if (epoch - 1) % summary_every == 0 and self.is_summary:
+                training_time = time.time() - tic
+                validated = self.validation_schedule.should_validate(epoch, self.num_epochs)
+                if validated:
+                    epoch_validation_X, epoch_validation_y = self.validation_schedule.validation_set(
+                        validation_X, validation_y, epoch, self.num_epochs)
+                    validation_losses = []
+                    for accumulator in self.validation_accumulators:
+                        accumulator.reset()
+                    batch_validation_sizes = []
+                    for batch_num, (validation_Xb, validation_yb) in enumerate(
+                            self.validation_iterator(epoch_validation_X, epoch_validation_y)):
+                        feed_dict_validation = {self.validation_inputs: validation_Xb,
+                                                self.validation_labels: self._adjust_ground_truth(validation_yb)}
                         log.debug(
-                            '7. Running validation steps with summary...')
-                        _validation_metric, summary_str_validate = sess.run(
-                            [self.validation_metric, validation_batch_summary_op], feed_dict=feed_dict_validation)
+                            '6. Loading batch %d validation data done.' % batch_num)
+
+                        if (epoch - 1) % summary_every == 0 and self.is_summary:
+                            log.debug(
+                                '7. Running validation steps with summary...')
+                            _validation_metric, validation_predictions_e, summary_str_validate = sess.run(
+                                [self.validation_metric, self.validation_predictions, validation_batch_summary_op],
+                                feed_dict=feed_dict_validation)
+                            validation_writer.add_summary(
+                                summary_str_validate, epoch)
+                            validation_writer.flush()
+                            log.debug(
+                                '7. Running validation steps with summary done.')
+                            log.debug(
+                                "Epoch %d, Batch %d validation loss: %s" % (epoch, batch_num, validation_loss_e))
+                            log.debug("Epoch %d, Batch %d validation predictions: %s" % (
+                                epoch, batch_num, validation_predictions_e))
+                        else:
+                            log.debug(
+                                '7. Running validation steps without summary...')
+                            _validation_metric, validation_predictions_e = sess.run(
+                                [self.validation_metric, self.validation_predictions], feed_dict=feed_dict_validation)
+                            log.debug(
+                                '7. Running validation steps without summary done.')
+                        validation_losses.append(_validation_metric[-1])
+                        batch_validation_sizes.append(
+                            self.cnf['batch_size_test'])
+
+                        self._update_validation_accumulators(
+                            _validation_metric[:-1], validation_predictions_e, validation_yb)
+                        log.debug('8. Validation batch %d done' % batch_num)
+
+                    epoch_validation_loss = np.average(
+                        validation_losses, weights=batch_validation_sizes)
+                    epoch_validation_metrics = [accumulator.compute()
+                                                for accumulator in self.validation_accumulators]
+
+                    # Write validation epoch summary every epoch
+                    log.debug('9. Writing epoch validation summary...')
+                    if self.is_summary:
+                        summary_str_validate = sess.run(validation_epoch_summary_op, feed_dict={
+                                                        self.epoch_loss: epoch_validation_loss, self.validation_metric_placeholders: epoch_validation_metrics})
                         validation_writer.add_summary(
                             summary_str_validate, epoch)
                         validation_writer.flush()
-                        log.debug(
-                            '7. Running validation steps with summary done.')
-                        log.debug(
-                            "Epoch %d, Batch %d validation loss: %s" % (epoch, batch_num, validation_loss_e))
-                        log.debug("Epoch %d, Batch %d validation predictions: %s" % (
-                            epoch, batch_num, validation_predictions_e))
-                    else:
-                        log.debug(
-                            '7. Running validation steps without summary...')
-                        _validation_metric = sess.run(
-                            self.validation_metric, feed_dict=feed_dict_validation)
-                        log.debug(
-                            '7. Running validation steps without summary done.')
-                    validation_losses.append(_validation_metric[-1])
-                    batch_validation_sizes.append(
-                        self.cnf['batch_size_test'])
-
-                    for i, (_, metric_function) in enumerate(self.validation_metrics_def):
-                        batch_validation_metrics[i].append(
-                            _validation_metric[i])
-                    log.debug('8. Validation batch %d done' % batch_num)
-
-                epoch_validation_loss = np.average(
-                    validation_losses, weights=batch_validation_sizes)
-                for i, (_, _) in enumerate(self.validation_metrics_def):
-                    epoch_validation_metrics.append(
-                        np.average(batch_validation_metrics[i], weights=batch_validation_sizes))
-
-                # Write validation epoch summary every epoch
-                log.debug('9. Writing epoch validation summary...')
-                if self.is_summary:
-                    summary_str_validate = sess.run(validation_epoch_summary_op, feed_dict={
-                                                    self.epoch_loss: epoch_validation_loss, self.validation_metric_placeholders: epoch_validation_metrics})
-                    validation_writer.add_summary(
-                        summary_str_validate, epoch)
-                    validation_writer.flush()
-                log.debug('9. Writing epoch validation summary done.')
-
-                custom_metrics_string = [', %s: %.3f' % (name, epoch_validation_metrics[i]) for i, (name, _) in
-                                         enumerate(self.validation_metrics_def)]
-                custom_metrics_string = ''.join(custom_metrics_string)
-
-                log.info(
-                    "Epoch %d [(%s, %s) images, %6.1fs]: t-loss: %.3f, v-loss: %.3f%s" %
-                    (epoch, np.sum(batch_train_sizes), np.sum(batch_validation_sizes), time.time() - tic,
-                     epoch_training_loss,
-                     epoch_validation_loss,
-                     custom_metrics_string)
-                )
-
-                saver.save(sess, "%s/model-epoch-%d.ckpt" %
-                           (weights_dir, epoch))
+                    log.debug('9. Writing epoch validation summary done.')
+
+                    custom_metrics_string = [', %s: %.3f' % (name, epoch_validation_metrics[i]) for i, (name, _) in
+                                             enumerate(self.validation_metrics_def)]
+                    custom_metrics_string = ''.join(custom_metrics_string)
+
+                    log.info(
+                        "Epoch %d [(%s, %s) images, %6.1fs]: t-loss: %.3f, v-loss: %.3f%s" %
+                        (epoch, np.sum(batch_train_sizes), np.sum(batch_validation_sizes), time.time() - tic,
+                         epoch_training_loss,
+                         epoch_validation_loss,
+                         custom_metrics_string)
+                    )
+                else:
+                    log.info(
+                        "Epoch %d [%s images, %6.1fs]: t-loss: %.3f, validation skipped" %
+                        (epoch, np.sum(batch_train_sizes), time.time() - tic, epoch_training_loss))
+                self.validation_schedule.record(training_time, time.time() - tic - training_time)
 
                 epoch_info = dict(
                     epoch=epoch,
-                    training_loss=epoch_training_loss,
-                    validation_loss=epoch_validation_loss
+                    training_loss=epoch_training_loss
                 )
+                if validated:
+                    epoch_info.update(
+                        validation_loss=epoch_validation_loss,
+                        validation_subset=not self.validation_schedule.is_full(epoch, self.num_epochs),
+                        validation_metrics=dict(zip([name for name, _ in self.validation_metrics_def],
+                                                    epoch_validation_metrics)))
 
                 training_history.append(epoch_info)
+                checkpoints.save(sess, epoch, CheckpointManager.epoch_metrics(epoch_info))
 
                 log.debug('10. Epoch done. [%d]' % epoch)
-                learning_rate_value = self.lr_policy.epoch_update(
-                    learning_rate_value, training_history)
+                lr_history = self.validation_schedule.lr_policy_history(self.lr_policy, training_history)
+                if lr_history is not None:
+                    learning_rate_value = self.lr_policy.epoch_update(
+                        learning_rate_value, lr_history)
                 log.info("Learning rate: %f " % learning_rate_value)
             if self.is_summary:
                 train_writer.close()
@@ -286,7 +332,7 @@ class SupervisedLearner(Base, BaseMixin):
                                                 i], loss_type=self.loss_type, is_training=is_training, reuse=reuse, is_classification=is_classification, gpu_id=i)
 
                         tf.get_variable_scope().reuse_variables()
-                        if self.clip_by_global_norm:
+                        if self.clip_by_global_norm and self.accum_steps == 1:
                             grads_and_vars = self._clip_grad_global_norms(tf.trainable_variables(
                             ), loss, opt, global_norm=self.norm_threshold, gradient_noise_scale=0.0)
                         else:
@@ -302,7 +348,7 @@ class SupervisedLearner(Base, BaseMixin):
         tower_loss = []
         predictions = []
         validation_metric = []
-        validation_metric_tmp = [[] for _, _ in self.validation_metrics_def]
+        validation_metric_tmp = [[] for _ in self._graph_validation_metrics()]
         if self.cnf.get('num_gpus', 1) > 1:
             images_gpus = tf.split(
                 self.validation_inputs, self.cnf.get('num_gpus', 1), axis=0)
@@ -318,14 +364,14 @@ class SupervisedLearner(Base, BaseMixin):
                         i], loss_type=self.loss_type, is_training=is_training, reuse=reuse, is_classification=is_classification)
                     tower_loss.append(loss_pred['loss'])
                     predictions.append(loss_pred['predictions'])
-                    for j, (_, metric_function) in enumerate(self.validation_metrics_def):
+                    for j, metric_function in enumerate(self._graph_validation_metrics()):
                         metric_score = metric_function(
                             labels_gpus[i], tf.argmax(loss_pred['predictions'], 1))
                         validation_metric_tmp[j].append(metric_score)
         predictions = tf.convert_to_tensor(predictions)
         predictions = tf.reshape(predictions, [-1, num_classes])
-        for i, (_, _) in enumerate(self.validation_metrics_def):
-            validation_metric.append(sum(validation_metric_tmp[i]))
+        for metric_scores in validation_metric_tmp:
+            validation_metric.append(sum(metric_scores))
         return sum(tower_loss), predictions, validation_metric
 
     def _setup_model_loss(self, keep_moving_averages=False, num_classes=5):
@@ -347,16 +393,30 @@ class SupervisedLearner(Base, BaseMixin):
             self.validation_labels = tf.placeholder(tf.int64, shape=(None,))
         self.validation_inputs = tf.placeholder(tf.float32, shape=(
             None, self.cnf['crop_size'][0], self.cnf['crop_size'][1], 3), name="validation_input")
+        self.staged_inputs = None
+        if self.cnf.get('staged_inputs', False):
+            # the training towers dequeue the batches staged by a feeder thread
+            self.staged_inputs = StagedInputs(
+                [self.inputs, self.labels], capacity=self.cnf.get('staging_capacity', 2))
+            self.inputs, self.labels = self.staged_inputs.outputs
         self.grads_and_vars, self.training_loss = self._process_towers_grads(
             optimizer, self.model, is_classification=self.classification)
         self.validation_loss, self.validation_predictions, self.validation_metric = self._process_towers_loss(
             optimizer, self.model, is_classification=self.classification, num_classes=num_classes)
         self.validation_metric.append(self.validation_loss)
 
-        if self.clip_norm and not self.clip_by_global_norm:
-            self.grads_and_vars = self._clip_grad_norms(
-                self.grads_and_vars, max_norm=self.norm_threshold)
-        apply_gradients_op = optimizer.apply_gradients(self.grads_and_vars)
+        self.accumulate_op = None
+        if self.accum_steps > 1:
+            # the training steps accumulate the micro-batch gradients, the optimizer steps
+            # clip and apply them once every accum_steps micro-batches
+            self.accumulate_op, apply_gradients_op = self._accumulate_gradients(
+                self.grads_and_vars, optimizer, clip_norm=self.clip_norm,
+                clip_by_global_norm=self.clip_by_global_norm, max_norm=self.norm_threshold)
+        else:
+            if self.clip_norm and not self.clip_by_global_norm:
+                self.grads_and_vars = self._clip_grad_norms(
+                    self.grads_and_vars, max_norm=self.norm_threshold)
+            apply_gradients_op = optimizer.apply_gradients(self.grads_and_vars)
         if keep_moving_averages:
             variables_averages_op = self._moving_averages_op()
             with tf.control_dependencies([apply_gradients_op, variables_averages_op]):
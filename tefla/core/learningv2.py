@@ -44,11 +44,15 @@ class SupervisedLearner(Base, BaseMixin):
         gpu_memory_fraction: amount of gpu memory to use
         is_summary: bool, to write summary or not
     """
+    supports_validation_schedule = True
 
     def __init__(self, model, cnf, clip_by_global_norm=False, **kwargs):
         self.clip_by_global_norm = clip_by_global_norm
         super(SupervisedLearner, self).__init__(
             model, cnf, **kwargs)
+        if self.validation_schedule.subset_size is not None:
+            # the validation queue always reads the whole validation set
+            raise ValueError('validation_schedule subset_size is not supported by the queue based learner')
 
     def fit(self, data_dir, data_dir_val=None, features_keys=None, weights_from=None, start_epoch=1, summary_every=10, training_set_size=None, val_set_size=None, dataset_name='cifar10', keep_moving_averages=False):
         """
@@ -221,13 +225,15 @@ class SupervisedLearner(Base, BaseMixin):
             log.debug('5. Writing epoch summary done.')
 
             # Validation prediction and metrics
+            training_time = time.time() - tic
+            validated = dataset_val is not None and self.validation_schedule.should_validate(epoch, self.num_epochs)
             validation_losses = []
-            batch_validation_metrics = [[]
-                                        for _, _ in self.validation_metrics_def]
+            for accumulator in self.validation_accumulators:
+                accumulator.reset()
             epoch_validation_metrics = []
             epoch_validation_loss = 0
             batch_validation_sizes = []
-            if dataset_val is not None:
+            if validated:
                 for batch_num in xrange(dataset_val.n_iters_per_epoch):
                     log.debug(
                         '6. Loading batch %d validation data done.' % batch_num)
@@ -235,8 +241,9 @@ class SupervisedLearner(Base, BaseMixin):
                     if (epoch - 1) % summary_every == 0 and self.is_summary:
                         log.debug(
                             '7. Running validation steps with summary...')
-                        _validation_metric, summary_str_validate = sess.run(
-                            [self.validation_metric, validation_batch_summary_op])
+                        _validation_metric, validation_predictions_e, validation_targets_e, summary_str_validate = sess.run(
+                            [self.validation_metric, self.validation_predictions, self.validation_targets,
+                             validation_batch_summary_op])
                         validation_writer.add_summary(
                             summary_str_validate, epoch)
                         validation_writer.flush()
@@ -249,23 +256,22 @@ class SupervisedLearner(Base, BaseMixin):
                     else:
                         log.debug(
                             '7. Running validation steps without summary...')
-                        _validation_metric = sess.run(self.validation_metric)
+                        _validation_metric, validation_predictions_e, validation_targets_e = sess.run(
+                            [self.validation_metric, self.validation_predictions, self.validation_targets])
                         log.debug(
                             '7. Running validation steps without summary done.')
                     validation_losses.append(_validation_metric[-1])
                     batch_validation_sizes.append(
                         self.cnf['batch_size_test'])
 
-                    for i, (_, metric_function) in enumerate(self.validation_metrics_def):
-                        batch_validation_metrics[i].append(
-                            _validation_metric[i])
+                    self._update_validation_accumulators(
+                        _validation_metric[:-1], validation_predictions_e, validation_targets_e)
                     log.debug('8. Validation batch %d done' % batch_num)
 
                 epoch_validation_loss = np.average(
                     validation_losses, weights=batch_validation_sizes)
-                for i, (_, _) in enumerate(self.validation_metrics_def):
-                    epoch_validation_metrics.append(
-                        np.average(batch_validation_metrics[i], weights=batch_validation_sizes))
+                epoch_validation_metrics = [accumulator.compute()
+                                            for accumulator in self.validation_accumulators]
 
                 # Write validation epoch summary every epoch
                 log.debug('9. Writing epoch validation summary...')
@@ -281,26 +287,37 @@ class SupervisedLearner(Base, BaseMixin):
                                          enumerate(self.validation_metrics_def)]
                 custom_metrics_string = ''.join(custom_metrics_string)
 
-            log.info(
-                "Epoch %d [(%s, %s) images, %6.1fs]: t-loss: %.3f, v-loss: %.3f%s" %
-                (epoch, np.sum(batch_train_sizes), np.sum(batch_validation_sizes), time.time() - tic,
-                 epoch_training_loss,
-                 epoch_validation_loss,
-                 custom_metrics_string)
-            )
+                log.info(
+                    "Epoch %d [(%s, %s) images, %6.1fs]: t-loss: %.3f, v-loss: %.3f%s" %
+                    (epoch, np.sum(batch_train_sizes), np.sum(batch_validation_sizes), time.time() - tic,
+                     epoch_training_loss,
+                     epoch_validation_loss,
+                     custom_metrics_string)
+                )
+            else:
+                log.info(
+                    "Epoch %d [%s images, %6.1fs]: t-loss: %.3f, validation skipped" %
+                    (epoch, np.sum(batch_train_sizes), time.time() - tic, epoch_training_loss))
+            self.validation_schedule.record(training_time, time.time() - tic - training_time)
 
             saver.save(sess, "%s/model-epoch-%d.ckpt" %
                        (weights_dir, epoch))
 
             epoch_info = dict(
                 epoch=epoch,
-                training_loss=epoch_training_loss,
-                validation_loss=epoch_validation_loss
+                training_loss=epoch_training_loss
             )
+            if validated:
+                epoch_info.update(
+                    validation_loss=epoch_validation_loss,
+                    validation_metrics=dict(zip([name for name, _ in self.validation_metrics_def],
+                                                epoch_validation_metrics)))
 
             training_history.append(epoch_info)
-            learning_rate_value = self.lr_policy.epoch_update(
-                learning_rate_value, training_history)
+            lr_history = self.validation_schedule.lr_policy_history(self.lr_policy, training_history)
+            if lr_history is not None:
+                learning_rate_value = self.lr_policy.epoch_update(
+                    learning_rate_value, lr_history)
             log.info("Learning rate: %f " % learning_rate_value)
 
             if self.is_summary:
@@ -338,8 +355,9 @@ class SupervisedLearner(Base, BaseMixin):
     def _process_towers_loss(self, dataset, opt, model, is_training=False, reuse=True, is_classification=True, num_classes=10):
         tower_loss = []
         predictions = []
+        targets = []
         validation_metric = []
-        validation_metric_tmp = [[] for _, _ in self.validation_metrics_def]
+        validation_metric_tmp = [[] for _ in self._graph_validation_metrics()]
         for i in xrange(self.cnf.get('num_gpus', 1)):
             with tf.device('/gpu:%d' % i):
                 with tf.name_scope('%s_%d' % (self.cnf.get('TOWER_NAME', 'tower'), i)) as scope:
@@ -350,15 +368,16 @@ class SupervisedLearner(Base, BaseMixin):
                         scope, model, images, labels, is_training=is_training, reuse=reuse, is_classification=is_classification)
                     tower_loss.append(loss_pred['loss'])
                     predictions.append(loss_pred['predictions'])
-                    for i, (_, metric_function) in enumerate(self.validation_metrics_def):
+                    targets.append(labels)
+                    for i, metric_function in enumerate(self._graph_validation_metrics()):
                         metric_score = metric_function(
                             labels, tf.argmax(loss_pred['predictions'], 1))
                         validation_metric_tmp[i].append(metric_score)
         predictions = tf.convert_to_tensor(predictions)
         predictions = tf.reshape(predictions, [-1, num_classes])
-        for i, (_, _) in enumerate(self.validation_metrics_def):
-            validation_metric.append(sum(validation_metric_tmp[i]))
-        return sum(tower_loss), predictions, validation_metric
+        for metric_scores in validation_metric_tmp:
+            validation_metric.append(sum(metric_scores))
+        return sum(tower_loss), predictions, tf.concat(targets, 0), validation_metric
 
     def _setup_model_loss(self, dataflow, dataflow_val=None, keep_moving_averages=False, num_classes=10):
         self.learning_rate = tf.placeholder(
@@ -371,7 +390,7 @@ class SupervisedLearner(Base, BaseMixin):
         self.grads_and_vars, self.training_loss = self._process_towers_grads(
             dataflow, optimizer, self.model, is_classification=self.classification)
         if dataflow_val is not None:
-            self.validation_loss, self.validation_predictions, self.validation_metric = self._process_towers_loss(
+            self.validation_loss, self.validation_predictions, self.validation_targets, self.validation_metric = self._process_towers_loss(
                 dataflow_val, optimizer, self.model, is_classification=self.classification, num_classes=num_classes)
             self.validation_metric.append(self.validation_loss)
 
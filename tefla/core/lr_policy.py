@@ -140,6 +140,7 @@ class AdaptiveDecayPolicy(InitialLrMixin, NoBatchUpdateMixin):
     If validation loss doesnt decreases over last 5 epoch then decay the learning rate by a
     multiplication factor 0.9; e.g. current_lr*0.9
     """
+    uses_validation = True
 
     def epoch_update(self, learning_rate, training_history, verbose=-1):
         """
@@ -187,6 +188,7 @@ class AdaptiveUpDownDecayPolicy(InitialLrMixin, NoBatchUpdateMixin):
     Here we will count the number of upward and downward movements of validation loss,
     if validation losses increases for 6 times (for 10 epoch) then decay the current learning rate
     """
+    uses_validation = True
 
     def epoch_update(self, learning_rate, training_history, sess, verbose=-1):
         """
@@ -7,6 +7,8 @@ import tensorflow as tf
 import numpy as np
 from sklearn.metrics import precision_recall_fscore_support, roc_auc_score, accuracy_score
 
+from ..utils import quadratic_weighted_kappa as qwk
+
 
 class Metric(object):
 
@@ -17,6 +19,84 @@ class Metric(object):
         raise NotImplementedError
 
 
+class MetricAccumulator(object):
+    """Streaming metric protocol
+
+    An accumulator is updated batch by batch, e.g. over the validation batches,
+    and computes the metric once at the end, so that the metrics which are not
+    a mean over samples (kappa, auroc, f1) are exact. Accumulators filled
+    by different workers are combined with `merge`.
+    """
+
+    def reset(self):
+        """Clears the accumulated state"""
+        raise NotImplementedError
+
+    def update(self, predictions, targets):
+        """Adds a batch of predictions and targets"""
+        raise NotImplementedError
+
+    def merge(self, other):
+        """Adds the state of another accumulator of the same type"""
+        raise NotImplementedError
+
+    def compute(self):
+        """Returns the metric over all the batches seen since the last reset"""
+        raise NotImplementedError
+
+
+class BatchAverage(MetricAccumulator):
+    """Size weighted average of per batch scores
+
+    Used for the metric functions that are not accumulators, e.g. `util.kappa_wrapper`
+    or metric ops computed in the graph.
+
+    Args:
+        metric_function: callable, `metric_function(targets, predictions)` returns a batch score
+    """
+
+    def __init__(self, metric_function=None):
+        self.metric_function = metric_function
+        self.reset()
+
+    def reset(self):
+        self.total = 0.0
+        self.weight = 0
+
+    def update(self, predictions, targets):
+        self.add(self.metric_function(targets, predictions), len(targets))
+        return self
+
+    def add(self, score, weight):
+        """Adds an already computed batch score"""
+        self.total += score * weight
+        self.weight += weight
+        return self
+
+    def merge(self, other):
+        self.total += other.total
+        self.weight += other.weight
+        return self
+
+    def compute(self):
+        return self.total / self.weight if self.weight else np.nan
+
+
+def as_accumulator(metric_function):
+    """Returns `metric_function` if it is an accumulator, else a `BatchAverage` of it"""
+    if isinstance(metric_function, MetricAccumulator):
+        return metric_function
+    return BatchAverage(metric_function)
+
+
+def _as_labels(values):
+    """Labels of a batch of labels, one hot vectors or class probabilities"""
+    values = np.asarray(values)
+    if values.ndim > 1 and values.shape[1] > 1:
+        return np.argmax(values, axis=1)
+    return values.ravel()
+
+
 class MetricMixin(object):
 
     def __init__(self, name='metric_hist_confusion'):
@@ -27,31 +107,13 @@ class MetricMixin(object):
         """
         Returns the confusion matrix between rater's ratings
         """
-        assert(len(rater_a) == len(rater_b))
-        if min_rating is None:
-            min_rating = min(rater_a + rater_b)
-        if max_rating is None:
-            max_rating = max(rater_a + rater_b)
-        num_ratings = int(max_rating - min_rating + 1)
-        conf_mat = [[0 for i in range(num_ratings)]
-                    for j in range(num_ratings)]
-        for a, b in zip(rater_a, rater_b):
-            conf_mat[a - min_rating][b - min_rating] += 1
-        return conf_mat
+        return qwk.confusion_matrix(rater_a, rater_b, min_rating, max_rating)
 
     def histogram(self, ratings, min_rating=None, max_rating=None):
         """
         Returns the counts of each type of rating that a rater made
         """
-        if min_rating is None:
-            min_rating = min(ratings)
-        if max_rating is None:
-            max_rating = max(ratings)
-        num_ratings = int(max_rating - min_rating + 1)
-        hist_ratings = [0 for x in range(num_ratings)]
-        for r in ratings:
-            hist_ratings[r - min_rating] += 1
-        return hist_ratings
+        return qwk.histogram(ratings, min_rating, max_rating)
 
 
 class Top_k(Metric):
@@ -168,41 +230,44 @@ class Kappa(Metric, MetricMixin):
         is the minimum possible rating, and max_rating is the maximum possible
         rating
         """
-        rater_a = np.clip(rater_a, min_rating, max_rating)
-        rater_b = np.clip(rater_b, min_rating, max_rating)
+        rater_a = qwk.clean_ratings(rater_a, min_rating, max_rating)
+        rater_b = qwk.clean_ratings(rater_b, min_rating, max_rating)
+        assert(len(rater_a) == len(rater_b))
+        conf_mat = self.confusion_matrix(rater_a, rater_b, min_rating, max_rating)
+        return qwk.kappa_from_confusion_matrix(conf_mat, zero_division_value=0.0001)
 
-        rater_a = np.round(rater_a).astype(int).ravel()
-        rater_a[~np.isfinite(rater_a)] = 0
-        rater_b = np.round(rater_b).astype(int).ravel()
-        rater_b[~np.isfinite(rater_b)] = 0
 
-        assert(len(rater_a) == len(rater_b))
-        if min_rating is None:
-            min_rating = min(min(rater_a), min(rater_b))
-        if max_rating is None:
-            max_rating = max(max(rater_a), max(rater_b))
-        conf_mat = self.confusion_matrix(
-            rater_a, rater_b, min_rating, max_rating)
-        num_ratings = len(conf_mat)
-        num_scored_items = float(len(rater_a))
-
-        hist_rater_a = self.histogram(rater_a, min_rating, max_rating)
-        hist_rater_b = self.histogram(rater_b, min_rating, max_rating)
-
-        numerator = 0.0
-        denominator = 0.0
-
-        for i in range(num_ratings):
-            for j in range(num_ratings):
-                expected_count = (
-                    hist_rater_a[i] * hist_rater_b[j] / num_scored_items)
-                d = pow(i - j, 2.0) / pow(num_ratings - 1, 2.0)
-                numerator += d * conf_mat[i][j] / num_scored_items
-                denominator += d * expected_count / num_scored_items
-        try:
-            return 1.0 - numerator / denominator
-        except ZeroDivisionError:
-            return 0.0001
+class KappaAccumulator(MetricAccumulator):
+    """Streaming quadratic weighted kappa
+
+    Accumulates the ratings confusion matrix batch by batch, e.g. over the
+    validation batches, the kappa is computed once from the final matrix.
+
+    Args:
+        num_classes: int, number of ratings, the ratings are clipped to [0, num_classes - 1]
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.conf_mat = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+
+    def update(self, predictions, targets):
+        """Adds a batch of predictions and targets, either labels or one hot/probabilities"""
+        max_rating = self.num_classes - 1
+        self.conf_mat += qwk.confusion_matrix(qwk.clean_ratings(_as_labels(predictions), 0, max_rating),
+                                              qwk.clean_ratings(_as_labels(targets), 0, max_rating), 0, max_rating)
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another accumulator"""
+        self.conf_mat += other.conf_mat
+        return self
+
+    def compute(self):
+        return qwk.kappa_from_confusion_matrix(self.conf_mat, zero_division_value=0.0001)
 
 
 class KappaV2(Metric, MetricMixin):
@@ -305,6 +370,51 @@ class Auroc(Metric):
             return accuracy_score(y_true, np.argmax(y_pred, axis=1))
 
 
+class AurocAccumulator(MetricAccumulator):
+    """Streaming binary auroc
+
+    Keeps the positive class scores and the labels of every batch, the auroc
+    of the whole set is computed once, as `Auroc.metric` does.
+
+    Args:
+        num_classes: int, num_classes of the network, to one hot label predictions
+    """
+
+    def __init__(self, num_classes=2):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.scores = []
+        self.predicted = []
+        self.targets = []
+
+    def update(self, predictions, targets):
+        predictions = np.asarray(predictions)
+        if predictions.ndim == 1:
+            predictions = one_hot(predictions, m=self.num_classes)
+        self.scores.append(predictions[:, 1].astype(np.float32))
+        self.predicted.append(np.argmax(predictions, axis=1))
+        self.targets.append(_as_labels(targets))
+        return self
+
+    def merge(self, other):
+        self.scores.extend(other.scores)
+        self.predicted.extend(other.predicted)
+        self.targets.extend(other.targets)
+        return self
+
+    def compute(self):
+        if not self.targets:
+            return np.nan
+        targets = np.concatenate(self.targets)
+        try:
+            return roc_auc_score(targets, np.concatenate(self.scores))
+        except ValueError as e:
+            print(e)
+            return accuracy_score(targets, np.concatenate(self.predicted))
+
+
 class F1score(Metric):
 
     def __init__(self, name='auroc'):
@@ -335,6 +445,71 @@ class F1score(Metric):
         return accuracy_score(y_true, y_pred_2) if 0 in f1 else np.mean(f1)
 
 
+class F1Accumulator(MetricAccumulator):
+    """Streaming macro F1 score
+
+    Accumulates the confusion matrix; as `F1score.metric`, the mean F1 over the
+    classes present in the targets or predictions, or the accuracy if one of
+    them has a zero F1.
+
+    Args:
+        num_classes: int, num_classes of the network
+    """
+
+    def __init__(self, num_classes=5):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.conf_mat = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+
+    def update(self, predictions, targets):
+        self.conf_mat += qwk.confusion_matrix(_as_labels(targets), _as_labels(predictions), 0, self.num_classes - 1)
+        return self
+
+    def merge(self, other):
+        self.conf_mat += other.conf_mat
+        return self
+
+    def compute(self):
+        total = self.conf_mat.sum()
+        if total == 0:
+            return np.nan
+        tp = np.diag(self.conf_mat).astype(np.float64)
+        actual = self.conf_mat.sum(axis=1)
+        predicted = self.conf_mat.sum(axis=0)
+        present = (actual + predicted) > 0
+        tp, actual, predicted = tp[present], actual[present], predicted[present]
+        # 2 * precision * recall / (precision + recall)
+        f1 = 2 * tp / (actual + predicted)
+        return tp.sum() / total if 0 in f1 else np.mean(f1)
+
+
+class AccuracyAccumulator(MetricAccumulator):
+    """Streaming accuracy, predictions and targets are labels or one hot/probabilities"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.correct = 0
+        self.total = 0
+
+    def update(self, predictions, targets):
+        targets = _as_labels(targets)
+        self.correct += int(np.sum(_as_labels(predictions) == targets))
+        self.total += len(targets)
+        return self
+
+    def merge(self, other):
+        self.correct += other.correct
+        self.total += other.total
+        return self
+
+    def compute(self):
+        return self.correct / float(self.total) if self.total else np.nan
+
+
 def accuracy_op(predictions, targets, num_classes=5):
     """
     Computes accuracy metric
@@ -371,11 +546,62 @@ def one_hot(vec, m=None):
 
 def fast_hist(a, b, n):
     k = (a >= 0) & (a < n)
-    return np.bincount(n * a[k].astype(int) + b[k], minlength=n**2).reshape(n, n)
+    return np.bincount(n * a[k].astype(np.int64) + b[k], minlength=n**2).reshape(n, n)
 
 
 def compute_hist(preds, gt, num_classes=15):
-    hist = np.zeros((num_classes, num_classes))
-    hist += fast_hist(np.reshape(gt, (-1)),
-                      np.reshape(preds, (-1)), num_classes)
-    return hist
+    """int64 confusion matrix of a segmentation, rows are the ground truth classes"""
+    return fast_hist(np.reshape(gt, (-1)), np.reshape(preds, (-1)), num_classes)
+
+
+class ConfusionMatrixAccumulator(MetricAccumulator):
+    """Streaming segmentation metrics
+
+    Accumulates an int64 confusion matrix over batches/images, so that the
+    per pixel arrays do not need to be kept around; accumulators filled by
+    different worker processes are combined with `merge`.
+
+    Args:
+        num_classes: int, number of classes, ground truth labels outside
+            [0, num_classes) are ignored
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        self.hist = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+
+    def update(self, preds, gt):
+        """Adds a batch of predicted and ground truth label maps of the same shape"""
+        self.hist += compute_hist(preds, gt, self.num_classes)
+        return self
+
+    def merge(self, other):
+        """Adds the counts of another accumulator or confusion matrix"""
+        self.hist += other.hist if isinstance(other, ConfusionMatrixAccumulator) else other
+        return self
+
+    def per_class_iou(self):
+        """IoU of every class, nan for classes absent from both ground truth and predictions"""
+        tp = np.diag(self.hist).astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return tp / (self.hist.sum(1) + self.hist.sum(0) - tp)
+
+    def mean_iou(self):
+        return np.nanmean(self.per_class_iou())
+
+    def pixel_accuracy(self):
+        return np.diag(self.hist).sum() / float(max(self.hist.sum(), 1))
+
+    def freq_weighted_iou(self):
+        freq = self.hist.sum(1) / float(max(self.hist.sum(), 1))
+        iou = self.per_class_iou()
+        valid = freq > 0
+        return (freq[valid] * iou[valid]).sum()
+
+    def compute(self):
+        """Returns a dict of the segmentation metrics"""
+        return {'mean_iou': self.mean_iou(), 'per_class_iou': self.per_class_iou(),
+                'pixel_accuracy': self.pixel_accuracy(), 'freq_weighted_iou': self.freq_weighted_iou()}
@@ -1,7 +1,9 @@
 from __future__ import division, print_function, absolute_import
 
+import Queue
+import threading
 import time
-from scipy.stats.mstats import gmean
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tensorflow as tf
 from ..da import tta
@@ -28,9 +30,9 @@ class PredictSessionMixin(object):
         else:
             self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto())
 
-    def predict(self, X):
+    def predict(self, X, **kwargs):
         with self.graph.as_default():
-            return self._real_predict(X)
+            return self._real_predict(X, **kwargs)
 
     def _real_predict(self, X):
         pass
@@ -47,13 +49,19 @@ class OneCropPredictor(PredictSessionMixin):
         cnf: prediction configs
         weights_from: location of the model weights file
         prediction_iterator: iterator to access and augment the data for prediction
+        pipelined: bool, if True the batches are loaded on a producer thread and the
+            session runs are issued from another thread, overlapping the data loading,
+            the inference and the collection of the predictions
+        pipeline_depth: int, max number of batches waiting between two pipeline stages
         gpu_memory_fraction: fraction of gpu memory to use, if not cpu prediction
     """
 
-    def __init__(self, model, cnf, weights_from, prediction_iterator):
+    def __init__(self, model, cnf, weights_from, prediction_iterator, pipelined=False, pipeline_depth=2):
         self.model = model
         self.cnf = cnf
         self.prediction_iterator = prediction_iterator
+        self.pipelined = pipelined
+        self.pipeline_depth = pipeline_depth
         super(OneCropPredictor, self).__init__(weights_from)
         with self.graph.as_default():
             self._build_model()
@@ -66,17 +74,34 @@ class OneCropPredictor(PredictSessionMixin):
         self.inputs = end_points_predict['inputs']
         self.predictions = end_points_predict['predictions']
 
-    def _real_predict(self, X, xform=None, crop_bbox=None):
+    def _real_predict(self, X, xform=None, crop_bbox=None, color_vecs=None, aggregator=None):
+        """Returns the predictions, or with an `aggregator` feeds it batch by batch and returns it"""
         tic = time.time()
         print('Making %d predictions' % len(X))
         data_predictions = []
-        for X, y in self.prediction_iterator(X, xform=xform, crop_bbox=crop_bbox):
-            predictions_e = self.sess.run(
-                self.predictions, feed_dict={self.inputs: X})
-            data_predictions.append(predictions_e)
-        data_predictions = np.vstack(data_predictions)
+        start = 0
+        batches = self.prediction_iterator(X, xform=xform, crop_bbox=crop_bbox, color_vecs=color_vecs)
+        if self.pipelined:
+            batch_predictions = run_pipelined(batches, self.predict_batch, self.pipeline_depth)
+        else:
+            batch_predictions = (self.predict_batch(Xb) for Xb, _ in batches)
+        for predictions_e in batch_predictions:
+            if aggregator is None:
+                data_predictions.append(predictions_e)
+            else:
+                # the crops/transforms of an image are consecutive
+                num_variants = getattr(self.prediction_iterator, 'num_variants', None) or 1
+                predictions_e = predictions_e.reshape((-1, num_variants) + predictions_e.shape[1:])
+                aggregator.update(predictions_e, start)
+                start += len(predictions_e)
         print('took %6.1f seconds' % (time.time() - tic))
-        return data_predictions
+        if aggregator is not None:
+            return aggregator
+        return np.vstack(data_predictions)
+
+    def predict_batch(self, X):
+        """Returns the predictions of an already loaded and augmented batch"""
+        return self.sess.run(self.predictions, feed_dict={self.inputs: X})
 
 
 class QuasiPredictor(PredictSessionMixin):
@@ -100,7 +125,18 @@ class QuasiPredictor(PredictSessionMixin):
             model, cnf, weights_from, prediction_iterator)
         super(QuasiPredictor, self).__init__(weights_from)
 
-    def _real_predict(self, X):
+    def _real_predict(self, X, ensemble_type='mean', return_variance=False):
+        """Returns the aggregated predictions over the transforms
+
+        Args:
+            X: inputs
+            ensemble_type: operation to combine the transforms' predictions
+                available type: ['mean', 'gmean', 'log_mean']
+            return_variance: bool, also return the per image variance of the predictions
+
+        Returns:
+            predictions, and their variance if return_variance
+        """
         standardizer = self.prediction_iterator.standardizer
         da_params = standardizer.da_processing_params()
         util.veryify_args(da_params, [
@@ -108,13 +144,15 @@ class QuasiPredictor(PredictSessionMixin):
         color_sigma = da_params.get('sigma', 0.0)
         tfs, color_vecs = tta.build_quasirandom_transforms(self.number_of_transforms, color_sigma=color_sigma,
                                                            **self.cnf['aug_params'])
-        multiple_predictions = []
-        for i, (xform, color_vec) in enumerate(zip(tfs, color_vecs), start=1):
-            print('Quasi-random tta iteration: %d' % i)
-            standardizer.set_tta_args(color_vec=color_vec)
-            predictions = self.predictor._real_predict(X, xform=xform)
-            multiple_predictions.append(predictions)
-        return np.mean(multiple_predictions, axis=0)
+        # every image is decoded once per group of transforms, its transforms
+        # come out consecutively and are predicted in the same session runs
+        group_size = max(1, self.prediction_iterator.batch_size)
+        aggregator = PredictionAggregator(len(X), ensemble_type)
+        for start in range(0, len(tfs), group_size):
+            print('Quasi-random tta iterations: %d-%d' % (start + 1, min(start + group_size, len(tfs))))
+            self.predictor._real_predict(X, xform=list(tfs[start:start + group_size]),
+                                         color_vecs=color_vecs[start:start + group_size], aggregator=aggregator)
+        return _aggregated(aggregator, return_variance)
 
 
 class CropPredictor(PredictSessionMixin):
@@ -140,16 +178,26 @@ class CropPredictor(PredictSessionMixin):
             model, cnf, weights_from, prediction_iterator)
         super(CropPredictor, self).__init__(weights_from)
 
-    def _real_predict(self, X):
+    def _real_predict(self, X, ensemble_type='mean', return_variance=False):
+        """Returns the aggregated predictions over the crops
+
+        Args:
+            X: inputs
+            ensemble_type: operation to combine the crops' predictions
+                available type: ['mean', 'gmean', 'log_mean']
+            return_variance: bool, also return the per image variance of the predictions
+
+        Returns:
+            predictions, and their variance if return_variance
+        """
         crop_size = np.array(self.crop_size)
         im_size = np.array(self.im_size)
         bboxs = util.get_bbox_10crop(crop_size, im_size)
-        multiple_predictions = []
-        for i, bbox in enumerate(bboxs, start=1):
-            print('Crop-deterministic iteration: %d' % i)
-            predictions = self.predictor._real_predict(X, crop_bbox=bbox)
-            multiple_predictions.append(predictions)
-        return np.mean(multiple_predictions, axis=0)
+        print('Crop-deterministic predictions: %d crops' % len(bboxs))
+        # every image is decoded once, its crops come out consecutively
+        aggregator = self.predictor._real_predict(X, crop_bbox=bboxs,
+                                                  aggregator=PredictionAggregator(len(X), ensemble_type))
+        return _aggregated(aggregator, return_variance)
 
 
 class EnsemblePredictor(object):
@@ -159,12 +207,21 @@ class EnsemblePredictor(object):
 
     Args:
         predictors: predictor instances
+        prediction_iterator: an optional iterator shared by all the models; if given,
+            every batch is loaded and augmented once and the models, which must be
+            `OneCropPredictor`s, predict it concurrently in threads
     """
 
-    def __init__(self, predictors):
+    def __init__(self, predictors, prediction_iterator=None):
         self.predictors = predictors
+        self.prediction_iterator = prediction_iterator
+        self.pool = None
+        if prediction_iterator is not None:
+            for p in predictors:
+                if not hasattr(p, 'predict_batch'):
+                    raise ValueError('A shared prediction iterator needs one crop predictors, got: %s' % p)
 
-    def predict(self, X, ensemble_type='mean'):
+    def predict(self, X, ensemble_type='mean', return_variance=False):
         """
         Returns ensembled predictions for an input or batch of inputs
 
@@ -172,19 +229,201 @@ class EnsemblePredictor(object):
             X: 4D tensor, inputs
             ensemble_type: operation to combine models probabilities
                     available type: ['mean', 'gmean', 'log_mean']
+            return_variance: bool, also return the per input variance of the models' probabilities
         """
-        multiple_predictions = []
+        aggregator = PredictionAggregator(len(X), ensemble_type)
+        if self.prediction_iterator is not None:
+            self._predict_shared(X, aggregator)
+            return _aggregated(aggregator, return_variance)
         for p in self.predictors:
             print('Ensembler - running predictions using: %s' % p)
-            predictions = p.predict(X)
-            multiple_predictions.append(predictions)
-        multiple_predictions = np.array(multiple_predictions, dtype=np.float32)
-        return _ensemble(ensemble_type, multiple_predictions)
-
-
-def _ensemble(en_type, x):
-    return {
-        'mean': np.mean(x, axis=0),
-        'gmean': gmean(x, axis=0),
-        'log_mean': np.mean(np.log(x + (x == 0)), axis=0),
-    }[en_type]
+            aggregator.update(np.asarray(p.predict(X), dtype=np.float32))
+        return _aggregated(aggregator, return_variance)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stops the threads predicting a shared batch with every model"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _predict_shared(self, X, aggregator):
+        tic = time.time()
+        print('Ensembler - running predictions of %d models on a shared pipeline' % len(self.predictors))
+        if self.pool is None:
+            self.pool = ThreadPool(len(self.predictors))
+        start = 0
+        for Xb, _ in self.prediction_iterator(X):
+            # sess.run releases the GIL, the models predict the batch concurrently
+            predictions = self.pool.map(lambda p: p.predict_batch(Xb), self.predictors)
+            aggregator.update(np.stack(predictions, axis=1).astype(np.float32), start)
+            start += len(Xb)
+        print('took %6.1f seconds' % (time.time() - tic))
+
+
+def _aggregated(aggregator, return_variance):
+    if return_variance:
+        return aggregator.result(), aggregator.variance()
+    return aggregator.result()
+
+
+class PredictionAggregator(object):
+    """Running aggregation of predictions over transforms or models
+
+    Keeps O(N x C) state whatever the number of predictions aggregated per
+    sample: the running mean of the predictions, or the running sum of their
+    logs, and the running sum of squared deviations for the per sample variance.
+
+    Args:
+        num_samples: int, number of samples N
+        ensemble_type: operation to combine the predictions, the arithmetic mean, the geometric
+            mean or the mean of the logs (zeros counted as ones)
+            available type: ['mean', 'gmean', 'log_mean']
+    """
+
+    def __init__(self, num_samples, ensemble_type='mean'):
+        if ensemble_type not in ('mean', 'gmean', 'log_mean'):
+            raise ValueError('Unknown ensemble type: %s' % ensemble_type)
+        self.num_samples = num_samples
+        self.ensemble_type = ensemble_type
+        self.counts = np.zeros(num_samples, dtype=np.int64)
+        self.dtype = None
+        self._mean = None
+        self._m2 = None
+        self._log_sum = None
+
+    def update(self, predictions, start=0):
+        """Adds the predictions of a batch of samples
+
+        Args:
+            predictions: (n, C) array, one prediction per sample, or (n, T, C)
+                array, T predictions (e.g. transforms) per sample
+            start: int, index of the batch's first sample
+        """
+        predictions = np.asarray(predictions)
+        if predictions.ndim == 2:
+            predictions = predictions[:, np.newaxis]
+        n, t = predictions.shape[:2]
+        if self._mean is None:
+            shape = (self.num_samples,) + predictions.shape[2:]
+            self.dtype = np.result_type(predictions.dtype, np.float32)
+            self._mean = np.zeros(shape)
+            self._m2 = np.zeros(shape)
+            if self.ensemble_type != 'mean':
+                self._log_sum = np.zeros(shape)
+        rows = slice(start, start + n)
+        counts = self.counts[rows].reshape((n,) + (1,) * (predictions.ndim - 2))
+        new_counts = counts + t
+        # Chan et al. parallel update of the mean and the sum of squared deviations
+        batch_mean = predictions.mean(axis=1)
+        delta = batch_mean - self._mean[rows]
+        self._mean[rows] += delta * (t / new_counts)
+        self._m2[rows] += np.square(predictions - batch_mean[:, np.newaxis]).sum(axis=1) + \
+            np.square(delta) * (counts * t / new_counts)
+        if self.ensemble_type == 'gmean':
+            with np.errstate(divide='ignore'):
+                self._log_sum[rows] += np.log(predictions).sum(axis=1)
+        elif self.ensemble_type == 'log_mean':
+            self._log_sum[rows] += np.log(predictions + (predictions == 0)).sum(axis=1)
+        self.counts[rows] += t
+
+    def result(self):
+        """Aggregated predictions, shape (N, C)"""
+        self._check_counts()
+        if self.ensemble_type == 'mean':
+            result = self._mean
+        else:
+            result = self._log_sum / self._counts()
+            if self.ensemble_type == 'gmean':
+                result = np.exp(result)
+        return result.astype(self.dtype)
+
+    def variance(self):
+        """Per sample variance of the predictions, shape (N, C)"""
+        self._check_counts()
+        return (self._m2 / self._counts()).astype(self.dtype)
+
+    def _check_counts(self):
+        missing = np.flatnonzero(self.counts == 0)
+        if len(missing):
+            raise ValueError('No predictions were aggregated for %d of the %d samples, e.g. sample %d' %
+                             (len(missing), self.num_samples, missing[0]))
+
+    def _counts(self):
+        return self.counts.reshape((-1,) + (1,) * (self._mean.ndim - 1))
+
+
+def run_pipelined(batches, run, depth=2):
+    """Runs a function on every batch in a three stage pipeline
+
+    The batches are produced on one thread, `run` is called on another one and
+    the outputs are yielded to the caller, with at most `depth` items waiting
+    between two stages, so that loading, running and consuming overlap. The
+    outputs come in the order of the batches.
+
+    Args:
+        batches: iterable of (X, y) batches, e.g. a prediction iterator
+        run: callable, e.g. a predictor's `predict_batch`
+        depth: int, max number of items queued between two stages
+
+    Returns:
+        a generator of `run` outputs
+    """
+    loaded = Queue.Queue(maxsize=depth)
+    outputs = Queue.Queue(maxsize=depth)
+    end_marker = object()
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            for X, _ in batches:
+                if errors or stop.is_set():
+                    break
+                # the iterator may reuse the memory of a batch once it produces the next one
+                loaded.put(np.array(X))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            loaded.put(end_marker)
+
+    def consume():
+        try:
+            X = loaded.get()
+            while X is not end_marker:
+                if not (errors or stop.is_set()):
+                    outputs.put(run(X))
+                X = loaded.get()
+        except Exception as e:
+            errors.append(e)
+            # let the producer run down
+            while X is not end_marker:
+                X = loaded.get()
+        finally:
+            outputs.put(end_marker)
+
+    threads = [threading.Thread(target=produce), threading.Thread(target=consume)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    output = outputs.get()
+    try:
+        while output is not end_marker:
+            yield output
+            output = outputs.get()
+    finally:
+        if output is not end_marker:
+            # generator abandoned early, stop the stages and unblock them
+            stop.set()
+            while output is not end_marker:
+                output = outputs.get()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
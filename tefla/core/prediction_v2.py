@@ -1,13 +1,16 @@
 from __future__ import division, print_function, absolute_import
 
+import multiprocessing
 import time
-from scipy.stats.mstats import gmean
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import tensorflow as tf
 from ..da import tta
 from ..da import data
+from ..utils import tiling
 from ..utils import util
-from .special_layers import dense_crf
+from .prediction import PredictionAggregator, run_pipelined
+from .special_layers import dense_crf_batch
 
 
 class PredictSessionMixin(object):
@@ -29,9 +32,9 @@ class PredictSessionMixin(object):
         else:
             self.sess = tf.Session(graph=self.graph, config=tf.ConfigProto())
 
-    def predict(self, X):
+    def predict(self, X, **kwargs):
         with self.graph.as_default():
-            return self._real_predict(X)
+            return self._real_predict(X, **kwargs)
 
     def _real_predict(self, X):
         pass
@@ -47,26 +50,50 @@ class OneCropPredictor(PredictSessionMixin):
         graph: graph with weights and variables
         cnf: prediction configs
         prediction_iterator: iterator to access and augment the data for prediction
+        pipelined: bool, if True the batches are loaded on a producer thread and the
+            session runs are issued from another thread, overlapping the data loading,
+            the inference and the collection of the predictions
+        pipeline_depth: int, max number of batches waiting between two pipeline stages
         gpu_memory_fraction: fraction of gpu memory to use, if not cpu prediction
     """
 
-    def __init__(self, graph, prediction_iterator, input_tensor_name='model/inputs/input:0', predict_tensor_name='model/predictions/Softmax:0'):
+    def __init__(self, graph, prediction_iterator, input_tensor_name='model/inputs/input:0', predict_tensor_name='model/predictions/Softmax:0',
+                 pipelined=False, pipeline_depth=2):
         self.prediction_iterator = prediction_iterator
+        self.pipelined = pipelined
+        self.pipeline_depth = pipeline_depth
         self.inputs = graph.get_tensor_by_name(input_tensor_name)
         self.predictions = graph.get_tensor_by_name(predict_tensor_name)
         super(OneCropPredictor, self).__init__(graph)
 
-    def _real_predict(self, X, xform=None, crop_bbox=None):
+    def _real_predict(self, X, xform=None, crop_bbox=None, color_vecs=None, aggregator=None):
+        """Returns the predictions, or with an `aggregator` feeds it batch by batch and returns it"""
         tic = time.time()
         print('Making %d predictions' % len(X))
         data_predictions = []
-        for X, y in self.prediction_iterator(X, xform=xform, crop_bbox=crop_bbox):
-            predictions_e = self.sess.run(
-                self.predictions, feed_dict={self.inputs: X})
-            data_predictions.append(predictions_e)
-        data_predictions = np.vstack(data_predictions)
+        start = 0
+        batches = self.prediction_iterator(X, xform=xform, crop_bbox=crop_bbox, color_vecs=color_vecs)
+        if self.pipelined:
+            batch_predictions = run_pipelined(batches, self.predict_batch, self.pipeline_depth)
+        else:
+            batch_predictions = (self.predict_batch(Xb) for Xb, _ in batches)
+        for predictions_e in batch_predictions:
+            if aggregator is None:
+                data_predictions.append(predictions_e)
+            else:
+                # the crops/transforms of an image are consecutive
+                num_variants = getattr(self.prediction_iterator, 'num_variants', None) or 1
+                predictions_e = predictions_e.reshape((-1, num_variants) + predictions_e.shape[1:])
+                aggregator.update(predictions_e, start)
+                start += len(predictions_e)
         print('took %6.1f seconds' % (time.time() - tic))
-        return data_predictions
+        if aggregator is not None:
+            return aggregator
+        return np.vstack(data_predictions)
+
+    def predict_batch(self, X):
+        """Returns the predictions of an already loaded and augmented batch"""
+        return self.sess.run(self.predictions, feed_dict={self.inputs: X})
 
 
 class QuasiPredictor(PredictSessionMixin):
@@ -89,7 +116,18 @@ class QuasiPredictor(PredictSessionMixin):
             graph, prediction_iterator, input_tensor_name, predict_tensor_name)
         super(QuasiPredictor, self).__init__(graph)
 
-    def _real_predict(self, X):
+    def _real_predict(self, X, ensemble_type='mean', return_variance=False):
+        """Returns the aggregated predictions over the transforms
+
+        Args:
+            X: inputs
+            ensemble_type: operation to combine the transforms' predictions
+                available type: ['mean', 'gmean', 'log_mean']
+            return_variance: bool, also return the per image variance of the predictions
+
+        Returns:
+            predictions, and their variance if return_variance
+        """
         standardizer = self.prediction_iterator.standardizer
         da_params = standardizer.da_processing_params()
         util.veryify_args(da_params, [
@@ -97,13 +135,15 @@ class QuasiPredictor(PredictSessionMixin):
         color_sigma = da_params.get('sigma', 0.0)
         tfs, color_vecs = tta.build_quasirandom_transforms(self.number_of_transforms, color_sigma=color_sigma,
                                                            **self.cnf['aug_params'])
-        multiple_predictions = []
-        for i, (xform, color_vec) in enumerate(zip(tfs, color_vecs), start=1):
-            print('Quasi-random tta iteration: %d' % i)
-            standardizer.set_tta_args(color_vec=color_vec)
-            predictions = self.predictor._real_predict(X, xform=xform)
-            multiple_predictions.append(predictions)
-        return np.mean(multiple_predictions, axis=0)
+        # every image is decoded once per group of transforms, its transforms
+        # come out consecutively and are predicted in the same session runs
+        group_size = max(1, self.prediction_iterator.batch_size)
+        aggregator = PredictionAggregator(len(X), ensemble_type)
+        for start in range(0, len(tfs), group_size):
+            print('Quasi-random tta iterations: %d-%d' % (start + 1, min(start + group_size, len(tfs))))
+            self.predictor._real_predict(X, xform=list(tfs[start:start + group_size]),
+                                         color_vecs=color_vecs[start:start + group_size], aggregator=aggregator)
+        return _aggregated(aggregator, return_variance)
 
 
 class CropPredictor(PredictSessionMixin):
@@ -128,16 +168,26 @@ class CropPredictor(PredictSessionMixin):
         self.prediction_iterator = prediction_iterator
         super(CropPredictor, self).__init__(graph)
 
-    def _real_predict(self, X):
+    def _real_predict(self, X, ensemble_type='mean', return_variance=False):
+        """Returns the aggregated predictions over the crops
+
+        Args:
+            X: inputs
+            ensemble_type: operation to combine the crops' predictions
+                available type: ['mean', 'gmean', 'log_mean']
+            return_variance: bool, also return the per image variance of the predictions
+
+        Returns:
+            predictions, and their variance if return_variance
+        """
         crop_size = np.array(self.crop_size)
         im_size = np.array(self.im_size)
         bboxs = util.get_bbox_10crop(crop_size, im_size)
-        multiple_predictions = []
-        for i, bbox in enumerate(bboxs, start=1):
-            print('Crop-deterministic iteration: %d' % i)
-            predictions = self.predictor._real_predict(X, crop_bbox=bbox)
-            multiple_predictions.append(predictions)
-        return np.mean(multiple_predictions, axis=0)
+        print('Crop-deterministic predictions: %d crops' % len(bboxs))
+        # every image is decoded once, its crops come out consecutively
+        aggregator = self.predictor._real_predict(X, crop_bbox=bboxs,
+                                                  aggregator=PredictionAggregator(len(X), ensemble_type))
+        return _aggregated(aggregator, return_variance)
 
 
 class EnsemblePredictor(object):
@@ -147,12 +197,21 @@ class EnsemblePredictor(object):
 
     Args:
         predictors: predictor instances
+        prediction_iterator: an optional iterator shared by all the models; if given,
+            every batch is loaded and augmented once and the models, which must be
+            `OneCropPredictor`s, predict it concurrently in threads
     """
 
-    def __init__(self, predictors):
+    def __init__(self, predictors, prediction_iterator=None):
         self.predictors = predictors
+        self.prediction_iterator = prediction_iterator
+        self.pool = None
+        if prediction_iterator is not None:
+            for p in predictors:
+                if not hasattr(p, 'predict_batch'):
+                    raise ValueError('A shared prediction iterator needs one crop predictors, got: %s' % p)
 
-    def predict(self, X, ensemble_type='mean'):
+    def predict(self, X, ensemble_type='mean', return_variance=False):
         """
         Returns ensembled predictions for an input or batch of inputs
 
@@ -160,39 +219,95 @@ class EnsemblePredictor(object):
             X: 4D tensor, inputs
             ensemble_type: operation to combine models probabilities
                     available type: ['mean', 'gmean', 'log_mean']
+            return_variance: bool, also return the per input variance of the models' probabilities
         """
-        multiple_predictions = []
+        aggregator = PredictionAggregator(len(X), ensemble_type)
+        if self.prediction_iterator is not None:
+            self._predict_shared(X, aggregator)
+            return _aggregated(aggregator, return_variance)
         for p in self.predictors:
             print('Ensembler - running predictions using: %s' % p)
-            predictions = p.predict(X)
-            multiple_predictions.append(predictions)
-        multiple_predictions = np.array(multiple_predictions, dtype=np.float32)
-        return _ensemble(ensemble_type, multiple_predictions)
+            aggregator.update(np.asarray(p.predict(X), dtype=np.float32))
+        return _aggregated(aggregator, return_variance)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stops the threads predicting a shared batch with every model"""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _predict_shared(self, X, aggregator):
+        tic = time.time()
+        print('Ensembler - running predictions of %d models on a shared pipeline' % len(self.predictors))
+        if self.pool is None:
+            self.pool = ThreadPool(len(self.predictors))
+        start = 0
+        for Xb, _ in self.prediction_iterator(X):
+            # sess.run releases the GIL, the models predict the batch concurrently
+            predictions = self.pool.map(lambda p: p.predict_batch(Xb), self.predictors)
+            aggregator.update(np.stack(predictions, axis=1).astype(np.float32), start)
+            start += len(Xb)
+        print('took %6.1f seconds' % (time.time() - tic))
+
+
+def _aggregated(aggregator, return_variance):
+    if return_variance:
+        return aggregator.result(), aggregator.variance()
+    return aggregator.result()
+
+
+class TiledMixin(object):
+    """Sliding window inference over tiles of the input image
 
+    Args:
+        tile_size: int or tuple(rows, cols), if given the image is predicted tile by tile
+            and the tile logits are blended, see `tiling.predict_tiled`
+        tile_overlap: int, min number of pixels shared by two neighbouring tiles
+        tile_batch_size: int, number of tiles per session run
+        blend: string, tile logits blending, `gaussian` or `mean`
+    """
+
+    def _setup_tiling(self, tile_size, tile_overlap, tile_batch_size, blend):
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.tile_batch_size = tile_batch_size
+        self.blend = blend
 
-def _ensemble(en_type, x):
-    return {
-        'mean': np.mean(x, axis=0),
-        'gmean': gmean(x, axis=0),
-        'log_mean': np.mean(np.log(x + (x == 0)), axis=0),
-    }[en_type]
+    def _predict_tiled_logits(self, X):
+        """Returns the blended (rows, cols, n_classes) logits of a standardized (rows, cols, C) image"""
+        return tiling.predict_tiled(X, lambda tiles: self.sess.run(self.logits, {self.inputs: tiles}), self.tile_size,
+                                    self.tile_overlap, self.tile_batch_size, self.blend)
 
 
-class SegmentPredictor(PredictSessionMixin):
+class SegmentPredictor(TiledMixin, PredictSessionMixin):
     """One crop Predictor, it predict network out put from a single crop of an input image
 
     Args:
         graph: graph with weights and variables
         cnf: prediction configs
         standardizer: standardizer for the  input data for prediction
+        logits_tensor_name: name of the logits tensor, used for tiled prediction
         gpu_memory_fraction: fraction of gpu memory to use, if not cpu prediction
+        tile_size, tile_overlap, tile_batch_size, blend: tiled prediction params, see `TiledMixin`
     """
 
-    def __init__(self, graph, standardizer, preprocessor, input_tensor_name='model/inputs/input:0', predict_tensor_name='model/ArgMax:0'):
+    def __init__(self, graph, standardizer, preprocessor, input_tensor_name='model/inputs/input:0', predict_tensor_name='model/ArgMax:0',
+                 logits_tensor_name='model/final_map_logits/BiasAdd:0', tile_size=None, tile_overlap=32,
+                 tile_batch_size=8, blend='gaussian'):
         self.standardizer = standardizer
         self.preprocessor = preprocessor
         self.inputs = graph.get_tensor_by_name(input_tensor_name)
         self.predictions = graph.get_tensor_by_name(predict_tensor_name)
+        self._setup_tiling(tile_size, tile_overlap, tile_batch_size, blend)
+        if tile_size is not None:
+            self.logits = graph.get_tensor_by_name(logits_tensor_name)
         super(SegmentPredictor, self).__init__(graph)
 
     def _real_predict(self, X, xform=None, crop_bbox=None):
@@ -200,43 +315,95 @@ class SegmentPredictor(PredictSessionMixin):
         X = data.load_image(X, preprocessor=self.preprocessor)
         X = self.standardizer(X, False)
         X = X.transpose(1, 2, 0)
-        X = np.expand_dims(X, 0)
-        predictions = self.sess.run(
-            self.predictions, feed_dict={self.inputs: X})
+        if self.tile_size is not None:
+            predictions = np.argmax(self._predict_tiled_logits(X), axis=2)[np.newaxis]
+        else:
+            X = np.expand_dims(X, 0)
+            predictions = self.sess.run(
+                self.predictions, feed_dict={self.inputs: X})
         print('took %6.1f seconds' % (time.time() - tic))
         return predictions
 
 
-class SegmentPredictor_v2(PredictSessionMixin):
+class SegmentPredictor_v2(TiledMixin, PredictSessionMixin):
     """One crop Predictor, it predict network out put from a single crop of an input image
 
+    The softmax, dense CRF and argmax post-processing ops are built once; images
+    are predicted in batches, the CRF of every batch element running in a pool
+    of worker processes.
+
     Args:
         graph: graph with weights and variables
         cnf: prediction configs
         standardizer: standardizer for the  input data for prediction
+        batch_size: int, number of images per session run
+        num_classes: int, number of segmentation classes
+        num_crf_workers: int, number of dense CRF worker processes, defaults to the
+            number of cpus; 0 runs the CRF on the calling thread. The workers are
+            only started with a `batch_size` > 1, stop them with `close`
         gpu_memory_fraction: fraction of gpu memory to use, if not cpu prediction
+        tile_size, tile_overlap, tile_batch_size, blend: tiled prediction params, see `TiledMixin`;
+            with tiling the images are predicted one at a time
     """
 
-    def __init__(self, graph, standardizer, preprocessor, input_tensor_name='model/inputs/input:0', predict_tensor_name='model/final_map_logits/BiasAdd:0'):
+    def __init__(self, graph, standardizer, preprocessor, input_tensor_name='model/inputs/input:0', predict_tensor_name='model/final_map_logits/BiasAdd:0',
+                 batch_size=1, num_classes=15, num_crf_workers=None, tile_size=None, tile_overlap=32,
+                 tile_batch_size=8, blend='gaussian'):
         self.standardizer = standardizer
         self.preprocessor = preprocessor
+        self.batch_size = batch_size if tile_size is None else 1
+        self.num_classes = num_classes
+        self._setup_tiling(tile_size, tile_overlap, tile_batch_size, blend)
+        # single images never go through the pool; fork the workers before the session starts its threads
+        if self.batch_size > 1 and num_crf_workers != 0:
+            self.pool = multiprocessing.Pool(num_crf_workers)
+        else:
+            self.pool = None
         self.inputs = graph.get_tensor_by_name(input_tensor_name)
         self.predictions = graph.get_tensor_by_name(predict_tensor_name)
+        self.logits = self.predictions
+        with graph.as_default():
+            self.images = tf.placeholder(tf.uint8, shape=(None, None, None, 3), name='crf_images')
+            raw_output_up = tf.nn.softmax(self.predictions)
+            raw_output_up = tf.py_func(self._dense_crf, [raw_output_up, self.images], tf.float32)
+            self.segmentation = tf.argmax(raw_output_up, dimension=3)
         super(SegmentPredictor_v2, self).__init__(graph)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Terminates the CRF worker processes and closes the session"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.sess.close()
+
+    def _dense_crf(self, probs, imgs):
+        return dense_crf_batch(probs, imgs, self.pool, n_classes=self.num_classes)
+
     def _real_predict(self, X, xform=None, crop_bbox=None):
+        """Returns the segmentation maps, shape (N, h, w), of an image filename or a list of filenames"""
         tic = time.time()
-        img_orig = data.load_image(X, preprocessor=self.preprocessor)
-        img_orig = np.asarray(img_orig.transpose(1, 2, 0), dtype=np.uint8)
-        X = data.load_image(X, preprocessor=self.preprocessor)
-        X = self.standardizer(X, False)
-        X = X.transpose(1, 2, 0)
-        X = np.expand_dims(X, 0)
-        raw_output_up = tf.nn.softmax(self.predictions)
-        raw_output_up = tf.py_func(
-            dense_crf, [raw_output_up, tf.expand_dims(img_orig, axis=0)], tf.float32)
-        raw_output_up = tf.argmax(raw_output_up, dimension=3)
-        predictions = self.sess.run(
-            raw_output_up, {self.inputs: X})
+        fnames = [X] if isinstance(X, basestring) else X
+        predictions = []
+        for start in range(0, len(fnames), self.batch_size):
+            imgs = [data.load_image(fname, preprocessor=self.preprocessor)
+                    for fname in fnames[start:start + self.batch_size]]
+            imgs_orig = np.array([img.transpose(1, 2, 0) for img in imgs], dtype=np.uint8)
+            X = np.array([img.transpose(1, 2, 0) for img in imgs], dtype=np.float32)
+            X = data.standardize_batch(X, self.standardizer, False)
+            if self.tile_size is not None:
+                logits = self._predict_tiled_logits(X[0])
+                probs = np.exp(logits - logits.max(axis=2, keepdims=True))
+                probs /= probs.sum(axis=2, keepdims=True)
+                predictions.append(np.argmax(self._dense_crf(probs[np.newaxis], imgs_orig), axis=3))
+                continue
+            predictions.append(self.sess.run(
+                self.segmentation, {self.inputs: X, self.images: imgs_orig}))
         print('took %6.1f seconds' % (time.time() - tic))
-        return predictions
+        return np.vstack(predictions)
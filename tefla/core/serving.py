@@ -0,0 +1,305 @@
+"""Long lived local inference server with micro-batching"""
+from __future__ import division, print_function, absolute_import
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import collections
+import functools
+import httplib
+import json
+import threading
+import time
+
+import numpy as np
+
+from ..da import data
+
+
+class PredictionRequest(object):
+    """A single input waiting in a `MicroBatcher` queue
+
+    Args:
+        x: `ndarray`, one input, without the batch dimension
+    """
+
+    def __init__(self, x):
+        self.x = x
+        self.enqueued = time.time()
+        self.prediction = None
+        self.latency = None
+        self.error = None
+        self._done = threading.Event()
+
+    def result(self, timeout=None):
+        """Waits for and returns the prediction
+
+        Args:
+            timeout: float, max number of seconds to wait, forever by default
+
+        Returns:
+            the prediction and the request latency in seconds
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Prediction request timed out after %s seconds' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.prediction, self.latency
+
+    def _finish(self, prediction=None, error=None):
+        self.prediction = prediction
+        self.error = error
+        self.latency = time.time() - self.enqueued
+        self._done.set()
+
+
+class MicroBatcher(object):
+    """Groups individual prediction requests into micro-batches
+
+    A worker thread takes the oldest waiting request and keeps collecting
+    requests until `max_batch_size` are gathered or `max_wait_ms` have passed
+    since the oldest one was queued, then predicts them with a single
+    `predict_batch` call.
+
+    Args:
+        predict_batch: callable, maps a batch of inputs to a batch of predictions
+            e.g.: `prediction_v2.OneCropPredictor.predict_batch`
+        max_batch_size: int, max number of requests per batch
+        max_wait_ms: float, max time a request waits for its batch to fill up
+        latency_window: int, number of most recent requests the latency stats are computed on
+    """
+
+    def __init__(self, predict_batch, max_batch_size=32, max_wait_ms=5.0, latency_window=1000):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.queue = Queue.Queue()
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.lock = threading.Lock()
+        self.stop_marker = object()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, x):
+        """Queues one input
+
+        Returns:
+            a `PredictionRequest`
+        """
+        request = PredictionRequest(x)
+        self.queue.put(request)
+        return request
+
+    def predict(self, x, timeout=None):
+        """Predicts one input, blocking until its batch has run
+
+        Returns:
+            the prediction and the request latency in seconds
+        """
+        return self.submit(x).result(timeout)
+
+    def queue_depth(self):
+        """Number of requests waiting for a batch"""
+        return self.queue.qsize()
+
+    def stats(self):
+        """Queue depth, request and batch counts and latency percentiles in ms"""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.0
+            stats = {'queue_depth': self.queue_depth(), 'requests': self.num_requests, 'batches': self.num_batches,
+                     'mean_batch_size': self.num_requests / max(self.num_batches, 1)}
+        if len(latencies):
+            stats['latency_ms'] = {'mean': float(latencies.mean()), 'p50': float(np.percentile(latencies, 50)),
+                                   'p99': float(np.percentile(latencies, 99)), 'max': float(latencies.max())}
+        return stats
+
+    def close(self):
+        """Stops the worker thread once the queued requests are done"""
+        self.queue.put(self.stop_marker)
+        self.thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            request = self.queue.get()
+            if request is self.stop_marker:
+                break
+            batch = [request]
+            deadline = request.enqueued + self.max_wait_ms / 1000.0
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        request = self.queue.get(timeout=timeout)
+                    else:
+                        request = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if request is self.stop_marker:
+                    stopping = True
+                    break
+                batch.append(request)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        try:
+            predictions = self.predict_batch(np.stack([request.x for request in batch]))
+        except Exception as e:
+            for request in batch:
+                request._finish(error=e)
+            return
+        for request, prediction in zip(batch, predictions):
+            request._finish(prediction=prediction)
+        with self.lock:
+            self.num_requests += len(batch)
+            self.num_batches += 1
+            self.latencies.extend(request.latency for request in batch)
+
+
+def create_image_loader(preprocessor, crop_size, standardizer=None):
+    """Loader of a single image file as a network input, as the prediction iterators load it
+
+    Args:
+        preprocessor: real-time image processing/crop, or None
+        crop_size: tuple, (w, h) network input size
+        standardizer: image standardizer
+
+    Returns:
+        a callable mapping an image filename to a (w, h, C) input
+    """
+    return functools.partial(data.load_augment, preprocessor=preprocessor or data.image_no_preprocessing,
+                             w=crop_size[0], h=crop_size[1], is_training=False, standardizer=standardizer)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _PredictionRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/stats':
+            return self._reply(404, {'error': 'unknown path %s' % self.path})
+        self._reply(200, self.server.inference_server.batcher.stats())
+
+    def do_POST(self):
+        if self.path != '/predict':
+            return self._reply(404, {'error': 'unknown path %s' % self.path})
+        inference_server = self.server.inference_server
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            # decoding happens on the request threads, concurrently
+            x = inference_server.load_input(body['image'])
+        except Exception as e:
+            return self._reply(400, {'error': str(e)})
+        try:
+            prediction, latency = inference_server.batcher.predict(x, inference_server.request_timeout)
+        except Exception as e:
+            return self._reply(500, {'error': str(e)})
+        self._reply(200, {'predictions': np.asarray(prediction).tolist(), 'latency_ms': latency * 1000.0,
+                          'queue_depth': inference_server.batcher.queue_depth()})
+
+    def _reply(self, code, body):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InferenceServer(object):
+    """Local HTTP inference server holding a prediction session
+
+    `POST /predict` with a json body `{"image": <image filename>}` replies with
+    `{"predictions": [...], "latency_ms": ..., "queue_depth": ...}`; the requests
+    are predicted in micro-batches by a `MicroBatcher`. `GET /stats` replies with
+    the batcher stats.
+
+    Args:
+        predictor: a predictor with a `predict_batch` method,
+            e.g.: `prediction_v2.OneCropPredictor`
+        load_input: callable, maps an image filename to a network input,
+            e.g.: from `create_image_loader`
+        host: string, interface to listen on
+        port: int, port to listen on, 0 picks a free port
+        max_batch_size: int, max number of requests per batch
+        max_wait_ms: float, max time a request waits for its batch to fill up
+        request_timeout: float, max number of seconds a request waits for its prediction
+    """
+
+    def __init__(self, predictor, load_input, host='127.0.0.1', port=0, max_batch_size=32, max_wait_ms=5.0,
+                 request_timeout=60.0):
+        self.load_input = load_input
+        self.request_timeout = request_timeout
+        self.batcher = MicroBatcher(predictor.predict_batch, max_batch_size, max_wait_ms)
+        self.httpd = _ThreadingHTTPServer((host, port), _PredictionRequestHandler)
+        self.httpd.inference_server = self
+        self.thread = None
+
+    @property
+    def address(self):
+        """(host, port) the server listens on"""
+        return self.httpd.server_address[:2]
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        """Serves on a background thread"""
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.batcher.close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class InferenceClient(object):
+    """Client of a local `InferenceServer`
+
+    Args:
+        host: string, server host
+        port: int, server port
+        timeout: float, socket timeout in seconds
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080, timeout=60.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def predict(self, image):
+        """Predicts one image file
+
+        Returns:
+            the prediction `ndarray` and the server side latency in ms
+        """
+        reply = self._request('POST', '/predict', json.dumps({'image': image}))
+        return np.array(reply['predictions']), reply['latency_ms']
+
+    def stats(self):
+        return self._request('GET', '/stats')
+
+    def _request(self, method, path, body=None):
+        connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            connection.request(method, path, body, {'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            reply = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError('Inference server error %d: %s' % (response.status, reply.get('error')))
+        return reply
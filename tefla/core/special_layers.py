@@ -461,6 +461,31 @@ def dense_crf(probs, img=None, n_classes=15, n_iters=10,
     return preds
 
 
+def dense_crf_batch(probs, imgs=None, pool=None, **kwargs):
+    """DenseCRF over a batch of predictions, one batch element at a time.
+
+    Args:
+        probs: class probabilities per pixel, shape (N, h, w, n_classes).
+        imgs: if given, (N, h, w, 3) uint8 raw RGB images for the pairwise bilateral potential.
+        pool: an optional `multiprocessing.Pool`, to process the batch elements in parallel.
+        kwargs: `dense_crf` arguments.
+
+    Returns:
+        Refined predictions after MAP inference, shape (N, h, w, n_classes).
+    """
+    args = [(probs[i:i + 1], imgs[i:i + 1] if imgs is not None else None, kwargs) for i in range(len(probs))]
+    if pool is not None and len(args) > 1:
+        preds = pool.map(_dense_crf_element, args)
+    else:
+        preds = [_dense_crf_element(element_args) for element_args in args]
+    return np.concatenate(preds, axis=0)
+
+
+def _dense_crf_element(args):
+    probs, img, kwargs = args
+    return dense_crf(probs, img, **kwargs)
+
+
 class GradientReverseLayer(object):
 
     def __init__(self):
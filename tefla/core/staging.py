@@ -0,0 +1,132 @@
+"""Training inputs staged in the graph by a background feeder thread"""
+from __future__ import division, print_function, absolute_import
+
+import Queue
+import contextlib
+import threading
+
+import tensorflow as tf
+
+
+class StagedInputs(object):
+    """Double buffered training inputs
+
+    A feeder thread enqueues the next batches into a bounded in-graph FIFO queue
+    while the current training step runs; the training step consumes `outputs`,
+    which dequeue one batch per session run, so that it needs no feed_dict for
+    its inputs. Every session run fetching an op that depends on `outputs`
+    consumes a batch.
+
+    Args:
+        tensors: list of the input tensors (placeholders) to stage, their dtypes and
+            shapes are used for the staging queue
+        capacity: int, number of batches buffered in the graph
+        name: string, name scope of the staging ops
+    """
+
+    def __init__(self, tensors, capacity=2, name='staged_inputs'):
+        with tf.name_scope(name):
+            self.placeholders = [tf.placeholder(t.dtype.base_dtype, shape=t.get_shape()) for t in tensors]
+            self.queue = tf.FIFOQueue(capacity, [p.dtype for p in self.placeholders])
+            self.enqueue_op = self.queue.enqueue(self.placeholders)
+            self.close_op = self.queue.close(cancel_pending_enqueues=True)
+            self.size_op = self.queue.size()
+            outputs = self.queue.dequeue()
+        if not isinstance(outputs, (list, tuple)):
+            outputs = [outputs]
+        for output, placeholder in zip(outputs, self.placeholders):
+            output.set_shape(placeholder.get_shape())
+        self.outputs = list(outputs)
+        self.capacity = capacity
+        self.closed = False
+
+    def reroute(self, tensors, can_modify=None):
+        """Makes the consumers of `tensors` consume the staged outputs instead
+
+        For models which create their own input placeholders, e.g.: the models
+        of `SupervisedTrainer`.
+
+        Args:
+            tensors: list of tensors, one per staged output
+            can_modify: list of ops allowed to be rerouted, all the consumers by default
+        """
+        from tensorflow.contrib import graph_editor as ge
+        ge.reroute_ts(self.outputs, tensors, can_modify=can_modify)
+
+    def epoch(self, sess, batches, transform=None):
+        """Stages the batches of an epoch on a feeder thread
+
+        Args:
+            sess: training session
+            batches: iterable of batches, e.g.: a `training_iterator` call
+            transform: callable, maps a batch to the list of values of the staged tensors,
+                defaults to the batch itself
+
+        Yields:
+            the batches in order, each one once it is enqueued, so that the next
+            training step dequeues it without blocking. If the epoch is abandoned
+            early, the feeder is stopped and the batches left in the staging queue
+            are discarded, so that the next epoch starts from an empty queue.
+        """
+        # holds at most the batches in the staging queue, the feeder never blocks on it
+        staged = Queue.Queue()
+        end_marker = object()
+        stop = threading.Event()
+
+        def feed():
+            try:
+                for batch in batches:
+                    if stop.is_set():
+                        break
+                    values = transform(*batch) if transform is not None else batch
+                    sess.run(self.enqueue_op, feed_dict=dict(zip(self.placeholders, values)))
+                    staged.put(batch)
+                staged.put(end_marker)
+            except Exception as e:
+                staged.put(e)
+
+        thread = threading.Thread(target=feed)
+        thread.daemon = True
+        thread.start()
+        finished = False
+        try:
+            while True:
+                batch = staged.get()
+                if batch is end_marker:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+            finished = True
+        finally:
+            if not finished:
+                stop.set()
+                while thread.is_alive() and not self.closed:
+                    # the feeder may wait for room in a full staging queue
+                    self._discard(sess)
+                    thread.join(0.01)
+                thread.join()
+                if not self.closed:
+                    self._discard(sess)
+        thread.join()
+
+    def close(self, sess):
+        """Closes the staging queue, cancelling pending enqueues"""
+        if not self.closed:
+            sess.run(self.close_op)
+            self.closed = True
+
+    def _discard(self, sess):
+        """Dequeues the batches waiting in the staging queue"""
+        for _ in range(sess.run(self.size_op)):
+            sess.run(self.outputs)
+
+
+@contextlib.contextmanager
+def closing_staged_inputs(staged_inputs, sess):
+    """Closes the staging queue of `staged_inputs` on exit, errors included; no-op if it is None"""
+    try:
+        yield staged_inputs
+    finally:
+        if staged_inputs is not None:
+            staged_inputs.close(sess)
@@ -11,6 +11,10 @@ import tensorflow as tf
 from ..da.iterator import BatchIterator
 from .lr_policy import NoDecayPolicy
 from .losses import kappa_log_loss_clipped
+from .metrics import as_accumulator
+from .checkpoint import CheckpointManager
+from .staging import StagedInputs, closing_staged_inputs
+from .validation_schedule import ValidationSchedule
 from . import summary
 
 logger = logging.getLogger('tefla')
@@ -53,6 +57,9 @@ class SupervisedTrainer(object):
         self.lr_policy.base_lr = resume_lr
         self.lr_policy.n_iters_per_epoch = n_iters_per_epoch
         self.validation_metrics_def = self.cnf.get('validation_scores', [])
+        self.validation_schedule = self.cnf.get('validation_schedule', ValidationSchedule())
+        self.validation_accumulators = [as_accumulator(metric_function)
+                                        for _, metric_function in self.validation_metrics_def]
         self.clip_norm = clip_norm
         self.gpu_memory_fraction = gpu_memory_fraction
         self.is_summary = is_summary
@@ -78,6 +85,7 @@ class SupervisedTrainer(object):
         if self.is_summary:
             self._setup_summaries()
         self._setup_misc()
+        self._setup_staging()
         self._print_info(data_set, verbose)
         self._train_loop(data_set, weights_from, start_epoch, summary_every,
                          verbose)
@@ -90,6 +98,27 @@ class SupervisedTrainer(object):
             # if update_ops is not None:
             #     regularized_training_loss = control_flow_ops.with_dependencies(update_ops, regularized_training_loss)
 
+    def _setup_staging(self):
+        """Stages the training inputs and targets in the graph if cnf['staged_inputs'] is set
+
+        The model creates its own input placeholder, so the training ops are
+        rerouted to the staged tensors; the validation ops keep the placeholders.
+        """
+        self.staged_inputs = None
+        self.training_step = self.optimizer_step
+        if not self.cnf.get('staged_inputs', False):
+            return
+        from tensorflow.contrib import graph_editor as ge
+        self.staged_inputs = StagedInputs(
+            [self.inputs, self.target], capacity=self.cnf.get('staging_capacity', 2))
+        validation_ops = set(ge.get_backward_walk_ops([self.validation_loss]))
+        training_consumers = [op for tensor in (self.inputs, self.target) for op in tensor.consumers()
+                              if op not in validation_ops]
+        self.staged_inputs.reroute([self.inputs, self.target], can_modify=training_consumers)
+        if self.update_ops is not None:
+            # the update ops consume the staged batch, they run in the same step
+            self.training_step = tf.group(self.optimizer_step, *self.update_ops)
+
     def _print_info(self, data_set, verbose):
         logger.info('Config:')
         logger.info(pprint.pformat(self.cnf))
@@ -131,6 +160,11 @@ class SupervisedTrainer(object):
         weights_dir = "weights"
         if not os.path.exists(weights_dir):
             os.mkdir(weights_dir)
+        checkpoints = CheckpointManager(
+            weights_dir=weights_dir, keep_best=self.cnf.get('keep_best_checkpoints'),
+            keep_last=self.cnf.get('keep_last_checkpoints'),
+            metric=self.cnf.get('checkpoint_metric', 'validation_loss'),
+            mode=self.cnf.get('checkpoint_metric_mode', 'min'))
         if self.is_summary:
             training_batch_summary_op = tf.summary.merge_all(
                 key=TRAINING_BATCH_SUMMARIES)
@@ -143,7 +177,8 @@ class SupervisedTrainer(object):
 
         gpu_options = tf.GPUOptions(
             per_process_gpu_memory_fraction=self.gpu_memory_fraction)
-        with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess:
+        with tf.Session(config=tf.ConfigProto(gpu_options=gpu_options)) as sess, checkpoints, \
+                closing_staged_inputs(self.staged_inputs, sess):
             if start_epoch > 1:
                 weights_from = "weights/model-epoch-%d.ckpt" % (start_epoch - 1)
 
@@ -170,9 +205,14 @@ class SupervisedTrainer(object):
                 training_losses = []
                 batch_train_sizes = []
 
-                for batch_num, (Xb, yb) in enumerate(self.training_iterator(training_X, training_y)):
-                    feed_dict_train = {self.inputs: Xb, self.target: self._adjust_ground_truth(yb),
-                                       self.learning_rate: learning_rate_value}
+                training_batches = self.training_iterator(training_X, training_y)
+                if self.staged_inputs is not None:
+                    training_batches = self.staged_inputs.epoch(
+                        sess, training_batches, lambda Xb, yb: (Xb, self._adjust_ground_truth(yb)))
+                for batch_num, (Xb, yb) in enumerate(training_batches):
+                    feed_dict_train = {self.learning_rate: learning_rate_value}
+                    if self.staged_inputs is None:
+                        feed_dict_train.update({self.inputs: Xb, self.target: self._adjust_ground_truth(yb)})
 
                     logger.debug('1. Loading batch %d data done.' % batch_num)
                     if epoch % summary_every == 0 and self.is_summary:
@@ -180,7 +220,7 @@ class SupervisedTrainer(object):
                             '2. Running training steps with summary...')
                         training_predictions_e, training_loss_e, summary_str_train, _ = sess.run(
                             [self.training_predictions, self.regularized_training_loss, training_batch_summary_op,
-                             self.optimizer_step],
+                             self.training_step],
                             feed_dict=feed_dict_train)
                         train_writer.add_summary(summary_str_train, epoch)
                         train_writer.flush()
@@ -194,7 +234,7 @@ class SupervisedTrainer(object):
                     else:
                         logger.debug(
                             '2. Running training steps without summary...')
-                        training_loss_e, _ = sess.run([self.regularized_training_loss, self.optimizer_step],
+                        training_loss_e, _ = sess.run([self.regularized_training_loss, self.training_step],
                                                       feed_dict=feed_dict_train)
                         logger.debug(
                             '2. Running training steps without summary done.')
@@ -202,7 +242,7 @@ class SupervisedTrainer(object):
                     training_losses.append(training_loss_e)
                     batch_train_sizes.append(len(Xb))
 
-                    if self.update_ops is not None:
+                    if self.update_ops is not None and self.staged_inputs is None:
                         logger.debug('3. Running update ops...')
                         sess.run(self.update_ops, feed_dict=feed_dict_train)
                         logger.debug('3. Running update ops done.')
@@ -225,92 +265,103 @@ class SupervisedTrainer(object):
                 logger.debug('5. Writing epoch summary done.')
 
                 # Validation prediction and metrics
-                validation_losses = []
-                batch_validation_metrics = [[]
-                                            for _, _ in self.validation_metrics_def]
-                epoch_validation_metrics = []
-                batch_validation_sizes = []
-                for batch_num, (validation_Xb, validation_yb) in enumerate(
-                        self.validation_iterator(validation_X, validation_y)):
-                    feed_dict_validation = {self.validation_inputs: validation_Xb,
-                                            self.target: self._adjust_ground_truth(validation_yb)}
-                    logger.debug(
-                        '6. Loading batch %d validation data done.' % batch_num)
-
-                    if (epoch - 1) % summary_every == 0 and self.is_summary:
-                        logger.debug(
-                            '7. Running validation steps with summary...')
-                        validation_predictions_e, validation_loss_e, summary_str_validate = sess.run(
-                            [self.validation_predictions, self.validation_loss,
-                                validation_batch_summary_op],
-                            feed_dict=feed_dict_validation)
-                        validation_writer.add_summary(
-                            summary_str_validate, epoch)
-                        validation_writer.flush()
-                        logger.debug(
-                            '7. Running validation steps with summary done.')
-                        if verbose > 3:
-                            logger.debug(
-                                "Epoch %d, Batch %d validation loss: %s" % (epoch, batch_num, validation_loss_e))
-                            logger.debug("Epoch %d, Batch %d validation predictions: %s" % (
-                                epoch, batch_num, validation_predictions_e))
-                    else:
+                training_time = time.time() - tic
+                validated = self.validation_schedule.should_validate(epoch, self.num_epochs)
+                if validated:
+                    epoch_validation_X, epoch_validation_y = self.validation_schedule.validation_set(
+                        validation_X, validation_y, epoch, self.num_epochs)
+                    validation_losses = []
+                    for accumulator in self.validation_accumulators:
+                        accumulator.reset()
+                    batch_validation_sizes = []
+                    for batch_num, (validation_Xb, validation_yb) in enumerate(
+                            self.validation_iterator(epoch_validation_X, epoch_validation_y)):
+                        feed_dict_validation = {self.validation_inputs: validation_Xb,
+                                                self.target: self._adjust_ground_truth(validation_yb)}
                         logger.debug(
-                            '7. Running validation steps without summary...')
-                        validation_predictions_e, validation_loss_e = sess.run(
-                            [self.validation_predictions, self.validation_loss],
-                            feed_dict=feed_dict_validation)
-                        logger.debug(
-                            '7. Running validation steps without summary done.')
-                    validation_losses.append(validation_loss_e)
-                    batch_validation_sizes.append(len(validation_Xb))
-
-                    for i, (_, metric_function) in enumerate(self.validation_metrics_def):
-                        metric_score = metric_function(
-                            validation_yb, validation_predictions_e)
-                        batch_validation_metrics[i].append(metric_score)
-                    logger.debug('8. Validation batch %d done' % batch_num)
-
-                epoch_validation_loss = np.average(
-                    validation_losses, weights=batch_validation_sizes)
-                for i, (_, _) in enumerate(self.validation_metrics_def):
-                    epoch_validation_metrics.append(
-                        np.average(batch_validation_metrics[i], weights=batch_validation_sizes))
-
-                # Write validation epoch summary every epoch
-                logger.debug('9. Writing epoch validation summary...')
-                if self.is_summary:
-                    summary_str_validate = sess.run(validation_epoch_summary_op, feed_dict={
-                                                    self.epoch_loss: epoch_validation_loss, self.validation_metric_placeholders: epoch_validation_metrics})
-                    validation_writer.add_summary(summary_str_validate, epoch)
-                    validation_writer.flush()
-                logger.debug('9. Writing epoch validation summary done.')
-
-                custom_metrics_string = [', %s: %.3f' % (name, epoch_validation_metrics[i]) for i, (name, _) in
-                                         enumerate(self.validation_metrics_def)]
-                custom_metrics_string = ''.join(custom_metrics_string)
-
-                logger.info(
-                    "Epoch %d [(%s, %s) images, %6.1fs]: t-loss: %.3f, v-loss: %.3f%s" %
-                    (epoch, np.sum(batch_train_sizes), np.sum(batch_validation_sizes), time.time() - tic,
-                     epoch_training_loss,
-                     epoch_validation_loss,
-                     custom_metrics_string)
-                )
+                            '6. Loading batch %d validation data done.' % batch_num)
 
-                saver.save(sess, "%s/model-epoch-%d.ckpt" %
-                           (weights_dir, epoch))
+                        if (epoch - 1) % summary_every == 0 and self.is_summary:
+                            logger.debug(
+                                '7. Running validation steps with summary...')
+                            validation_predictions_e, validation_loss_e, summary_str_validate = sess.run(
+                                [self.validation_predictions, self.validation_loss,
+                                    validation_batch_summary_op],
+                                feed_dict=feed_dict_validation)
+                            validation_writer.add_summary(
+                                summary_str_validate, epoch)
+                            validation_writer.flush()
+                            logger.debug(
+                                '7. Running validation steps with summary done.')
+                            if verbose > 3:
+                                logger.debug(
+                                    "Epoch %d, Batch %d validation loss: %s" % (epoch, batch_num, validation_loss_e))
+                                logger.debug("Epoch %d, Batch %d validation predictions: %s" % (
+                                    epoch, batch_num, validation_predictions_e))
+                        else:
+                            logger.debug(
+                                '7. Running validation steps without summary...')
+                            validation_predictions_e, validation_loss_e = sess.run(
+                                [self.validation_predictions, self.validation_loss],
+                                feed_dict=feed_dict_validation)
+                            logger.debug(
+                                '7. Running validation steps without summary done.')
+                        validation_losses.append(validation_loss_e)
+                        batch_validation_sizes.append(len(validation_Xb))
+
+                        for accumulator in self.validation_accumulators:
+                            accumulator.update(validation_predictions_e, validation_yb)
+                        logger.debug('8. Validation batch %d done' % batch_num)
+
+                    epoch_validation_loss = np.average(
+                        validation_losses, weights=batch_validation_sizes)
+                    epoch_validation_metrics = [accumulator.compute()
+                                                for accumulator in self.validation_accumulators]
+
+                    # Write validation epoch summary every epoch
+                    logger.debug('9. Writing epoch validation summary...')
+                    if self.is_summary:
+                        summary_str_validate = sess.run(validation_epoch_summary_op, feed_dict={
+                                                        self.epoch_loss: epoch_validation_loss, self.validation_metric_placeholders: epoch_validation_metrics})
+                        validation_writer.add_summary(summary_str_validate, epoch)
+                        validation_writer.flush()
+                    logger.debug('9. Writing epoch validation summary done.')
+
+                    custom_metrics_string = [', %s: %.3f' % (name, epoch_validation_metrics[i]) for i, (name, _) in
+                                             enumerate(self.validation_metrics_def)]
+                    custom_metrics_string = ''.join(custom_metrics_string)
+
+                    logger.info(
+                        "Epoch %d [(%s, %s) images, %6.1fs]: t-loss: %.3f, v-loss: %.3f%s" %
+                        (epoch, np.sum(batch_train_sizes), np.sum(batch_validation_sizes), time.time() - tic,
+                         epoch_training_loss,
+                         epoch_validation_loss,
+                         custom_metrics_string)
+                    )
+                else:
+                    logger.info(
+                        "Epoch %d [%s images, %6.1fs]: t-loss: %.3f, validation skipped" %
+                        (epoch, np.sum(batch_train_sizes), time.time() - tic, epoch_training_loss))
+                self.validation_schedule.record(training_time, time.time() - tic - training_time)
 
                 epoch_info = dict(
                     epoch=epoch,
-                    training_loss=epoch_training_loss,
-                    validation_loss=epoch_validation_loss
+                    training_loss=epoch_training_loss
                 )
+                if validated:
+                    epoch_info.update(
+                        validation_loss=epoch_validation_loss,
+                        validation_subset=not self.validation_schedule.is_full(epoch, self.num_epochs),
+                        validation_metrics=dict(zip([name for name, _ in self.validation_metrics_def],
+                                                    epoch_validation_metrics)))
 
                 training_history.append(epoch_info)
+                checkpoints.save(sess, epoch, CheckpointManager.epoch_metrics(epoch_info))
 
-                learning_rate_value = self.lr_policy.epoch_update(
-                    learning_rate_value, training_history)
+                lr_history = self.validation_schedule.lr_policy_history(self.lr_policy, training_history)
+                if lr_history is not None:
+                    learning_rate_value = self.lr_policy.epoch_update(
+                        learning_rate_value, lr_history)
                 if verbose > 0:
                     logger.info("Learning rate: %f " % learning_rate_value)
                 logger.debug('10. Epoch done. [%d]' % epoch)
@@ -0,0 +1,141 @@
+"""Validation schedules of the training loops"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+
+class ValidationSchedule(object):
+    """Decides which epochs are validated and on which samples
+
+    The default schedule runs a full validation pass after every epoch; the
+    last epoch is always fully validated.
+
+    Args:
+        every: int, validate every `every` epochs
+        subset_size: int or float, if given the epochs are validated on a fixed stratified
+            subset of `subset_size` samples, or of this fraction of the samples if float
+        full_every: int, with a subset, run a full validation pass every `full_every` epochs
+        time_budget: float, max fraction of the training wall time spent on validation,
+            an epoch is not validated while the validation time so far exceeds it
+        seed: int, seed of the subset sampling
+    """
+
+    def __init__(self, every=1, subset_size=None, full_every=None, time_budget=None, seed=0):
+        self.every = every
+        self.subset_size = subset_size
+        self.full_every = full_every
+        self.time_budget = time_budget
+        self.seed = seed
+        self.training_time = 0.0
+        self.validation_time = 0.0
+        self._subset = None
+
+    def __str__(self):
+        return 'ValidationSchedule(every=%s, subset_size=%s, full_every=%s, time_budget=%s)' % (
+            self.every, self.subset_size, self.full_every, self.time_budget)
+
+    def __repr__(self):
+        return str(self)
+
+    def is_default(self):
+        """Whether the schedule is a full validation pass after every epoch"""
+        return self.every == 1 and self.subset_size is None and self.time_budget is None
+
+    def should_validate(self, epoch, num_epochs):
+        """Whether the epoch is validated"""
+        if epoch == num_epochs:
+            return True
+        if epoch % self.every:
+            return False
+        if self.time_budget is not None:
+            return self.validation_time <= self.time_budget * (self.training_time + self.validation_time)
+        return True
+
+    def is_full(self, epoch, num_epochs):
+        """Whether the epoch validation runs on the whole validation set"""
+        return (self.subset_size is None or epoch == num_epochs or
+                (self.full_every is not None and epoch % self.full_every == 0))
+
+    def validation_set(self, X, y, epoch, num_epochs):
+        """Returns the validation samples of the epoch
+
+        Args:
+            X: validation inputs, an array or a list of filenames
+            y: validation labels
+            epoch: int, current epoch
+            num_epochs: int, last epoch
+
+        Returns:
+            a tuple of X, y or of their subset
+        """
+        if self.is_full(epoch, num_epochs):
+            return X, y
+        if self._subset is None or self._subset[0] is not y:
+            size = self.subset_size
+            if isinstance(size, float):
+                size = int(round(size * len(y)))
+            self._subset = (y, stratified_indices(y, size, np.random.RandomState(self.seed)))
+        indices = self._subset[1]
+        X = X[indices] if hasattr(X, 'shape') else [X[i] for i in indices]
+        return X, y[indices]
+
+    def record(self, training_time, validation_time):
+        """Adds an epoch training and validation wall time, in seconds"""
+        self.training_time += training_time
+        self.validation_time += validation_time
+
+    def validation_history(self, training_history):
+        """Validated epochs of the history comparable with the last validated one
+
+        Subset and full validation metrics are not mixed.
+        """
+        validated = [epoch_info for epoch_info in training_history if 'validation_loss' in epoch_info]
+        if not validated:
+            return validated
+        subset = validated[-1].get('validation_subset', False)
+        return [epoch_info for epoch_info in validated if epoch_info.get('validation_subset', False) == subset]
+
+    def lr_policy_history(self, lr_policy, training_history):
+        """History for the lr policy epoch update, None if it must not be updated
+
+        Policies driven by the validation loss, e.g. `AdaptiveDecayPolicy`, only
+        see the validated epochs and are only updated after a validation.
+        """
+        if not getattr(lr_policy, 'uses_validation', False):
+            return training_history
+        if 'validation_loss' not in training_history[-1]:
+            return None
+        return self.validation_history(training_history)
+
+
+def stratified_indices(y, size, rng=np.random):
+    """Sorted indices of a stratified sample of the labels
+
+    Every class keeps its share of the samples, and at least one sample.
+    Non integer labels, e.g. regression targets, are sampled uniformly.
+
+    Args:
+        y: labels, or one hot/probability vectors
+        size: int, sample size
+        rng: random number generator
+
+    Returns:
+        an `ndarray` of indices
+    """
+    y = np.asarray(y)
+    if y.ndim > 1 and y.shape[1] > 1:
+        y = np.argmax(y, axis=1)
+    y = y.ravel()
+    if size >= len(y):
+        return np.arange(len(y))
+    if not np.issubdtype(y.dtype, np.integer):
+        return np.sort(rng.choice(len(y), size, replace=False))
+    classes, inverse = np.unique(y, return_inverse=True)
+    counts = np.bincount(inverse)
+    quotas = size * counts / float(len(y))
+    take = np.floor(quotas).astype(int)
+    # largest remainders first
+    take[np.argsort(take - quotas)[:size - take.sum()]] += 1
+    take = np.minimum(np.maximum(take, 1), counts)
+    indices = [rng.choice(np.flatnonzero(inverse == i), n, replace=False) for i, n in enumerate(take)]
+    return np.sort(np.concatenate(indices))
@@ -10,6 +10,12 @@ Enhanced by Mrinal Haloi
 """
 from __future__ import division, print_function
 
+import collections
+import hashlib
+import threading
+import weakref
+from uuid import uuid4
+
 from PIL import Image
 from PIL import ImageEnhance
 
@@ -37,7 +43,8 @@ def fast_warp(img, tf, output_shape, mode='constant', mode_cval=0, order=0):
     Args:
         img: `ndarray`, input image
         tf: For 2-D images, you can directly pass a transformation object
-            e.g. skimage.transform.SimilarityTransform, or its inverse.
+            e.g. skimage.transform.SimilarityTransform, or its inverse,
+            or a (3, 3) transformation matrix.
         output_shape: tuple, (rows, cols)
         mode: mode for transformation
             available modes: {`constant`, `edge`, `symmetric`, `reflect`, `wrap`}
@@ -53,7 +60,7 @@ def fast_warp(img, tf, output_shape, mode='constant', mode_cval=0, order=0):
     Returns:
         warped, double `ndarray`
     """
-    m = tf.params
+    m = getattr(tf, 'params', tf)
     t_img = np.zeros((img.shape[0],) + output_shape, img.dtype)
     for i in range(t_img.shape[0]):
         t_img[i] = _warp_fast(img[i], m, output_shape=output_shape,
@@ -61,6 +68,138 @@ def fast_warp(img, tf, output_shape, mode='constant', mode_cval=0, order=0):
     return t_img
 
 
+_output_grids = {}
+
+
+def _output_grid(output_shape):
+    """Homogeneous (x, y, 1) coordinates of every output pixel, cached per shape"""
+    grid = _output_grids.get(output_shape)
+    if grid is None:
+        rows, cols = output_shape
+        yy, xx = np.mgrid[0:rows, 0:cols]
+        grid = np.vstack([xx.ravel(), yy.ravel(), np.ones(rows * cols)]).astype(np.float64)
+        _output_grids[output_shape] = grid
+    return grid
+
+
+def _map_coords(coords, dim, mode):
+    """Map integer pixel coordinates into [0, dim) according to the fill mode
+
+    The mapping mirrors skimage's `coord_map` so that `fast_warp_batch`
+    produces the same output as `fast_warp`. For `constant` mode the
+    coordinates are clipped; out of bounds pixels are masked by the caller.
+    """
+    cmax = dim - 1
+    if mode == 'wrap':
+        return np.mod(coords, dim)
+    elif mode == 'symmetric':
+        coords = np.mod(coords, 2 * dim)
+        return np.where(coords > cmax, 2 * dim - 1 - coords, coords)
+    elif mode == 'reflect':
+        if dim == 1:
+            return np.zeros_like(coords)
+        coords = np.mod(coords, 2 * cmax)
+        return np.where(coords > cmax, 2 * cmax - coords, coords)
+    else:
+        return np.clip(coords, 0, cmax)
+
+
+def _gather_pixels(pixels, rows, cols, r, c, mode, mode_cval):
+    """Gather pixels at integer coordinates (r, c) of shape (N, P)
+
+    Args:
+        pixels: (N * rows * cols, C) `ndarray` of channels last images, or
+            (rows * cols, C) for a single image shared by all N outputs
+        rows: int, number of rows of each image
+        cols: int, number of cols of each image
+        r: (N, P) `ndarray` of row coordinates
+        c: (N, P) `ndarray` of column coordinates
+
+    Returns:
+        (N, P, C) `ndarray` of gathered pixels
+    """
+    n, channels = r.shape[0], pixels.shape[1]
+    idx = _map_coords(r, rows, mode) * cols + _map_coords(c, cols, mode)
+    if pixels.shape[0] > rows * cols:
+        idx += (np.arange(n) * (rows * cols))[:, np.newaxis]
+    # view every pixel as one opaque item so that all channels move in a single take
+    pixel_items = pixels.view(np.dtype((np.void, channels * pixels.itemsize))).ravel()
+    gathered = np.take(pixel_items, idx).view(pixels.dtype).reshape(r.shape + (channels,))
+    if mode == 'constant':
+        outside = (r < 0) | (r >= rows) | (c < 0) | (c >= cols)
+        np.copyto(gathered, np.asarray(mode_cval, dtype=gathered.dtype), where=outside[:, :, np.newaxis])
+    return gathered
+
+
+def fast_warp_batch(imgs, tfs, output_shape, mode='constant', mode_cval=0, order=0):
+    """Warp a batch of images according to per image coordinate transformations.
+
+        Vectorized counterpart of `fast_warp`; all images and channels are
+        warped with a handful of NumPy calls instead of one `_warp_fast` call
+        per channel per image.
+
+    Args:
+        imgs: `ndarray`, input images, shape (N, C, rows, cols); a single image
+            (1, C, rows, cols) is warped with every one of the N transformations
+        tfs: (N, 3, 3) `ndarray` of transformation matrices mapping output to
+            input coordinates, a single (3, 3) matrix used for every image, or a
+            list of transformation objects e.g. skimage.transform.SimilarityTransform
+        output_shape: tuple, (rows, cols)
+        mode: mode for transformation
+            available modes: {`constant`, `edge`, `symmetric`, `reflect`, `wrap`}
+        mode_cval: float, Used in conjunction with mode `constant`, the value outside the image boundaries
+        order: int, The order of interpolation. The order has to be in the range 0-1:
+            0: Nearest-neighbor
+            1: Bi-linear
+
+    Returns:
+        warped `ndarray`, shape (N, C) + output_shape, same dtype as imgs
+    """
+    if order not in (0, 1):
+        raise ValueError('fast_warp_batch supports only order 0 and 1, got %s' % str(order))
+    output_shape = tuple(output_shape)
+    n = imgs.shape[0]
+    if isinstance(tfs, np.ndarray):
+        m = np.asarray(tfs, dtype=np.float64)
+    else:
+        m = np.array([getattr(t, 'params', t) for t in tfs], dtype=np.float64)
+    if m.ndim == 2:
+        m = np.tile(m, (n, 1, 1))
+    n = len(m)
+
+    grid = _output_grid(output_shape)
+    if np.all(m[:, 2] == [0, 0, 1]):
+        # affine: a single (2N, 3) x (3, P) matrix product
+        coords = np.dot(m[:, :2].reshape(2 * n, 3), grid).reshape(n, 2, -1)
+        x, y = coords[:, 0], coords[:, 1]
+    else:
+        coords = np.dot(m.reshape(3 * n, 3), grid).reshape(n, 3, -1)
+        x, y = coords[:, 0] / coords[:, 2], coords[:, 1] / coords[:, 2]
+
+    rows, cols = imgs.shape[2:]
+    pixels = np.ascontiguousarray(imgs.transpose(0, 2, 3, 1)).reshape(imgs.shape[0] * rows * cols, -1)
+    if order == 0:
+        # round half away from zero, as C round() does in skimage
+        r = np.trunc(y + np.copysign(0.5, y)).astype(np.intp)
+        c = np.trunc(x + np.copysign(0.5, x)).astype(np.intp)
+        t_imgs = _gather_pixels(pixels, rows, cols, r, c, mode, mode_cval)
+    else:
+        dtype = np.result_type(imgs.dtype, np.float32)
+        minr = np.floor(y)
+        minc = np.floor(x)
+        dr = (y - minr).astype(dtype)[:, :, np.newaxis]
+        dc = (x - minc).astype(dtype)[:, :, np.newaxis]
+        minr = minr.astype(np.intp)
+        minc = minc.astype(np.intp)
+        top = (1 - dc) * _gather_pixels(pixels, rows, cols, minr, minc, mode, mode_cval) + \
+            dc * _gather_pixels(pixels, rows, cols, minr, minc + 1, mode, mode_cval)
+        bottom = (1 - dc) * _gather_pixels(pixels, rows, cols, minr + 1, minc, mode, mode_cval) + \
+            dc * _gather_pixels(pixels, rows, cols, minr + 1, minc + 1, mode, mode_cval)
+        t_imgs = (1 - dr) * top + dr * bottom
+    t_imgs = t_imgs.astype(imgs.dtype, copy=False).reshape((n,) + output_shape + (imgs.shape[1],))
+    return t_imgs.transpose(0, 3, 1, 2)
+
+
 def contrast_transform(img, contrast_min=0.8, contrast_max=1.2):
     """Transform input image contrast
 
@@ -167,6 +306,9 @@ def build_rescale_transform_fast(downscale_factor, image_shape, target_shape):
     return tform_shift_ds + tform_ds
 
 
+build_rescale_transform = build_rescale_transform_fast
+
+
 def build_centering_transform(image_shape, target_shape):
     """Image cetering transform
 
@@ -319,18 +461,155 @@ def perturb(img, augmentation_params, target_shape, rng=np.random, mode='constan
     Returns:
         a `ndarray` of transformed image
     """
-    shape = img.shape[1:]
-    tform_centering = build_centering_transform(shape, target_shape)
-    tform_center, tform_uncenter = build_center_uncenter_transforms(shape)
-    tform_augment = random_perturbation_transform(
-        rng=rng, **augmentation_params)
-    # shift to center, augment, shift back (for the rotation/shearing)
-    tform_augment = tform_uncenter + tform_augment + tform_center
-    return fast_warp(img, tform_centering + tform_augment,
+    tform = build_perturb_matrices(1, img.shape[1:], augmentation_params, target_shape, rng=rng)[0]
+    return fast_warp(img, tform,
                      output_shape=target_shape,
                      mode=mode, mode_cval=mode_cval)
 
 
+_centering_matrices = {}
+
+
+def _build_centering_matrices(image_shape, target_shape):
+    """Centering matrices around the augmentation, cached per (image_shape, target_shape)
+
+    Returns:
+        a tuple (center, uncenter_centering) of (3, 3) matrices, such that the
+        full perturbation is `center . augment . uncenter_centering`
+    """
+    key = (tuple(image_shape), tuple(target_shape))
+    matrices = _centering_matrices.get(key)
+    if matrices is None:
+        tform_centering = build_centering_transform(image_shape, target_shape)
+        tform_center, tform_uncenter = build_center_uncenter_transforms(image_shape)
+        # shift to center, augment, shift back (for the rotation/shearing)
+        matrices = (tform_center.params, np.dot(tform_uncenter.params, tform_centering.params))
+        _centering_matrices[key] = matrices
+    return matrices
+
+
+def build_augmentation_matrices(zoom, rotation, shear, translation, flip):
+    """Augmentation matrices for a batch
+
+    Vectorized counterpart of `build_augmentation_transform`; same parameters,
+    each given as an array with one entry per image.
+
+    Args:
+        zoom: a tuple(zoom_rows, zoom_cols) of arrays
+        rotation: array, Rotation angles in counter-clockwise direction as degrees.
+        shear: array, shear angles in counter-clockwise direction as degrees
+        translation: a tuple(trans_rows, trans_cols) of arrays
+        flip: bool array, flip an image
+
+    Returns:
+        (N, 3, 3) `ndarray` of augment matrices
+    """
+    flip = np.asarray(flip, dtype=bool)
+    # shear by 180 degrees is equivalent to rotation by 180 degrees + flip.
+    # So after that we rotate it another 180 degrees to get just the flip.
+    rotation = np.deg2rad(np.asarray(rotation, dtype=np.float64) + 180 * flip)
+    shear = np.deg2rad(np.asarray(shear, dtype=np.float64) + 180 * flip)
+    sx = 1 / np.asarray(zoom[0], dtype=np.float64)
+    sy = 1 / np.asarray(zoom[1], dtype=np.float64)
+    matrices = np.zeros((len(rotation), 3, 3))
+    matrices[:, 0, 0] = sx * np.cos(rotation)
+    matrices[:, 0, 1] = -sy * np.sin(rotation + shear)
+    matrices[:, 0, 2] = translation[0]
+    matrices[:, 1, 0] = sx * np.sin(rotation)
+    matrices[:, 1, 1] = sy * np.cos(rotation + shear)
+    matrices[:, 1, 2] = translation[1]
+    matrices[:, 2, 2] = 1
+    return matrices
+
+
+def random_perturbation_matrices(n, zoom_range, rotation_range, shear_range, translation_range, do_flip=True,
+                                 allow_stretch=False, rng=np.random):
+    """Random perturbation for a batch
+
+    Vectorized counterpart of `random_perturbation_transform`, sampling the
+    params of all images at once. Params are drawn in the same order, so with
+    n=1 the result matches `random_perturbation_transform` for the same rng state.
+
+    Args:
+        n: int, number of images
+        zoom_range: a tuple(min_zoom, max_zoom)
+        rotation_range: a tuple(min_angle, max_angle)
+        shear_range: a tuple(min_shear, max_shear)
+        translation_range: a tuple(min_shift, max_shift)
+        do_flip: bool, flip an image
+        allow_stretch: bool, stretch an image
+        rng: an instance
+
+    Returns:
+        (N, 3, 3) `ndarray` of augment matrices
+    """
+    shift_x = rng.uniform(*translation_range, size=n)
+    shift_y = rng.uniform(*translation_range, size=n)
+    translation = (shift_x, shift_y)
+
+    rotation = rng.uniform(*rotation_range, size=n)
+    shear = rng.uniform(*shear_range, size=n)
+
+    if do_flip:
+        flip = (rng.randint(2, size=n) > 0)  # flip half of the time
+    else:
+        flip = np.zeros(n, dtype=bool)
+
+    # random zoom
+    log_zoom_range = [np.log(z) for z in zoom_range]
+    if isinstance(allow_stretch, float):
+        log_stretch_range = [-np.log(allow_stretch), np.log(allow_stretch)]
+        zoom = np.exp(rng.uniform(*log_zoom_range, size=n))
+        stretch = np.exp(rng.uniform(*log_stretch_range, size=n))
+        zoom_x = zoom * stretch
+        zoom_y = zoom / stretch
+    elif allow_stretch is True:  # avoid bugs, f.e. when it is an integer
+        zoom_x = np.exp(rng.uniform(*log_zoom_range, size=n))
+        zoom_y = np.exp(rng.uniform(*log_zoom_range, size=n))
+    else:
+        zoom_x = zoom_y = np.exp(rng.uniform(*log_zoom_range, size=n))
+
+    return build_augmentation_matrices((zoom_x, zoom_y), rotation, shear, translation, flip)
+
+
+def build_perturb_matrices(n, image_shape, augmentation_params, target_shape, rng=np.random):
+    """Random perturbation matrices including centering, for a batch
+
+    Args:
+        n: int, number of images
+        image_shape: tuple(rows, cols), input image shape
+        augmentation_paras: a dict, with augmentation name as keys and values as params
+        target_shape: a tuple(rows, cols), output image shape
+        rng: an instance for random number generation
+
+    Returns:
+        (N, 3, 3) `ndarray` of matrices mapping output to input coordinates, as used by `perturb`
+    """
+    augment = random_perturbation_matrices(n, rng=rng, **augmentation_params)
+    return _center_augmentation(image_shape, augment, target_shape)
+
+
+def build_fixed_perturb_matrix(image_shape, tform_augment, target_shape):
+    """Determinastic perturbation matrix including centering
+
+    Args:
+        image_shape: tuple(rows, cols), input image shape
+        tform_augment: augment transform instance or (3, 3) matrix
+        target_shape: a tuple(rows, cols), output image shape
+
+    Returns:
+        (3, 3) `ndarray` mapping output to input coordinates, as used by `perturb_fixed`
+    """
+    augment = getattr(tform_augment, 'params', tform_augment)
+    return _center_augmentation(image_shape, augment[np.newaxis], target_shape)[0]
+
+
+def _center_augmentation(image_shape, augment, target_shape):
+    center, uncenter_centering = _build_centering_matrices(image_shape, target_shape)
+    # tform_centering + (tform_uncenter + tform_augment + tform_center)
+    return np.matmul(center, np.matmul(augment, uncenter_centering))
+
+
 def perturb_rescaled(img, scale, augmentation_params, target_shape=(224, 224), rng=np.random, mode='constant', mode_cval=0):
     """Perturb image rescaled
 
@@ -350,14 +629,31 @@ def perturb_rescaled(img, scale, augmentation_params, target_shape=(224, 224), r
     Returns:
         a `ndarray` of transformed image
     """
-    tform_rescale = build_rescale_transform(
-        scale, img.shape, target_shape)  # also does centering
-    tform_center, tform_uncenter = build_center_uncenter_transforms(img.shape)
-    tform_augment = random_perturbation_transform(
-        rng=rng, **augmentation_params)
-    # shift to center, augment, shift back (for the rotation/shearing)
-    tform_augment = tform_uncenter + tform_augment + tform_center
-    return fast_warp(img, tform_rescale + tform_augment, output_shape=target_shape, mode=mode, mode_cval=mode_cval).astype('float32')
+    augment = random_perturbation_matrices(1, rng=rng, **augmentation_params)[0]
+    center, uncenter_rescale = _build_rescale_matrices(img.shape[1:], scale, target_shape)
+    # tform_rescale + (tform_uncenter + tform_augment + tform_center)
+    tform = np.dot(center, np.dot(augment, uncenter_rescale))
+    return fast_warp(img, tform, output_shape=target_shape, mode=mode, mode_cval=mode_cval).astype('float32')
+
+
+_rescale_matrices = {}
+
+
+def _build_rescale_matrices(image_shape, downscale_factor, target_shape):
+    """Centering matrices around the augmentation of `perturb_rescaled`, cached per shapes and scale
+
+    Returns:
+        a tuple (center, uncenter_rescale) of (3, 3) matrices, such that the
+        full perturbation is `center . augment . uncenter_rescale`
+    """
+    key = (tuple(image_shape), downscale_factor, tuple(target_shape))
+    matrices = _rescale_matrices.get(key)
+    if matrices is None:
+        tform_rescale = build_rescale_transform(downscale_factor, image_shape, target_shape)  # also does centering
+        tform_center, tform_uncenter = build_center_uncenter_transforms(image_shape)
+        matrices = (tform_center.params, np.dot(tform_uncenter.params, tform_rescale.params))
+        _rescale_matrices[key] = matrices
+    return matrices
 
 
 # for test-time augmentation
@@ -379,12 +675,8 @@ def perturb_fixed(img, tform_augment, target_shape=(50, 50), mode='constant', mo
     Returns:
         a `ndarray` of transformed image
     """
-    shape = img.shape[1:]
-    tform_centering = build_centering_transform(shape, target_shape)
-    tform_center, tform_uncenter = build_center_uncenter_transforms(shape)
-    # shift to center, augment, shift back (for the rotation/shearing)
-    tform_augment = tform_uncenter + tform_augment + tform_center
-    return fast_warp(img, tform_centering + tform_augment,
+    tform = build_fixed_perturb_matrix(img.shape[1:], tform_augment, target_shape)
+    return fast_warp(img, tform,
                      output_shape=target_shape, mode=mode, mode_cval=mode_cval)
 
 
@@ -394,14 +686,244 @@ def load_perturbed(fname):
 
 
 def load_augmented_images(fnames, preprocessor, w, h, is_training, aug_params=no_augmentation_params, transform=None,
-                          bbox=None, fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None):
+                          bbox=None, fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None,
+                          cache=None, rngs=None):
+    per_image_rngs = rngs if rngs is not None else [None] * len(fnames)
+    if hasattr(standardizer, 'standardize_batch'):
+        imgs = np.array(
+            [load_augment(f, preprocessor, w, h, is_training, aug_params, transform, bbox, fill_mode, fill_mode_cval,
+                          None, save_to_dir, cache, rng) for f, rng in zip(fnames, per_image_rngs)])
+        return standardize_batch(imgs, standardizer, is_training, rngs)
     return np.array(
         [load_augment(f, preprocessor, w, h, is_training, aug_params, transform, bbox, fill_mode, fill_mode_cval,
-                      standardizer, save_to_dir) for f in fnames])
+                      standardizer, save_to_dir, cache, rng) for f, rng in zip(fnames, per_image_rngs)])
+
+
+def load_augmented_images_batch(fnames, preprocessor, w, h, is_training, aug_params=no_augmentation_params,
+                                transform=None, bbox=None, fill_mode='constant', fill_mode_cval=0, standardizer=None,
+                                save_to_dir=None, cache=None, rngs=None):
+    """Load augmented images with output shape (w, h), warping the whole batch at once.
+
+    Same arguments and output as `load_augmented_images`, but all images
+    sharing an input shape are warped with a single `fast_warp_batch` call
+    instead of one `fast_warp` call per image. Crops (`bbox`) involve no
+    warping and use the per image path. With per image `rngs` every image
+    draws its transform from its own generator, exactly as `load_augment` does.
+
+    Returns:
+        a `ndarray` of augmented images, shape (N, w, h, C)
+    """
+    if bbox is not None or len(fnames) == 0:
+        return load_augmented_images(fnames, preprocessor, w, h, is_training, aug_params, transform, bbox, fill_mode,
+                                     fill_mode_cval, standardizer, save_to_dir, cache, rngs)
+    imgs = [load_image(f, preprocessor, cache) for f in fnames]
+    indices_by_shape = {}
+    for i, img in enumerate(imgs):
+        indices_by_shape.setdefault(img.shape, []).append(i)
+
+    # work channels last (the memory layout of decoded images) so that
+    # stacking and warping never reorder the pixel data
+    t_imgs = None
+    for shape, indices in indices_by_shape.items():
+        if transform is not None:
+            tforms = build_fixed_perturb_matrix(shape[1:], transform, (w, h))
+        elif rngs is not None:
+            tforms = np.concatenate([build_perturb_matrices(1, shape[1:], aug_params, (w, h), rng=rngs[i])
+                                     for i in indices])
+        else:
+            tforms = build_perturb_matrices(len(indices), shape[1:], aug_params, (w, h))
+        batch = np.empty((len(indices),) + shape[1:] + shape[:1], dtype=imgs[indices[0]].dtype)
+        for j, i in enumerate(indices):
+            batch[j] = imgs[i].transpose(1, 2, 0)
+        warped = fast_warp_batch(batch.transpose(0, 3, 1, 2), tforms, output_shape=(w, h),
+                                 mode=fill_mode, mode_cval=fill_mode_cval)
+        if t_imgs is None:
+            t_imgs = np.empty((len(imgs), w, h, shape[0]), dtype=warped.dtype)
+        t_imgs[indices] = warped.transpose(0, 2, 3, 1)
+
+    if save_to_dir is not None:
+        for i, fname in enumerate(fnames):
+            _finalize_augmented(t_imgs[i].transpose(2, 0, 1), fname, is_training, None, save_to_dir,
+                                rngs[i] if rngs is not None else None)
+    # already in tf format
+    return standardize_batch(t_imgs, standardizer, is_training, rngs)
+
+
+def standardize_batch(imgs, standardizer, is_training, rngs=None):
+    """Standardize a (N, w, h, C) batch of images in place
+
+    Uses the standardizer's vectorized `standardize_batch` if it has one,
+    otherwise calls it on every image.
+
+    Args:
+        imgs: 4-D float array, batch of images in tf format
+        standardizer: image standardizer or None
+        is_training: bool, if True then training else validation
+        rngs: an optional sequence of per image random number generators
+
+    Returns:
+        the standardized batch
+    """
+    if standardizer is None or len(imgs) == 0:
+        return imgs
+    if not np.issubdtype(imgs.dtype, np.floating):
+        imgs = imgs.astype(np.float32)
+    if hasattr(standardizer, 'standardize_batch'):
+        return standardizer.standardize_batch(imgs, is_training, channels_last=True, rngs=rngs)
+    for i in range(len(imgs)):
+        img = imgs[i].transpose(2, 0, 1)
+        img[...] = _finalize_augmented(img, None, is_training, standardizer, None,
+                                       rngs[i] if rngs is not None else None)
+    return imgs
+
+
+def load_crops(fname, preprocessor, w, h, bboxes, standardizer=None, cache=None, out=None):
+    """Load several crops of an image, decoding it only once.
+
+    Args:
+        fname: string, image filename
+        preprocessor: real-time image processing/crop
+        w: int, width of the crops
+        h: int, height of the crops
+        bboxes: 2-D array, one crop per row as in `load_augment`'s bbox,
+            the crop is flipped if its 5th value is 1
+        standardizer: image standardizer, zero mean, unit variance image
+        cache: an optional `DecodedImageCache`, consulted before calling the preprocessor
+        out: an optional float array of shape (len(bboxes), w, h, C) to write the crops to
+
+    Returns:
+        standardized crops in tf format, shape (len(bboxes), w, h, C)
+    """
+    img = load_image(fname, preprocessor, cache)
+    if out is None:
+        out = np.empty((len(bboxes), w, h, img.shape[0]), dtype=np.float32)
+    _write_crops(img, bboxes, out)
+    return standardize_batch(out, standardizer, False)
+
+
+def load_multi_crop_images(fnames, preprocessor, w, h, bboxes, standardizer=None, cache=None):
+    """Load several crops of each image, decoding every image only once.
+
+    Same arguments as `load_crops`, for a batch of images.
+
+    Returns:
+        standardized crops in tf format, shape (len(fnames) * len(bboxes), w, h, C),
+        the crops of an image being consecutive
+    """
+    num_crops = len(bboxes)
+    out = None
+    for i, fname in enumerate(fnames):
+        img = load_image(fname, preprocessor, cache)
+        if out is None:
+            out = np.empty((len(fnames) * num_crops, w, h, img.shape[0]), dtype=np.float32)
+        _write_crops(img, bboxes, out[i * num_crops:(i + 1) * num_crops])
+    if out is None:
+        return np.empty((0, w, h, 3), dtype=np.float32)
+    return standardize_batch(out, standardizer, False)
+
+
+def load_transformed(fname, preprocessor, w, h, transforms, color_vecs=None, fill_mode='constant', fill_mode_cval=0,
+                     standardizer=None, cache=None, out=None):
+    """Load several fixed transforms of an image, decoding it only once.
+
+    Args:
+        fname: string, image filename
+        preprocessor: real-time image processing/crop
+        w: int, width of target image
+        h: int, height of target image
+        transforms: sequence of transform instances or (3, 3) matrices, as the
+            transform of `load_augment`
+        color_vecs: an optional sequence of color vectors, one per transform, set
+            on the standardizer with `set_tta_args` (test time augmentation)
+        fill_mode: mode for transformation
+            available modes: {`constant`, `edge`, `symmetric`, `reflect`, `wrap`}
+        fill_mode_cval: float, Used in conjunction with mode `constant`,
+            the value outside the image boundaries
+        standardizer: image standardizer, zero mean, unit variance image
+        cache: an optional `DecodedImageCache`, consulted before calling the preprocessor
+        out: an optional float array of shape (len(transforms), w, h, C) to write the images to
+
+    Returns:
+        standardized images in tf format, shape (len(transforms), w, h, C)
+    """
+    img = load_image(fname, preprocessor, cache)
+    if out is None:
+        out = np.empty((len(transforms), w, h, img.shape[0]), dtype=np.float32)
+    _write_transformed(img, transforms, fill_mode, fill_mode_cval, out)
+    return _standardize_variants(out, standardizer, color_vecs)
+
+
+def load_multi_transform_images(fnames, preprocessor, w, h, transforms, color_vecs=None, fill_mode='constant',
+                                fill_mode_cval=0, standardizer=None, cache=None):
+    """Load several fixed transforms of each image, decoding every image only once.
+
+    Same arguments as `load_transformed`, for a batch of images.
+
+    Returns:
+        standardized images in tf format, shape (len(fnames) * len(transforms), w, h, C),
+        the transforms of an image being consecutive
+    """
+    num_transforms = len(transforms)
+    out = None
+    for i, fname in enumerate(fnames):
+        img = load_image(fname, preprocessor, cache)
+        if out is None:
+            out = np.empty((len(fnames) * num_transforms, w, h, img.shape[0]), dtype=np.float32)
+        _write_transformed(img, transforms, fill_mode, fill_mode_cval,
+                           out[i * num_transforms:(i + 1) * num_transforms])
+    if out is None:
+        return np.empty((0, w, h, 3), dtype=np.float32)
+    return _standardize_variants(out, standardizer, color_vecs)
+
+
+def _write_transformed(img, transforms, fill_mode, fill_mode_cval, out):
+    """Warp the (C, rows, cols) image with every transform into the (N, w, h, C) buffer"""
+    augments = np.array([getattr(t, 'params', t) for t in transforms], dtype=np.float64)
+    tforms = _center_augmentation(img.shape[1:], augments, out.shape[1:3])
+    warped = fast_warp_batch(img[np.newaxis], tforms, output_shape=out.shape[1:3], mode=fill_mode,
+                             mode_cval=fill_mode_cval)
+    out[...] = warped.transpose(0, 2, 3, 1)
+
+
+def _standardize_variants(out, standardizer, color_vecs):
+    """Standardize images whose variants are interleaved, one color vector per variant"""
+    if color_vecs is None or standardizer is None:
+        return standardize_batch(out, standardizer, False)
+    num_variants = len(color_vecs)
+    for i, color_vec in enumerate(color_vecs):
+        standardizer.set_tta_args(color_vec=color_vec)
+        standardize_batch(out[i::num_variants], standardizer, False)
+    return out
+
+
+def _write_crops(img, bboxes, out):
+    """Copy the (C, rows, cols) image crops into the (N, w, h, C) buffer"""
+    for crop, bbox in zip(out, bboxes):
+        img_crop = definite_crop(img, bbox).transpose(1, 2, 0)
+        if bbox[4] == 1:
+            img_crop = img_crop[:, ::-1]
+        crop[...] = img_crop
+
+
+def _finalize_augmented(img, fname, is_training, standardizer, save_to_dir, rng=None):
+    """Save and standardize an augmented (C, w, h) image"""
+    if save_to_dir is not None:
+        file_full_name = os.path.basename(fname)
+        file_name, file_ext = os.path.splitext(file_full_name)
+        fname2 = "%s/%s_DA_%d%s" % (save_to_dir,
+                                    file_name, (rng or np.random).randint(1e4), file_ext)
+        save_image(img, fname2)
+
+    if standardizer is not None:
+        if rng is None:
+            img = standardizer(img, is_training)
+        else:
+            img = standardizer(img, is_training, rng=rng)
+    return img
 
 
 def load_augment(fname, preprocessor, w, h, is_training, aug_params=no_augmentation_params, transform=None, bbox=None,
-                 fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None):
+                 fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None, cache=None, rng=None):
     """Load augmented image with output shape (w, h).
 
     Default arguments return non augmented image of shape (w, h).
@@ -425,11 +947,15 @@ def load_augment(fname, preprocessor, w, h, is_training, aug_params=no_augmentat
         standardizer: image standardizer, zero mean, unit variance image
              e.g.: samplewise standardized each image based on its own value
         save_to_dir: a string, path to save image, save output image to a dir
+        cache: an optional `DecodedImageCache`, consulted before calling the preprocessor
+        rng: an optional random number generator for this image, e.g. from `sample_rng`,
+            used for the perturbation and passed on to the standardizer; the global
+            numpy state is used by default
 
     Returns:
         augmented image
     """
-    img = load_image(fname, preprocessor)
+    img = load_image(fname, preprocessor, cache)
 
     # target shape should be (h, w) i.e. (rows, cols). need to revisit when we
     # do non-square shapes
@@ -446,24 +972,31 @@ def load_augment(fname, preprocessor, w, h, is_training, aug_params=no_augmentat
         img = perturb_fixed(img, tform_augment=transform, target_shape=(w, h), mode=fill_mode,
                             mode_cval=fill_mode_cval)
     else:
-        img = perturb(img, augmentation_params=aug_params, target_shape=(w, h), mode=fill_mode,
-                      mode_cval=fill_mode_cval)
+        img = perturb(img, augmentation_params=aug_params, target_shape=(w, h), rng=rng or np.random,
+                      mode=fill_mode, mode_cval=fill_mode_cval)
     # img = brightness_transform(img, brightness_min=0.93, brightness_max=1.4)
 
-    if save_to_dir is not None:
-        file_full_name = os.path.basename(fname)
-        file_name, file_ext = os.path.splitext(file_full_name)
-        fname2 = "%s/%s_DA_%d%s" % (save_to_dir,
-                                    file_name, np.random.randint(1e4), file_ext)
-        save_image(img, fname2)
-
-    if standardizer is not None:
-        img = standardizer(img, is_training)
+    img = _finalize_augmented(img, fname, is_training, standardizer, save_to_dir, rng)
 
     # convert to tf format
     return img.transpose(1, 2, 0)
 
 
+def sample_rng(key):
+    """Random number generator of one sample's augmentation stream
+
+    The stream depends only on the key, e.g. (seed, epoch, batch, index in batch),
+    so a sample is augmented the same way whichever worker process handles it.
+
+    Args:
+        key: tuple of non negative ints
+
+    Returns:
+        a `np.random.RandomState` instance
+    """
+    return np.random.RandomState(np.array(key, dtype=np.uint32))
+
+
 def image_no_preprocessing(fname):
     """Open Image
 
@@ -491,26 +1024,185 @@ def load_images(imgs, preprocessor=image_no_preprocessing):
     return np.array([load_image(f, preprocessor) for f in imgs])
 
 
-def load_image(img, preprocessor=image_no_preprocessing):
+def load_image(img, preprocessor=image_no_preprocessing, cache=None):
     """Load image
 
     Args:
-        img: a image filename
+        img: a image filename, an image or an index into a packed dataset
         preprocessor: image processing function
+        cache: an optional `DecodedImageCache` holding preprocessed images
 
     Returns:
         a processed image
 
     """
     if isinstance(img, basestring):
-        p_img = preprocessor(img)
+        if cache is not None:
+            p_img = cache.load(img, preprocessor)
+        else:
+            p_img = preprocessor(img)
         return np.array(p_img, dtype=np.float32).transpose(2, 1, 0)
+    elif isinstance(img, (int, np.integer)):
+        # index into a packed dataset, resolved by the preprocessor
+        # e.g. tefla.core.dir_dataset.PackedImageReader
+        return np.array(preprocessor(img), dtype=np.float32).transpose(2, 1, 0)
     elif isinstance(img, np.ndarray):
         return preprocessor(img)
     else:
         raise AssertionError("Unknown image type")
 
 
+# caches created in this process, dropped with their last reference
+_image_caches = weakref.WeakValueDictionary()
+# copies unpickled by worker processes, kept for the lifetime of the worker
+_worker_caches = {}
+
+
+def _get_image_cache(cache_id, max_bytes, cache_dir):
+    cache = _image_caches.get(cache_id) or _worker_caches.get(cache_id)
+    if cache is None:
+        cache = _worker_caches[cache_id] = DecodedImageCache(max_bytes, cache_dir, cache_id)
+    else:
+        # the budget share shrinks as more worker processes use the cache
+        cache.set_max_bytes(max_bytes)
+    return cache
+
+
+class DecodedImageCache(object):
+    """Decoded image cache
+
+    Keeps the output of the preprocessor (the decoded, not yet augmented
+    image) so that every epoch does not re-open and re-decode the files. An
+    in-memory LRU with a byte budget sits in front of an optional on-disk
+    store of memory-mapped uint8 arrays, keyed by filename and mtime.
+
+    A cache holds the output of a single preprocessor; use one cache per
+    preprocessor. Pickled copies (e.g. sent to `ParallelDAIterator` workers)
+    resolve to a single instance per process. `max_bytes` is the total
+    budget: it is split evenly between the worker processes registered with
+    `attach_workers`, and as workers get a different slice of the images
+    every epoch, the in-memory LRU mostly pays off when the dataset fits in
+    a worker's share. The on-disk store is shared by all processes, its
+    pages by way of the OS page cache, and is what gives hits across
+    workers and restarts.
+
+    Args:
+        max_bytes: int, total byte budget of the in-memory LRUs; 0 disables them
+        cache_dir: string, optional directory of the on-disk store
+    """
+
+    def __init__(self, max_bytes=1 << 30, cache_dir=None, cache_id=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.cache_id = cache_id or str(uuid4())
+        self.num_workers = 0
+        self.nbytes = 0
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        if cache_id is None:
+            _image_caches[self.cache_id] = self
+
+    def __reduce__(self):
+        return _get_image_cache, (self.cache_id, self.max_bytes // max(self.num_workers, 1), self.cache_dir)
+
+    def attach_workers(self, num_workers):
+        """Registers worker processes using the cache, each gets an equal share of `max_bytes`
+
+        Args:
+            num_workers: int, number of worker processes
+        """
+        self.num_workers += num_workers
+
+    def detach_workers(self, num_workers):
+        """Unregisters worker processes registered with `attach_workers`
+
+        Args:
+            num_workers: int, number of worker processes
+        """
+        self.num_workers = max(self.num_workers - num_workers, 0)
+
+    def set_max_bytes(self, max_bytes):
+        """Sets the byte budget of the in-memory LRU, evicting images above it
+
+        Args:
+            max_bytes: int, byte budget of the in-memory LRU
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def load(self, fname, preprocessor):
+        """Returns the preprocessed image of a file, decoding it only on a cache miss
+
+        Args:
+            fname: a image filename
+            preprocessor: image processing function
+
+        Returns:
+            a `ndarray`, the preprocessed image as returned by the preprocessor, (rows, cols, channels)
+        """
+        key = (fname, os.path.getmtime(fname))
+        with self._lock:
+            img = self._images.pop(key, None)
+            if img is not None:
+                self._images[key] = img
+                return img
+        img = None
+        if self.cache_dir:
+            img = self._load_from_disk(key)
+        if img is None:
+            img = np.asarray(preprocessor(fname))
+            if self.cache_dir and img.dtype == np.uint8:
+                img = self._save_to_disk(key, img)
+        self._insert(key, img)
+        return img
+
+    def clear(self):
+        """Empties the in-memory LRU; the on-disk store is kept"""
+        with self._lock:
+            self._images.clear()
+            self.nbytes = 0
+
+    def _insert(self, key, img):
+        if img.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._images:
+                return
+            self._images[key] = img
+            self.nbytes += img.nbytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._images.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def _disk_path(self, key):
+        name = hashlib.sha1(('%s:%r' % (os.path.abspath(key[0]), key[1])).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def _load_from_disk(self, key):
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            return np.load(path, mmap_mode='r')
+        except (IOError, ValueError):
+            return None
+
+    def _save_to_disk(self, key, img):
+        path = self._disk_path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, img)
+        # atomic, concurrent writers of the same image end up with one complete file
+        os.rename(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
+
 def save_image(x, fname):
     """Save image
 
@@ -543,3 +1235,68 @@ def balance_per_class_indices(y, weights):
         p[y == i] = weight
     return np.random.choice(np.arange(len(y)), size=len(y), replace=True,
                             p=np.array(p) / p.sum())
+
+
+class BalancedClassSampler(object):
+    """Class balanced sampler
+
+    Vectorized counterpart of `balance_per_class_indices`, with the per epoch
+    interpolation from `balance_weights` to `final_balance_weights` built in.
+    Per class index arrays are computed once per label array; every draw
+    samples the class counts from a multinomial and then uniform indices
+    within each class, so there is no O(N) float work per epoch.
+
+    Args:
+        balance_weights: 1-D array, initial sampling weights per class
+        final_balance_weights: 1-D array, sampling weights per class reached over time
+        balance_ratio: float, the weight of `balance_weights` decays as `balance_ratio ** epoch`
+        balance_epoch_count: int, number of epochs already sampled, e.g. when resuming training
+        rng: an instance for random number generation
+    """
+
+    def __init__(self, balance_weights, final_balance_weights, balance_ratio, balance_epoch_count=0, rng=np.random):
+        self.balance_weights = np.asarray(balance_weights, dtype=np.float64)
+        self.final_balance_weights = np.asarray(final_balance_weights, dtype=np.float64)
+        self.balance_ratio = balance_ratio
+        self.count = balance_epoch_count
+        self.rng = rng
+        self._y = None
+        self._class_indices = None
+
+    def class_weights(self):
+        """Sampling weights per class for the current epoch"""
+        alpha = self.balance_ratio ** self.count
+        return self.balance_weights * alpha + self.final_balance_weights * (1 - alpha)
+
+    def sample(self, y, shuffle=True):
+        """Draws one epoch of class balanced indices, with replacement
+
+        Args:
+            y: 1-D int array, class labels
+            shuffle: bool, shuffle the indices; otherwise they come grouped by class
+
+        Returns:
+            1-D array of len(y) indices into y
+        """
+        if y is not self._y:
+            self._set_labels(y)
+        weights = self.class_weights()
+        self.count += 1
+        class_sizes = np.array([len(idx) for idx in self._class_indices], dtype=np.float64)
+        p = np.zeros(len(class_sizes))
+        n = min(len(weights), len(class_sizes))
+        p[:n] = weights[:n] * class_sizes[:n]
+        counts = self.rng.multinomial(len(y), p / p.sum())
+        indices = np.concatenate([idx[self.rng.randint(len(idx), size=count)]
+                                  for idx, count in zip(self._class_indices, counts) if count > 0])
+        if shuffle:
+            self.rng.shuffle(indices)
+        return indices
+
+    def _set_labels(self, y):
+        y = np.asarray(y)
+        order = np.argsort(y, kind='mergesort')
+        boundaries = np.cumsum(np.bincount(y.astype(np.intp)))
+        self._class_indices = np.split(order, boundaries[:-1])
+        self._y = y
+
@@ -2,6 +2,7 @@ from __future__ import division, print_function, absolute_import
 
 import Queue
 import SharedArray
+import collections
 import multiprocessing
 import os
 import threading
@@ -13,23 +14,55 @@ from . import data
 
 
 class BatchIterator(object):
-
-    def __init__(self, batch_size, shuffle):
+    """Batch iterator
+
+    Args:
+        batch_size: int, number of samples per batch
+        shuffle: bool, shuffle the samples every epoch
+        streaming: bool, if True, a shuffled epoch keeps only the permutation
+            and gathers each batch into a reusable output buffer instead of
+            materializing shuffled copies of X and y, so memory stays at one
+            batch on top of the dataset. A batch is then only valid until the
+            next one is requested.
+    """
+
+    def __init__(self, batch_size, shuffle, streaming=False):
         self.batch_size = batch_size
         self.shuffle = shuffle
+        self.streaming = streaming
 
     def __call__(self, X, y=None):
+        self.index_array = None
         if self.shuffle:
             index_array = np.random.permutation(len(X))
-            self.X = X[index_array]
-            self.y = y[index_array] if y is not None else y
+            if self.streaming:
+                # converted once, not by every batch gather
+                self.X = np.asarray(X)
+                self.y = np.asarray(y) if y is not None else y
+                self.index_array = index_array
+            else:
+                self.X = X[index_array]
+                self.y = y[index_array] if y is not None else y
         else:
             self.X, self.y = X, y
         return self
 
     def __iter__(self):
+        for Xb, yb in self.batches():
+            yield self.transform(Xb, yb)
+
+    def batches(self, batch_size=None):
+        """Yields the raw (untransformed) batches
+
+        Args:
+            batch_size: int, number of samples per batch, `self.batch_size` by default
+        """
+        bs = batch_size or self.batch_size
+        if getattr(self, 'index_array', None) is not None:
+            for batch in self._gathered_batches(bs):
+                yield batch
+            return
         n_samples = self.X.shape[0]
-        bs = self.batch_size
         for i in range((n_samples + bs - 1) // bs):
             sl = slice(i * bs, (i + 1) * bs)
             Xb = self.X[sl]
@@ -37,14 +70,30 @@ class BatchIterator(object):
                 yb = self.y[sl]
             else:
                 yb = None
-            yield self.transform(Xb, yb)
+            yield Xb, yb
+
+    def _gathered_batches(self, batch_size):
+        n_samples = len(self.index_array)
+        if n_samples == 0:
+            return
+        bs = min(batch_size, n_samples)
+        X_buffer = np.empty((bs,) + self.X.shape[1:], dtype=self.X.dtype)
+        y_buffer = np.empty((bs,) + self.y.shape[1:], dtype=self.y.dtype) if self.y is not None else None
+        for i in range((n_samples + bs - 1) // bs):
+            indices = self.index_array[i * bs:(i + 1) * bs]
+            Xb = np.take(self.X, indices, axis=0, out=X_buffer[:len(indices)])
+            if self.y is not None:
+                yb = np.take(self.y, indices, axis=0, out=y_buffer[:len(indices)])
+            else:
+                yb = None
+            yield Xb, yb
 
     def transform(self, Xb, yb):
         return Xb, yb
 
     def __getstate__(self):
         state = dict(self.__dict__)
-        for attr in ('X', 'y',):
+        for attr in ('X', 'y', 'index_array'):
             if attr in state:
                 del state[attr]
         return state
@@ -55,10 +104,13 @@ class QueuedMixin(object):
     def __iter__(self):
         queue = Queue.Queue(maxsize=20)
         end_marker = object()
+        stop = threading.Event()
 
         def producer():
             for Xb, yb in super(QueuedMixin, self).__iter__():
-                queue.put((np.array(Xb), np.array(yb)))
+                queue.put(self.queue_item(Xb, yb))
+                if stop.is_set():
+                    break
             queue.put(end_marker)
 
         thread = threading.Thread(target=producer)
@@ -66,10 +118,29 @@ class QueuedMixin(object):
         thread.start()
 
         item = queue.get()
-        while item is not end_marker:
-            yield item
-            queue.task_done()
-            item = queue.get()
+        try:
+            while item is not end_marker:
+                try:
+                    yield item
+                finally:
+                    self.batch_consumed()
+                queue.task_done()
+                item = queue.get()
+        finally:
+            if item is not end_marker:
+                # iteration abandoned early, let the producer run down
+                stop.set()
+                item = queue.get()
+                while item is not end_marker:
+                    self.batch_consumed()
+                    item = queue.get()
+
+    def queue_item(self, Xb, yb):
+        return np.array(Xb), np.array(yb)
+
+    def batch_consumed(self):
+        """Called once the consumer is done with the batch it was last given"""
+        pass
 
 
 class QueuedIterator(QueuedMixin, BatchIterator):
@@ -77,15 +148,44 @@ class QueuedIterator(QueuedMixin, BatchIterator):
 
 
 class DAIterator(BatchIterator):
-
-    def __call__(self, X, y=None, crop_bbox=None, xform=None):
+    """Data augmentation iterator
+
+    Args:
+        seed: int, if given every sample is augmented with its own random stream
+            keyed by (seed, epoch, batch, index in batch), see `data.sample_rng`,
+            instead of the global numpy random state; the augmentation of an
+            epoch is then reproducible whatever the number of workers
+        epoch_count: int, number of epochs already iterated, e.g. when resuming
+            training; every call of the iterator starts a new epoch
+        streaming: bool, gather the shuffled batches by index instead of copying
+            the shuffled dataset, see `BatchIterator`
+
+    Calling the iterator with a 2-D array of bounding boxes as `crop_bbox`
+    (e.g. `util.get_bbox_10crop`), or with a list of transforms as `xform`
+    (e.g. `tta.build_quasirandom_transforms`, optionally with one standardizer
+    `color_vecs` per transform), decodes every image once and yields all of
+    its variants consecutively, one row per bbox or transform, in batches of
+    at most `batch_size` rows.
+    """
+
+    def __call__(self, X, y=None, crop_bbox=None, xform=None, color_vecs=None):
         self.crop_bbox = crop_bbox
         self.xform = xform
+        self.color_vecs = color_vecs
+        if np.ndim(crop_bbox) == 2:
+            self.num_variants = len(crop_bbox)
+        elif isinstance(xform, (list, tuple)) or np.ndim(xform) == 3:
+            self.num_variants = len(xform)
+        else:
+            self.num_variants = None
+        self.epoch = self.epoch_count
+        self.epoch_count += 1
+        self.batch_count = 0
         return super(DAIterator, self).__call__(X, y)
 
     def __init__(self, batch_size, shuffle, preprocessor, crop_size, is_training,
                  aug_params=data.no_augmentation_params, fill_mode='constant', fill_mode_cval=0, standardizer=None,
-                 save_to_dir=None):
+                 save_to_dir=None, batch_warp=False, image_cache=None, seed=None, epoch_count=0, streaming=False):
         self.preprocessor = preprocessor if preprocessor else data.image_no_preprocessing
         self.w = crop_size[0]
         self.h = crop_size[1]
@@ -95,14 +195,18 @@ class DAIterator(BatchIterator):
         self.fill_mode_cval = fill_mode_cval
         self.standardizer = standardizer
         self.save_to_dir = save_to_dir
+        self.batch_warp = batch_warp
+        self.image_cache = image_cache
+        self.seed = seed
+        self.epoch_count = epoch_count
         if save_to_dir and not os.path.exists(save_to_dir):
             os.makedirs(save_to_dir)
-        super(DAIterator, self).__init__(batch_size, shuffle)
+        super(DAIterator, self).__init__(batch_size, shuffle, streaming)
 
     def da_args(self):
         kwargs = {'preprocessor': self.preprocessor, 'w': self.w, 'h': self.h, 'is_training': self.is_training,
                   'fill_mode': self.fill_mode, 'fill_mode_cval': self.fill_mode_cval, 'standardizer': self.standardizer,
-                  'save_to_dir': self.save_to_dir}
+                  'save_to_dir': self.save_to_dir, 'cache': self.image_cache}
         if self.crop_bbox is not None:
             assert not self.is_training, "crop bbox only in validation/prediction mode"
             kwargs['bbox'] = self.crop_bbox
@@ -113,9 +217,47 @@ class DAIterator(BatchIterator):
             kwargs['aug_params'] = self.aug_params
         return kwargs
 
+    def batches(self, batch_size=None):
+        if getattr(self, 'num_variants', None) and batch_size is None:
+            batch_size = max(1, self.batch_size // self.num_variants)
+        return super(DAIterator, self).batches(batch_size)
+
+    def variant_args(self):
+        """Loader and its kwargs for the several crops or transforms of an image
+
+        Returns:
+            a tuple of the per image loader, the batch loader and their kwargs
+        """
+        assert not self.is_training, "crop bbox and transforms only in validation/prediction mode"
+        kwargs = {'preprocessor': self.preprocessor, 'w': self.w, 'h': self.h, 'standardizer': self.standardizer,
+                  'cache': self.image_cache}
+        if self.crop_bbox is not None:
+            kwargs['bboxes'] = self.crop_bbox
+            return data.load_crops, data.load_multi_crop_images, kwargs
+        kwargs.update({'transforms': self.xform, 'color_vecs': self.color_vecs, 'fill_mode': self.fill_mode,
+                       'fill_mode_cval': self.fill_mode_cval})
+        return data.load_transformed, data.load_multi_transform_images, kwargs
+
+    def rng_keys(self, n):
+        """Random stream keys of the next batch's samples, None without a seed"""
+        batch = self.batch_count
+        self.batch_count += 1
+        if self.seed is None:
+            return None
+        return [(self.seed, self.epoch, batch, i) for i in range(n)]
+
     def transform(self, Xb, yb):
         fnames, labels = Xb, yb
-        Xb = data.load_augmented_images(fnames, **self.da_args())
+        if self.num_variants is not None:
+            _, load_batch, kwargs = self.variant_args()
+            Xb = load_batch(fnames, **kwargs)
+            return Xb, np.repeat(labels, self.num_variants, axis=0) if labels is not None else None
+        keys = self.rng_keys(len(fnames))
+        rngs = [data.sample_rng(key) for key in keys] if keys is not None else None
+        if self.batch_warp:
+            Xb = data.load_augmented_images_batch(fnames, rngs=rngs, **self.da_args())
+        else:
+            Xb = data.load_augmented_images(fnames, rngs=rngs, **self.da_args())
         return Xb, labels
 
 
@@ -126,100 +268,254 @@ class QueuedDAIterator(QueuedMixin, DAIterator):
 pool_process_seed = None
 
 
-def load_shared(args):
-    import os
-    i, array_name, fname, kwargs = args
-    array = SharedArray.attach(array_name)
+def seed_pool_process():
     global pool_process_seed
     if not pool_process_seed:
         pool_process_seed = os.getpid()
         # print("random seed: %d in pid %d" % (pool_process_seed, os.getpid()))
         np.random.seed(pool_process_seed)
-    array[i] = data.load_augment(fname, **kwargs)
+
+
+attached_arrays = {}
+
+
+def attach_shared(array_name):
+    # shared slabs live as long as their iterator, attach once per worker process
+    array = attached_arrays.get(array_name)
+    if array is None:
+        array = attached_arrays[array_name] = SharedArray.attach(array_name)
+    return array
+
+
+def load_shared(args):
+    i, array_name, fname, kwargs, key = args
+    array = attach_shared(array_name)
+    if key is None:
+        seed_pool_process()
+        rng = None
+    else:
+        rng = data.sample_rng(key)
+    array[i] = data.load_augment(fname, rng=rng, **kwargs)
+
+
+def load_shared_batch(args):
+    start, array_name, fnames, kwargs, keys = args
+    array = attach_shared(array_name)
+    if keys is None:
+        seed_pool_process()
+        rngs = None
+    else:
+        rngs = [data.sample_rng(key) for key in keys]
+    array[start:start + len(fnames)] = data.load_augmented_images_batch(fnames, rngs=rngs, **kwargs)
+
+
+def load_shared_variants(args):
+    i, array_name, fname, num_variants, load, kwargs = args
+    array = attach_shared(array_name)
+    load(fname, out=array[i * num_variants:(i + 1) * num_variants], **kwargs)
 
 
 class ParallelDAIterator(QueuedDAIterator):
+    """Data augmentation iterator using a pool of worker processes
+
+    Workers write augmented batches into a ring of pre-allocated shared memory
+    slabs, each of shape [batch_size, w, h, 3].
+
+    Args:
+        num_slabs: int, number of shared memory batch slabs in the ring; bounds
+            how many batches can be augmented ahead of the consumer
+        zero_copy: bool, if True batches are handed out as views of the shared
+            slabs instead of copies. A slab goes back to the ring when the next
+            batch is requested, so a batch must not be used after that
+            (e.g. collected in a list).
+        prefetch: int, if > 0, keep that many batches in flight in the pool on
+            top of the one being waited for, submitted with `map_async` and
+            yielded in order, instead of augmenting one batch at a time in the
+            queue thread. The ring is grown to `prefetch + 2` slabs if needed.
+    """
 
     def __init__(self, batch_size, shuffle, preprocessor, crop_size, is_training,
                  aug_params=data.no_augmentation_params, fill_mode='constant', fill_mode_cval=0, standardizer=None,
-                 save_to_dir=None):
-        self.pool = multiprocessing.Pool()
+                 save_to_dir=None, batch_warp=False, num_slabs=3, zero_copy=False, prefetch=0, image_cache=None,
+                 seed=None, epoch_count=0, streaming=False):
+        self.num_workers = multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.num_workers)
         super(ParallelDAIterator, self).__init__(batch_size, shuffle, preprocessor, crop_size, is_training, aug_params,
-                                                 fill_mode, fill_mode_cval, standardizer, save_to_dir)
+                                                 fill_mode, fill_mode_cval, standardizer, save_to_dir, batch_warp,
+                                                 image_cache, seed, epoch_count, streaming)
+        if image_cache is not None:
+            # every worker keeps its own LRU, within a share of the cache budget
+            image_cache.attach_workers(self.num_workers)
+        self.zero_copy = zero_copy
+        self.prefetch = prefetch
+        if prefetch > 0:
+            # prefetch + 1 batches in the pool, one held by the consumer
+            num_slabs = max(num_slabs, prefetch + 2)
+        self.slab_names = []
+        self.slabs = []
+        for _ in range(num_slabs):
+            name = str(uuid4())
+            self.slabs.append(SharedArray.create(name, [batch_size, self.w, self.h, 3], dtype=np.float32))
+            self.slab_names.append(name)
+        self.free_slabs = Queue.Queue()
+        for i in range(num_slabs):
+            self.free_slabs.put(i)
+        self.used_slabs = collections.deque()
 
-    def transform(self, Xb, yb):
-        shared_array_name = str(uuid4())
+    def __iter__(self):
+        if self.prefetch > 0:
+            return self._prefetch_iter()
+        return super(ParallelDAIterator, self).__iter__()
+
+    def _prefetch_iter(self):
+        pending = collections.deque()
         try:
-            shared_array = SharedArray.create(
-                shared_array_name, [len(Xb), self.w, self.h, 3], dtype=np.float32)
+            for Xb, yb in self.batches():
+                pending.append(self.submit(Xb, yb))
+                if len(pending) > self.prefetch:
+                    try:
+                        yield self.queue_item(*self.collect(pending.popleft()))
+                    finally:
+                        self.batch_consumed()
+            while pending:
+                try:
+                    yield self.queue_item(*self.collect(pending.popleft()))
+                finally:
+                    self.batch_consumed()
+        finally:
+            # iteration abandoned early, wait for the workers before reusing their slabs
+            while pending:
+                self.queue_item(*self.collect(pending.popleft()))
+                self.batch_consumed()
 
-            fnames, labels = Xb, yb
-            args = []
-            da_args = self.da_args()
+    def transform(self, Xb, yb):
+        return self.collect(self.submit(Xb, yb))
+
+    def submit(self, Xb, yb):
+        """Starts augmenting a batch in the pool
+
+        Returns:
+            a handle to pass to `collect`
+        """
+        slab = self.free_slabs.get()
+        self.used_slabs.append(slab)
+        shared_array_name = self.slab_names[slab]
+
+        # raw batches may live in a reused buffer (streaming), while ours are still in flight
+        fnames = np.array(Xb)
+        labels = np.array(yb) if yb is not None else None
+        args = []
+        if self.num_variants is not None:
+            # variants are written straight into the slab, num_variants rows per image
+            if self.num_variants > self.batch_size:
+                raise ValueError('%d crops/transforms per image do not fit in a batch of %d' %
+                                 (self.num_variants, self.batch_size))
+            load, _, kwargs = self.variant_args()
+            for i, fname in enumerate(fnames):
+                args.append((i, shared_array_name, fname, self.num_variants, load, kwargs))
+            if labels is not None:
+                labels = np.repeat(labels, self.num_variants, axis=0)
+            result = self.pool.map_async(load_shared_variants, args)
+            return result, slab, len(fnames) * self.num_variants, labels
+        da_args = self.da_args()
+        keys = self.rng_keys(len(fnames))
+        if self.batch_warp:
+            # one contiguous chunk of the batch per worker, warped in a single call
+            chunk_size = (len(fnames) + self.num_workers - 1) // self.num_workers
+            for start in range(0, len(fnames), chunk_size):
+                chunk_keys = keys[start:start + chunk_size] if keys is not None else None
+                args.append((start, shared_array_name, fnames[start:start + chunk_size], da_args, chunk_keys))
+            result = self.pool.map_async(load_shared_batch, args)
+        else:
             for i, fname in enumerate(fnames):
-                args.append((i, shared_array_name, fname, da_args))
+                args.append((i, shared_array_name, fname, da_args, keys[i] if keys is not None else None))
+            result = self.pool.map_async(load_shared, args)
+        return result, slab, len(fnames), labels
 
-            self.pool.map(load_shared, args)
-            Xb = np.array(shared_array, dtype=np.float32)
+    def collect(self, handle):
+        """Waits for a batch started by `submit`
 
-        finally:
-            SharedArray.delete(shared_array_name)
+        Returns:
+            the augmented batch, a view of its shared slab, and its labels
+        """
+        result, slab, n, labels = handle
+        result.get()
+        Xb = self.slabs[slab][:n]
 
         # if labels is not None:
         #     labels = labels[:, np.newaxis]
 
         return Xb, labels
 
+    def queue_item(self, Xb, yb):
+        if self.zero_copy:
+            return Xb, np.array(yb)
+        item = super(ParallelDAIterator, self).queue_item(Xb, yb)
+        self.free_slabs.put(self.used_slabs.popleft())
+        return item
+
+    def batch_consumed(self):
+        if self.zero_copy:
+            self.free_slabs.put(self.used_slabs.popleft())
+
+    def __del__(self):
+        if getattr(self, 'image_cache', None) is not None:
+            self.image_cache.detach_workers(self.num_workers)
+        for name in getattr(self, 'slab_names', []):
+            try:
+                SharedArray.delete(name)
+            except OSError:
+                pass
+
+
+class BalancingMixin(object):
+
+    def __call__(self, X, y=None):
+        if y is not None:
+            # the DA iterator shuffles the balanced indices anyway
+            indices = self.sampler.sample(y, shuffle=not self.shuffle)
+            X = X[indices]
+            y = y[indices]
+        return super(BalancingMixin, self).__call__(X, y)
+
+    @property
+    def count(self):
+        return self.sampler.count
 
-class BalancingDAIterator(ParallelDAIterator):
+
+class BalancingDAIterator(BalancingMixin, ParallelDAIterator):
 
     def __init__(
             self, batch_size, shuffle, preprocessor, crop_size, is_training,
             balance_weights, final_balance_weights, balance_ratio, balance_epoch_count=0,
             aug_params=data.no_augmentation_params,
-            fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None):
-        self.count = balance_epoch_count
+            fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None, batch_warp=False,
+            num_slabs=3, zero_copy=False, prefetch=0, image_cache=None, seed=None, streaming=False):
         self.balance_weights = balance_weights
         self.final_balance_weights = final_balance_weights
         self.balance_ratio = balance_ratio
+        self.sampler = data.BalancedClassSampler(balance_weights, final_balance_weights, balance_ratio,
+                                                 balance_epoch_count)
         super(BalancingDAIterator, self).__init__(batch_size, shuffle, preprocessor, crop_size, is_training, aug_params,
-                                                  fill_mode, fill_mode_cval, standardizer, save_to_dir)
-
-    def __call__(self, X, y=None):
-        if y is not None:
-            alpha = self.balance_ratio ** self.count
-            class_weights = self.balance_weights * alpha + \
-                self.final_balance_weights * (1 - alpha)
-            self.count += 1
-            indices = data.balance_per_class_indices(y, weights=class_weights)
-            X = X[indices]
-            y = y[indices]
-        return super(BalancingDAIterator, self).__call__(X, y)
+                                                  fill_mode, fill_mode_cval, standardizer, save_to_dir, batch_warp,
+                                                  num_slabs, zero_copy, prefetch, image_cache, seed,
+                                                  balance_epoch_count, streaming)
 
 
-# Todo remove code duplication with BalancingDAIterator (call method)
-class BalancingQueuedDAIterator(QueuedDAIterator):
+class BalancingQueuedDAIterator(BalancingMixin, QueuedDAIterator):
 
     def __init__(
             self, batch_size, shuffle, preprocessor, crop_size, is_training,
             balance_weights, final_balance_weights, balance_ratio, balance_epoch_count=0,
             aug_params=data.no_augmentation_params,
-            fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None):
-        self.count = balance_epoch_count
+            fill_mode='constant', fill_mode_cval=0, standardizer=None, save_to_dir=None, batch_warp=False,
+            image_cache=None, seed=None, streaming=False):
         self.balance_weights = balance_weights
         self.final_balance_weights = final_balance_weights
         self.balance_ratio = balance_ratio
+        self.sampler = data.BalancedClassSampler(balance_weights, final_balance_weights, balance_ratio,
+                                                 balance_epoch_count)
         super(BalancingQueuedDAIterator, self).__init__(batch_size, shuffle, preprocessor, crop_size, is_training,
                                                         aug_params, fill_mode, fill_mode_cval, standardizer,
-                                                        save_to_dir)
-
-    def __call__(self, X, y=None):
-        if y is not None:
-            alpha = self.balance_ratio ** self.count
-            class_weights = self.balance_weights * alpha + \
-                self.final_balance_weights * (1 - alpha)
-            self.count += 1
-            indices = data.balance_per_class_indices(y, weights=class_weights)
-            X = X[indices]
-            y = y[indices]
-        return super(BalancingQueuedDAIterator, self).__call__(X, y)
+                                                        save_to_dir, batch_warp, image_cache, seed,
+                                                        balance_epoch_count, streaming)
@@ -22,9 +22,12 @@ class NoDAMixin(object):
 class NoOpStandardizer(NoDAMixin):
     """No operation class"""
 
-    def __call__(self, img, is_training):
+    def __call__(self, img, is_training, rng=np.random):
         return img
 
+    def standardize_batch(self, imgs, is_training, channels_last=True, rngs=None):
+        return imgs
+
 
 class SamplewiseStandardizer(NoDAMixin):
     """Samplewise Standardizer
@@ -41,7 +44,7 @@ class SamplewiseStandardizer(NoDAMixin):
         self.channel_wise = channel_wise
         super(SamplewiseStandardizer, self).__init__()
 
-    def __call__(self, img, is_training):
+    def __call__(self, img, is_training, rng=np.random):
         if self.channel_wise:
             img_mean = img.mean(axis=(1, 2))
             img_std = img.std(axis=(1, 2))
@@ -56,6 +59,29 @@ class SamplewiseStandardizer(NoDAMixin):
         np.clip(img, -self.clip, self.clip, out=img)
         return img
 
+    def standardize_batch(self, imgs, is_training, channels_last=True, rngs=None):
+        """Standardize a batch of images in place
+
+        Args:
+            imgs: 4-D float array, (N, H, W, C) or (N, C, H, W) batch of images
+            is_training: bool, if True then training else validation
+            channels_last: bool, layout of `imgs`, (N, H, W, C) if True
+            rngs: unused, per image random number generators
+
+        Returns:
+            the standardized `imgs`
+        """
+        if self.channel_wise:
+            axis = (1, 2) if channels_last else (2, 3)
+        else:
+            axis = (1, 2, 3)
+        img_mean = imgs.mean(axis=axis, keepdims=True)
+        img_std = imgs.std(axis=axis, keepdims=True)
+        np.subtract(imgs, img_mean, out=imgs)
+        np.divide(imgs, img_std + 1e-4, out=imgs)
+        np.clip(imgs, -self.clip, self.clip, out=imgs)
+        return imgs
+
 
 class AggregateStandardizer(object):
     """Aggregate Standardizer
@@ -87,35 +113,74 @@ class AggregateStandardizer(object):
     def set_tta_args(self, **kwargs):
         self.color_vec = kwargs['color_vec']
 
-    def __call__(self, img, is_training):
+    def __call__(self, img, is_training, rng=np.random):
         np.subtract(img, self.mean[:, np.newaxis, np.newaxis], out=img)
         np.divide(img, self.std[:, np.newaxis, np.newaxis], out=img)
         if is_training:
-            img = self.augment_color(img, sigma=self.sigma)
+            img = self.augment_color(img, sigma=self.sigma, rng=rng)
         else:
             # tta (test time augmentation)
             img = self.augment_color(img, color_vec=self.color_vec)
         return img
 
-    def augment_color(self, img, sigma=0.0, color_vec=None):
+    def augment_color(self, img, sigma=0.0, color_vec=None, rng=np.random):
         """Augment color
 
         Args:
             img: input image
             sigma: a float, noise factor
             color_vec: an optional color vec
+            rng: an instance for random number generation
 
         """
         if color_vec is None:
             if not sigma > 0.0:
                 color_vec = np.zeros(3, dtype=np.float32)
             else:
-                color_vec = np.random.normal(0.0, sigma, 3)
+                color_vec = rng.normal(0.0, sigma, 3)
 
         alpha = color_vec.astype(np.float32) * self.ev
         noise = np.dot(self.u, alpha.T)
         return img + noise[:, np.newaxis, np.newaxis]
 
+    def standardize_batch(self, imgs, is_training, channels_last=True, rngs=None):
+        """Standardize a batch of images in place
+
+        Same as calling the standardizer on every image, with the color noise
+        of all images added at once.
+
+        Args:
+            imgs: 4-D float array, (N, H, W, C) or (N, C, H, W) batch of images
+            is_training: bool, if True then training else validation
+            channels_last: bool, layout of `imgs`, (N, H, W, C) if True
+            rngs: an optional sequence of per image random number generators
+                for the color noise; the global numpy state is used by default
+
+        Returns:
+            the standardized `imgs`
+        """
+        shape = (1, 1, 1, 3) if channels_last else (1, 3, 1, 1)
+        np.subtract(imgs, self.mean.reshape(shape), out=imgs)
+        np.divide(imgs, self.std.reshape(shape), out=imgs)
+        if is_training:
+            color_vecs = self._batch_color_vecs(len(imgs), sigma=self.sigma, rngs=rngs)
+        else:
+            # tta (test time augmentation)
+            color_vecs = self._batch_color_vecs(len(imgs), color_vec=self.color_vec)
+        noise = np.dot(color_vecs.astype(np.float32) * self.ev, self.u.T)
+        noise_shape = (len(imgs), 1, 1, 3) if channels_last else (len(imgs), 3, 1, 1)
+        np.add(imgs, noise.reshape(noise_shape), out=imgs, casting='unsafe')
+        return imgs
+
+    def _batch_color_vecs(self, n, sigma=0.0, color_vec=None, rngs=None):
+        if color_vec is not None:
+            return np.tile(color_vec, (n, 1))
+        if not sigma > 0.0:
+            return np.zeros((n, 3), dtype=np.float32)
+        if rngs is not None:
+            return np.array([rng.normal(0.0, sigma, 3) for rng in rngs])
+        return np.random.normal(0.0, sigma, (n, 3))
+
 
 class AggregateStandardizerTF(object):
     """Aggregate Standardizer
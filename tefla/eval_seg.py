@@ -1,4 +1,6 @@
+import collections
 import os
+import multiprocessing
 import click
 import numpy as np
 import cv2
@@ -13,6 +15,7 @@ from skimage import transform
 from skimage.util import img_as_float
 
 from tefla.core.iter_ops import create_prediction_iter, convert_preprocessor
+from tefla.core.metrics import ConfusionMatrixAccumulator, compute_hist
 from tefla.core.prediction_v2 import SegmentPredictor_v2 as SegmentPredictor
 from tefla.da import data
 from tefla.utils import util
@@ -22,16 +25,13 @@ from tefla.convert_labels import convert_labels
 import tensorflow as tf
 
 
-def fast_hist(a, b, n):
-    k = (a >= 0) & (a < n)
-    return np.bincount(n * a[k].astype(int) + b[k], minlength=n**2).reshape(n, n)
-
-
-def compute_hist(gt, preds, num_classes=15):
-    hist = np.zeros((num_classes, num_classes))
-    hist += fast_hist(np.reshape(gt, (-1)),
-                      np.reshape(preds, (-1)), num_classes)
-    return hist
+def image_hist(args):
+    """Loads the ground truth of an image and returns its confusion matrix with the prediction"""
+    prediction, gt_name, image_size, num_classes = args
+    gt = convert(gt_name, image_size)
+    gt = np.asarray(gt)
+    gt = convert_labels(gt, image_size, image_size)
+    return compute_hist(prediction, gt, num_classes=num_classes)
 
 
 @click.command()
@@ -47,8 +47,13 @@ def compute_hist(gt, preds, num_classes=15):
 @click.option('--output_path', default='/tmp/test', help='Output Dir to save the segmented image')
 @click.option('--gpu_memory_fraction', default=0.92, show_default=True,
               help='GPU memory fraction to use.')
+@click.option('--num_workers', default=None, type=int, show_default=True,
+              help='Number of processes computing the confusion matrices, defaults to the number of cpus.')
 def predict(frozen_model, training_cnf, predict_dir, image_size, output_path, num_classes,
-            gpu_memory_fraction):
+            gpu_memory_fraction, num_workers):
+    # the workers are forked before any session exists
+    num_workers = num_workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(num_workers)
     cnf = util.load_module(training_cnf).cnf
     standardizer = cnf['standardizer']
     graph = util.load_frozen_graph(frozen_model)
@@ -57,20 +62,39 @@ def predict(frozen_model, training_cnf, predict_dir, image_size, output_path, nu
     # images = data.get_image_files(predict_dir)
     image_names = [filename.strip() for filename in os.listdir(
         predict_dir) if filename.endswith('.jpg')]
-    hist = np.zeros((num_classes, num_classes))
-    for image_filename in image_names:
-        final_prediction_map = predictor.predict(
-            os.path.join(predict_dir, image_filename))
-        final_prediction_map = final_prediction_map.transpose(0, 2, 1).squeeze()
-        gt_name = os.path.join(predict_dir,
-                               image_filename[:-4] + '_final_mask' + '.png')
-        gt = convert(gt_name, image_size)
-        gt = np.asarray(gt)
-        gt = convert_labels(gt, image_size, image_size)
-        hist += compute_hist(gt, final_prediction_map, num_classes=num_classes)
-    iou = np.diag(hist) / (hist.sum(1) + hist.sum(0) - np.diag(hist))
-    meaniou = np.nanmean(iou)
-    print('Mean IOU %5.5f' % meaniou)
+
+    # predictions run in this thread while the workers load the ground truths,
+    # at most two images per worker are in flight and only the small per image
+    # confusion matrices come back
+    max_pending = 2 * num_workers
+    pending = collections.deque()
+    accumulator = ConfusionMatrixAccumulator(num_classes)
+    try:
+        for image_filename in image_names:
+            final_prediction_map = predictor.predict(
+                os.path.join(predict_dir, image_filename))
+            final_prediction_map = final_prediction_map.transpose(0, 2, 1).squeeze()
+            # class labels, no need to pickle them as int64
+            final_prediction_map = final_prediction_map.astype(np.min_scalar_type(num_classes))
+            gt_name = os.path.join(predict_dir,
+                                   image_filename[:-4] + '_final_mask' + '.png')
+            pending.append(pool.apply_async(image_hist, ((final_prediction_map, gt_name, image_size, num_classes),)))
+            if len(pending) >= max_pending:
+                accumulator.merge(pending.popleft().get())
+        while pending:
+            accumulator.merge(pending.popleft().get())
+    except Exception:
+        pool.terminate()
+        raise
+    finally:
+        predictor.close()
+    pool.close()
+    pool.join()
+    results = accumulator.compute()
+    print('Per class IOU %s' % np.array2string(results['per_class_iou'], precision=5))
+    print('Mean IOU %5.5f' % results['mean_iou'])
+    print('Pixel accuracy %5.5f' % results['pixel_accuracy'])
+    print('Frequency weighted IOU %5.5f' % results['freq_weighted_iou'])
 
 
 if __name__ == '__main__':
@@ -100,8 +100,8 @@ def predict(frozen_model, training_cnf, image_path, image_size, output_path,
     standardizer = cnf['standardizer']
     graph = util.load_frozen_graph(frozen_model)
     preprocessor = convert_preprocessor(448)
-    predictor = SegmentPredictor(graph, standardizer, preprocessor)
-    final_prediction_map = predictor.predict(image_path)
+    with SegmentPredictor(graph, standardizer, preprocessor) as predictor:
+        final_prediction_map = predictor.predict(image_path)
     final_prediction_map = final_prediction_map.transpose(0, 2, 1).squeeze()
     image = data.load_image(image_path, preprocessor=preprocessor)
     img = image.transpose(2, 1, 0)
@@ -0,0 +1,47 @@
+import click
+
+from tefla.core.iter_ops import convert_preprocessor
+from tefla.core.prediction_v2 import OneCropPredictor
+from tefla.core.serving import InferenceServer, create_image_loader
+from tefla.utils import util
+
+
+@click.command()
+@click.option('--frozen_model', default=None, show_default=True,
+              help='Relative path to model.')
+@click.option('--training_cnf', default=None, show_default=True,
+              help='Relative path to training config file.')
+@click.option('--crop_size', default=None, type=int, show_default=True,
+              help='Network input size; taken from the input tensor shape if not given.')
+@click.option('--convert', is_flag=True,
+              help='Convert/preprocess files before prediction.')
+@click.option('--image_size', default=256, show_default=True,
+              help='Image size for conversion.')
+@click.option('--host', default='127.0.0.1', show_default=True, help='Interface to listen on.')
+@click.option('--port', default=8080, show_default=True, help='Port to listen on.')
+@click.option('--max_batch_size', default=32, show_default=True,
+              help='Max number of requests predicted in one session run.')
+@click.option('--max_wait_ms', default=5.0, show_default=True,
+              help='Max time a request waits for its batch to fill up.')
+@click.option('--input_tensor_name', default='model/inputs/input:0', show_default=True)
+@click.option('--predict_tensor_name', default='model/predictions/Softmax:0', show_default=True)
+def serve(frozen_model, training_cnf, crop_size, convert, image_size, host, port, max_batch_size, max_wait_ms,
+          input_tensor_name, predict_tensor_name):
+    cnf = util.load_module(training_cnf).cnf
+    standardizer = cnf.get('standardizer', None)
+    graph = util.load_frozen_graph(frozen_model)
+    predictor = OneCropPredictor(graph, None, input_tensor_name, predict_tensor_name)
+    if crop_size is None:
+        crop_size = predictor.inputs.get_shape().as_list()[1]
+    preprocessor = convert_preprocessor(image_size) if convert else None
+    load_input = create_image_loader(preprocessor, (crop_size, crop_size), standardizer)
+    server = InferenceServer(predictor, load_input, host, port, max_batch_size, max_wait_ms)
+    print('Serving predictions on http://%s:%d/predict' % server.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    serve()
@@ -8,7 +8,7 @@ import tensorflow as tf
 
 tf.set_random_seed(127)
 
-from tefla.core.dir_dataset import DataSet
+from tefla.core.dir_dataset import DataSet, MemmapDataSet
 from tefla.core.iter_ops import create_training_iters
 from tefla.core.training import SupervisedTrainer
 from tefla.da.standardizer import NoOpStandardizer
@@ -37,7 +37,9 @@ import logging
               help='Loss fuction type.')
 @click.option('--is_summary', default=False, show_default=True,
               help='Path to initial weights file.')
-def main(model, training_cnf, data_dir, parallel, start_epoch, weights_from, resume_lr, gpu_memory_fraction, is_summary, loss_type):
+@click.option('--packed', default=False, show_default=True,
+              help='Read images from a memory-mapped packed copy of data_dir.')
+def main(model, training_cnf, data_dir, parallel, start_epoch, weights_from, resume_lr, gpu_memory_fraction, is_summary, loss_type, packed):
     model_def = util.load_module(model)
     model = model_def.model
     cnf = util.load_module(training_cnf).cnf
@@ -47,7 +49,10 @@ def main(model, training_cnf, data_dir, parallel, start_epoch, weights_from, res
     if weights_from:
         weights_from = str(weights_from)
 
-    data_set = DataSet(data_dir, model_def.image_size[0])
+    if packed:
+        data_set = MemmapDataSet(data_dir, model_def.image_size[0])
+    else:
+        data_set = DataSet(data_dir, model_def.image_size[0])
     standardizer = cnf.get('standardizer', NoOpStandardizer())
 
     training_iter, validation_iter = create_training_iters(
@@ -2,4 +2,5 @@ from __future__ import absolute_import
 
 # from . import image_utils
 from . import quadratic_weighted_kappa
+from . import tiling
 from . import util
@@ -9,19 +9,21 @@ import numpy as np
 
 def confusion_matrix(rater_a, rater_b, min_rating=None, max_rating=None):
     """
-    Returns the confusion matrix between rater's ratings
+    Returns the confusion matrix between rater's ratings, an int64 `ndarray`
     """
+    rater_a = np.asarray(rater_a, dtype=np.int64).ravel()
+    rater_b = np.asarray(rater_b, dtype=np.int64).ravel()
     assert(len(rater_a) == len(rater_b))
     if min_rating is None:
-        min_rating = min(rater_a + rater_b)
+        min_rating = min(rater_a.min(), rater_b.min())
     if max_rating is None:
-        max_rating = max(rater_a + rater_b)
+        max_rating = max(rater_a.max(), rater_b.max())
     num_ratings = int(max_rating - min_rating + 1)
-    conf_mat = [[0 for i in range(num_ratings)]
-                for j in range(num_ratings)]
-    for a, b in zip(rater_a, rater_b):
-        conf_mat[a - min_rating][b - min_rating] += 1
-    return conf_mat
+    if len(rater_a) and (min(rater_a.min(), rater_b.min()) < min_rating or
+                         max(rater_a.max(), rater_b.max()) > max_rating):
+        raise IndexError('Ratings out of the range [%d, %d]' % (min_rating, max_rating))
+    index = (rater_a - min_rating) * num_ratings + (rater_b - min_rating)
+    return np.bincount(index, minlength=num_ratings ** 2).reshape(num_ratings, num_ratings)
 
 
 def calculate_kappa(y_true, y_pred):
@@ -52,17 +54,55 @@ def calculate_auc(y_true, y_pred):
 
 def histogram(ratings, min_rating=None, max_rating=None):
     """
-    Returns the counts of each type of rating that a rater made
+    Returns the counts of each type of rating that a rater made, an int64 `ndarray`
     """
+    ratings = np.asarray(ratings, dtype=np.int64).ravel()
     if min_rating is None:
-        min_rating = min(ratings)
+        min_rating = ratings.min()
     if max_rating is None:
-        max_rating = max(ratings)
+        max_rating = ratings.max()
     num_ratings = int(max_rating - min_rating + 1)
-    hist_ratings = [0 for x in range(num_ratings)]
-    for r in ratings:
-        hist_ratings[r - min_rating] += 1
-    return hist_ratings
+    return np.bincount(ratings - min_rating, minlength=num_ratings)[:num_ratings]
+
+
+def clean_ratings(ratings, min_rating, max_rating):
+    """
+    Clips the ratings to [min_rating, max_rating] and rounds them to int, non finite ratings become 0
+    """
+    ratings = np.array(ratings, dtype=np.float64).ravel()
+    ratings[~np.isfinite(ratings)] = 0
+    if min_rating is not None or max_rating is not None:
+        ratings = np.clip(ratings, min_rating, max_rating)
+    return np.round(ratings).astype(np.int64)
+
+
+def kappa_from_confusion_matrix(conf_mat, zero_division_value=0.999):
+    """
+    Quadratic weighted kappa of a confusion matrix between two raters
+
+    The expected matrix is the outer product of the rater histograms, i.e. the
+    confusion matrix row and column sums.
+
+    Args:
+        conf_mat: 2D array, confusion matrix
+        zero_division_value: float, returned when the kappa is undefined, e.g.
+            a single rating or a constant rater
+
+    Returns:
+        the kappa score
+    """
+    conf_mat = np.asarray(conf_mat, dtype=np.float64)
+    num_ratings = conf_mat.shape[0]
+    num_scored_items = conf_mat.sum()
+    if num_ratings < 2 or num_scored_items == 0:
+        return zero_division_value
+    ratings = np.arange(num_ratings)
+    weights = np.subtract.outer(ratings, ratings) ** 2 / float((num_ratings - 1) ** 2)
+    expected = np.outer(conf_mat.sum(axis=1), conf_mat.sum(axis=0)) / num_scored_items
+    denominator = (weights * expected).sum()
+    if denominator == 0:
+        return zero_division_value
+    return 1.0 - (weights * conf_mat).sum() / denominator
 
 
 def quadratic_weighted_kappa(rater_a, rater_b, min_rating=0, max_rating=4):
@@ -86,38 +126,7 @@ def quadratic_weighted_kappa(rater_a, rater_b, min_rating=0, max_rating=4):
     is the minimum possible rating, and max_rating is the maximum possible
     rating
     """
-    rater_a = np.clip(rater_a, min_rating, max_rating)
-    rater_b = np.clip(rater_b, min_rating, max_rating)
-
-    rater_a = np.round(rater_a).astype(int).ravel()
-    rater_a[~np.isfinite(rater_a)] = 0
-    rater_b = np.round(rater_b).astype(int).ravel()
-    rater_b[~np.isfinite(rater_b)] = 0
-
+    rater_a = clean_ratings(rater_a, min_rating, max_rating)
+    rater_b = clean_ratings(rater_b, min_rating, max_rating)
     assert(len(rater_a) == len(rater_b))
-    if min_rating is None:
-        min_rating = min(min(rater_a), min(rater_b))
-    if max_rating is None:
-        max_rating = max(max(rater_a), max(rater_b))
-    conf_mat = confusion_matrix(rater_a, rater_b,
-                                min_rating, max_rating)
-    num_ratings = len(conf_mat)
-    num_scored_items = float(len(rater_a))
-
-    hist_rater_a = histogram(rater_a, min_rating, max_rating)
-    hist_rater_b = histogram(rater_b, min_rating, max_rating)
-
-    numerator = 0.0
-    denominator = 0.0
-
-    for i in range(num_ratings):
-        for j in range(num_ratings):
-            expected_count = (hist_rater_a[i] * hist_rater_b[j]
-                              / num_scored_items)
-            d = pow(i - j, 2.0) / pow(num_ratings - 1, 2.0)
-            numerator += d * conf_mat[i][j] / num_scored_items
-            denominator += d * expected_count / num_scored_items
-    try:
-        return 1.0 - numerator / denominator
-    except ZeroDivisionError:
-        return 0.999
+    return kappa_from_confusion_matrix(confusion_matrix(rater_a, rater_b, min_rating, max_rating))
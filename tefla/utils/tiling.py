@@ -0,0 +1,93 @@
+"""Sliding window tiled inference for large images"""
+from __future__ import division, print_function, absolute_import
+
+import numpy as np
+
+
+def tile_starts(length, tile, overlap=0):
+    """Start offsets of the tiles covering an axis
+
+    The tiles are `tile - overlap` apart, the last one being aligned with the end.
+
+    Args:
+        length: int, axis length
+        tile: int, tile length
+        overlap: int, min number of pixels shared by two neighbouring tiles
+
+    Returns:
+        a list of start offsets
+    """
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    if stride <= 0:
+        raise ValueError('Tile overlap %d must be smaller than the tile size %d' % (overlap, tile))
+    return list(range(0, length - tile, stride)) + [length - tile]
+
+
+def gaussian_weights(tile_shape, sigma_scale=0.125, min_weight=1e-3):
+    """Blending weights of a tile, highest at its center
+
+    Args:
+        tile_shape: tuple, (rows, cols)
+        sigma_scale: float, standard deviation of the gaussian relative to the tile size
+        min_weight: float, floor of the weights, so that every pixel counts
+
+    Returns:
+        a (rows, cols) `ndarray` with max 1
+    """
+    rows, cols = tile_shape
+    r = (np.arange(rows) - (rows - 1) / 2.0) / (sigma_scale * rows)
+    c = (np.arange(cols) - (cols - 1) / 2.0) / (sigma_scale * cols)
+    weights = np.exp(-0.5 * (r[:, np.newaxis] ** 2 + c[np.newaxis, :] ** 2))
+    return np.maximum(weights / weights.max(), min_weight)
+
+
+def predict_tiled(img, predict_batch, tile_size, overlap=0, batch_size=8, blend='gaussian'):
+    """Predicts an image of any size tile by tile and stitches the outputs
+
+    Images smaller than a tile are zero padded. Overlapping outputs, e.g. logits,
+    are blended with per tile weights.
+
+    Args:
+        img: `ndarray`, (rows, cols, C) network input
+        predict_batch: callable, maps a (N, tile rows, tile cols, C) batch of tiles
+            to (N, tile rows, tile cols, K) outputs
+        tile_size: int or tuple(rows, cols), tile size
+        overlap: int, min number of pixels shared by two neighbouring tiles
+        batch_size: int, number of tiles per `predict_batch` call
+        blend: string, tile weights for the blending, `gaussian` or `mean`
+
+    Returns:
+        a (rows, cols, K) `ndarray` of blended outputs
+    """
+    if blend not in ('gaussian', 'mean'):
+        raise ValueError('Unknown blending: %s' % blend)
+    tile_rows, tile_cols = (tile_size, tile_size) if np.isscalar(tile_size) else tile_size
+    rows, cols = img.shape[:2]
+    pad = ((0, max(tile_rows - rows, 0)), (0, max(tile_cols - cols, 0))) + ((0, 0),) * (img.ndim - 2)
+    if pad[0][1] or pad[1][1]:
+        img = np.pad(img, pad, mode='constant')
+    positions = [(r, c) for r in tile_starts(img.shape[0], tile_rows, overlap)
+                 for c in tile_starts(img.shape[1], tile_cols, overlap)]
+    if blend == 'gaussian':
+        weights = gaussian_weights((tile_rows, tile_cols))
+    else:
+        weights = np.ones((tile_rows, tile_cols))
+
+    stitched = None
+    weight_sum = np.zeros(img.shape[:2])
+    for start in range(0, len(positions), batch_size):
+        batch_positions = positions[start:start + batch_size]
+        tiles = np.array([img[r:r + tile_rows, c:c + tile_cols] for r, c in batch_positions])
+        outputs = predict_batch(tiles)
+        if outputs.shape[1:3] != (tile_rows, tile_cols):
+            raise ValueError('Tile outputs of shape %s do not match the tile size %s' %
+                             (outputs.shape[1:3], (tile_rows, tile_cols)))
+        if stitched is None:
+            stitched = np.zeros(img.shape[:2] + outputs.shape[3:], dtype=np.float32)
+        for (r, c), output in zip(batch_positions, outputs):
+            stitched[r:r + tile_rows, c:c + tile_cols] += output * weights[:, :, np.newaxis]
+            weight_sum[r:r + tile_rows, c:c + tile_cols] += weights
+    stitched /= weight_sum[:, :, np.newaxis]
+    return stitched[:rows, :cols]
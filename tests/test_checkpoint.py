@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from tefla.core.checkpoint import CheckpointManager
+
+
+@pytest.fixture(autouse=True)
+def _reset_graph():
+    tf.reset_default_graph()
+
+
+def test_checkpoint_manager_writes_and_prunes(tmpdir):
+    weights = tf.Variable(np.zeros((3, 4), dtype=np.float32), name='weights')
+    step = tf.Variable(0, name='step')
+    increment = [tf.assign_add(weights, tf.ones((3, 4))), tf.assign_add(step, 1)]
+    losses = {1: 0.5, 2: 0.2, 3: 0.4, 4: 0.6, 5: 0.7}
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        checkpoints = CheckpointManager(weights_dir=str(tmpdir), keep_best=1, keep_last=2)
+        for epoch in range(1, 6):
+            sess.run(increment)
+            checkpoints.save(sess, epoch, {'validation_loss': losses[epoch]})
+        checkpoints.close()
+        assert sorted(checkpoints.checkpoints) == [2, 4, 5]
+        assert len(checkpoints.write_times) == 5
+        assert checkpoints.best_checkpoint() == os.path.join(str(tmpdir), 'model-epoch-2.ckpt')
+        assert not [fname for fname in os.listdir(str(tmpdir)) if fname.startswith('model-epoch-3.ckpt')]
+
+        tf.train.Saver().restore(sess, checkpoints.best_checkpoint())
+        np.testing.assert_array_equal(sess.run(weights), np.full((3, 4), 2, dtype=np.float32))
+        assert sess.run(step) == 2
+
+
+def test_checkpoint_manager_keeps_all_by_default(tmpdir):
+    tf.Variable(1.0, name='v')
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        checkpoints = CheckpointManager(weights_dir=str(tmpdir), metric='validation kappa', mode='max')
+        for epoch in range(1, 4):
+            checkpoints.save(sess, epoch, CheckpointManager.epoch_metrics(
+                {'epoch': epoch, 'validation_loss': 1.0, 'validation_metrics': {'validation kappa': epoch / 10.0}}))
+        checkpoints.close()
+    assert sorted(checkpoints.checkpoints) == [1, 2, 3]
+    assert checkpoints.best_checkpoint().endswith('model-epoch-3.ckpt')
+
+
+def test_checkpoint_manager_context_writes_on_error(tmpdir):
+    tf.Variable(1.0, name='v')
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        with pytest.raises(RuntimeError):
+            with CheckpointManager(weights_dir=str(tmpdir)) as checkpoints:
+                checkpoints.save(sess, 1)
+                raise RuntimeError('epoch failed')
+    assert sorted(checkpoints.checkpoints) == [1]
+    assert not checkpoints.thread.is_alive()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
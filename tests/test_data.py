@@ -0,0 +1,212 @@
+import gc
+import pickle
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from PIL import Image
+
+from tefla.da import data
+
+aug_params = {
+    'zoom_range': (1 / 1.2, 1.2),
+    'rotation_range': (0, 360),
+    'shear_range': (-10, 10),
+    'translation_range': (-8, 8),
+    'do_flip': True,
+    'allow_stretch': True,
+}
+
+
+@pytest.mark.parametrize('mode', ['constant', 'edge', 'symmetric', 'reflect', 'wrap'])
+@pytest.mark.parametrize('order', [0, 1])
+def test_fast_warp_batch_matches_fast_warp(mode, order):
+    rng = np.random.RandomState(42)
+    imgs = rng.uniform(0, 255, size=(4, 3, 40, 50))
+    tfs = data.build_perturb_matrices(4, (40, 50), aug_params, (32, 36), rng=rng)
+    warped = data.fast_warp_batch(imgs, tfs, (32, 36), mode=mode, mode_cval=7, order=order)
+    expected = np.array([data.fast_warp(img, tf, (32, 36), mode=mode, mode_cval=7, order=order)
+                         for img, tf in zip(imgs, tfs)])
+    assert_array_almost_equal(expected, warped)
+
+
+@pytest.mark.parametrize('allow_stretch', [False, True, 1.2])
+@pytest.mark.parametrize('seed', range(6))
+def test_build_perturb_matrices_matches_transform_chain(allow_stretch, seed):
+    params = dict(aug_params, allow_stretch=allow_stretch)
+    rng = np.random.RandomState(seed)
+    tform_centering = data.build_centering_transform((64, 80), (48, 48))
+    tform_center, tform_uncenter = data.build_center_uncenter_transforms((64, 80))
+    tform_augment = data.random_perturbation_transform(rng=rng, **params)
+    expected = (tform_centering + (tform_uncenter + tform_augment + tform_center)).params
+    matrices = data.build_perturb_matrices(1, (64, 80), params, (48, 48), rng=np.random.RandomState(seed))
+    assert matrices.shape == (1, 3, 3)
+    assert_array_almost_equal(expected, matrices[0])
+
+
+@pytest.mark.parametrize('flip', [False, True])
+def test_build_augmentation_matrices_matches_transform(flip):
+    tform = data.build_augmentation_transform((1.1, 0.9), 30, 12, (2, -3), flip)
+    matrices = data.build_augmentation_matrices(([1.1], [0.9]), [30], [12], ([2], [-3]), [flip])
+    assert_array_almost_equal(tform.params, matrices[0])
+
+
+def test_perturb_rescaled_matches_transform_chain():
+    img = np.random.RandomState(0).uniform(0, 255, size=(3, 64, 80))
+    tform_rescale = data.build_rescale_transform(2.0, (64, 80), (24, 24))
+    tform_center, tform_uncenter = data.build_center_uncenter_transforms((64, 80))
+    tform_augment = data.random_perturbation_transform(rng=np.random.RandomState(5), **aug_params)
+    tform = tform_rescale + (tform_uncenter + tform_augment + tform_center)
+    expected = data.fast_warp(img, tform.params, output_shape=(24, 24))
+    perturbed = data.perturb_rescaled(img, 2.0, aug_params, (24, 24), rng=np.random.RandomState(5))
+    assert_array_almost_equal(expected.astype('float32'), perturbed)
+
+
+def test_load_augmented_images_batch():
+    imgs = np.random.uniform(0, 255, size=(6, 3, 20, 20))
+    tform = data.build_augmentation_transform((1.1, 1.1), 30, 0, (2, -3), False)
+    expected = data.load_augmented_images(imgs, lambda img: img, 16, 16, False, transform=tform)
+    batch = data.load_augmented_images_batch(imgs, lambda img: img, 16, 16, False, transform=tform)
+    assert_array_almost_equal(expected, batch)
+
+
+class ScalingStandardizer(object):
+
+    def __call__(self, img, is_training, rng=np.random):
+        return img / 255. + rng.uniform()
+
+
+class BatchScalingStandardizer(ScalingStandardizer):
+
+    def standardize_batch(self, imgs, is_training, channels_last=True, rngs=None):
+        imgs /= 255.
+        imgs += np.array([rng.uniform() for rng in rngs]).reshape(-1, 1, 1, 1)
+        return imgs
+
+
+@pytest.mark.parametrize('standardizer', [ScalingStandardizer(), BatchScalingStandardizer()])
+def test_load_augmented_images_standardized(standardizer):
+    imgs = np.random.uniform(0, 255, size=(6, 3, 20, 20))
+    expected = np.array([data.load_augment(img, lambda img: img, 16, 16, True, aug_params,
+                                           standardizer=ScalingStandardizer(), rng=np.random.RandomState(i))
+                         for i, img in enumerate(imgs)])
+    for load in (data.load_augmented_images, data.load_augmented_images_batch):
+        rngs = [np.random.RandomState(i) for i in range(len(imgs))]
+        batch = load(imgs, lambda img: img, 16, 16, True, aug_params, standardizer=standardizer, rngs=rngs)
+        assert_array_almost_equal(expected, batch)
+
+
+class ColorShiftStandardizer(object):
+
+    def __init__(self):
+        self.color_vec = None
+
+    def set_tta_args(self, **kwargs):
+        self.color_vec = kwargs['color_vec']
+
+    def __call__(self, img, is_training):
+        return img + self.color_vec[:, np.newaxis, np.newaxis]
+
+
+def test_load_multi_transform_images():
+    imgs = np.random.uniform(0, 255, size=(3, 3, 20, 24))
+    tforms = [data.build_augmentation_transform((1.1, 0.9), rotation, 0, (2, -3), flip)
+              for rotation, flip in [(0, False), (30, True), (200, False)]]
+    color_vecs = np.random.normal(size=(3, 3))
+    standardizer = ColorShiftStandardizer()
+    expected = []
+    for img in imgs:
+        for tform, color_vec in zip(tforms, color_vecs):
+            standardizer.set_tta_args(color_vec=color_vec)
+            expected.append(data.load_augment(img, lambda img: img, 16, 16, False, transform=tform,
+                                              standardizer=standardizer))
+    variants = data.load_multi_transform_images(imgs, lambda img: img, 16, 16, tforms, color_vecs,
+                                                standardizer=standardizer)
+    assert_array_almost_equal(expected, variants, decimal=4)
+    assert_array_almost_equal(variants[3:6], data.load_transformed(imgs[1], lambda img: img, 16, 16, tforms,
+                                                                   color_vecs, standardizer=standardizer))
+
+
+def _write_images(tmpdir, n, size=8):
+    fnames = []
+    for i in range(n):
+        fname = str(tmpdir.join('%d.png' % i))
+        Image.fromarray(np.random.randint(0, 255, size=(size, size, 3)).astype(np.uint8)).save(fname)
+        fnames.append(fname)
+    return fnames
+
+
+class CountingPreprocessor(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, fname):
+        self.calls += 1
+        return data.image_no_preprocessing(fname)
+
+
+def test_decoded_image_cache_memory(tmpdir):
+    fnames = _write_images(tmpdir, 3)
+    preprocessor = CountingPreprocessor()
+    # room for two 8x8x3 images
+    cache = data.DecodedImageCache(max_bytes=2 * 8 * 8 * 3)
+    for fname in fnames + fnames[-1:]:
+        assert_array_equal(data.load_image(fname, preprocessor), data.load_image(fname, preprocessor, cache))
+    assert preprocessor.calls == 4 + 3
+    assert cache.nbytes == 2 * 8 * 8 * 3
+    data.load_image(fnames[0], preprocessor, cache)
+    assert preprocessor.calls == 4 + 3 + 1
+
+
+def test_decoded_image_cache_disk(tmpdir):
+    fnames = _write_images(tmpdir, 2)
+    preprocessor = CountingPreprocessor()
+    cache_dir = str(tmpdir.join('cache'))
+    cache = data.DecodedImageCache(max_bytes=0, cache_dir=cache_dir)
+    first = [data.load_image(f, preprocessor, cache) for f in fnames]
+    second = [data.load_image(f, preprocessor, data.DecodedImageCache(0, cache_dir)) for f in fnames]
+    assert preprocessor.calls == 2
+    assert_array_equal(first, second)
+    assert len(tmpdir.join('cache').listdir()) == 2
+
+
+def test_decoded_image_cache_pickle():
+    cache = data.DecodedImageCache()
+    assert pickle.loads(pickle.dumps(cache)) is cache
+
+
+def test_decoded_image_cache_worker_budget():
+    cache = data.DecodedImageCache(max_bytes=1000)
+    cache.attach_workers(4)
+    cache.attach_workers(4)
+    _, args = cache.__reduce__()
+    assert args[1] == 125
+    cache.detach_workers(4)
+    assert cache.__reduce__()[1][1] == 250
+
+
+def test_decoded_image_cache_released():
+    cache = data.DecodedImageCache()
+    cache_id = cache.cache_id
+    del cache
+    gc.collect()
+    assert cache_id not in data._image_caches
+
+
+def test_balanced_class_sampler():
+    y = np.array([0] * 900 + [1] * 90 + [2] * 10)
+    sampler = data.BalancedClassSampler([1., 10., 90.], [1., 1., 1.], 0.5, rng=np.random.RandomState(0))
+    indices = sampler.sample(y)
+    assert len(indices) == len(y)
+    assert np.all(np.bincount(y[indices], minlength=3) > 200)
+    assert sampler.count == 1
+    for _ in range(30):
+        indices = sampler.sample(y, shuffle=False)
+    # interpolated back to the original class distribution
+    assert_array_equal(np.bincount(y[indices], minlength=3) > [800, 60, 0], [True, True, True])
+    assert np.all(np.diff(y[indices]) >= 0)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+from PIL import Image
+
+from tefla.core.dir_dataset import DataSet, MemmapDataSet
+from tefla.da import data
+
+
+@pytest.fixture
+def data_dir(tmpdir):
+    for split, n in (('training', 5), ('validation', 3)):
+        split_dir = tmpdir.mkdir('%s_8' % split)
+        with open(str(tmpdir.join('%s_labels.csv' % split)), 'w') as f:
+            f.write('image,level\n')
+            for i in range(n):
+                name = '%s_%d' % (split, i)
+                img = np.random.randint(0, 255, size=(8, 8, 3)).astype(np.uint8)
+                Image.fromarray(img).save(str(split_dir.join(name + '.png')))
+                f.write('%s,%d\n' % (name, i % 2))
+    return str(tmpdir)
+
+
+def test_memmap_dataset_matches_dir_dataset(data_dir):
+    dir_data_set = DataSet(data_dir, 8)
+    data_set = MemmapDataSet(data_dir, 8)
+    assert os.path.exists(os.path.join(data_dir, 'packed_8', 'images.npy'))
+    assert data_set.num_training_files() == 5
+    assert data_set.num_validation_files() == 3
+    assert_array_equal(dir_data_set.training_y, data_set.training_y)
+    assert_array_equal(dir_data_set.validation_y, data_set.validation_y)
+    for files, indices in ((dir_data_set.training_X, data_set.training_X),
+                           (dir_data_set.validation_X, data_set.validation_X)):
+        for fname, index in zip(files, indices):
+            assert_array_equal(data.load_image(fname), data.load_image(index, data_set.preprocessor))
+
+
+def test_memmap_dataset_repacks_changed_dir(data_dir):
+    assert MemmapDataSet(data_dir, 8).num_training_files() == 5
+    img = np.random.randint(0, 255, size=(8, 8, 3)).astype(np.uint8)
+    Image.fromarray(img).save(os.path.join(data_dir, 'training_8', 'training_5.png'))
+    with open(os.path.join(data_dir, 'training_labels.csv'), 'a') as f:
+        f.write('training_5,1\n')
+    data_set = MemmapDataSet(data_dir, 8)
+    assert data_set.num_training_files() == 6
+    assert data_set.num_validation_files() == 3
+    assert_array_equal(DataSet(data_dir, 8).training_y, data_set.training_y)
+    assert_array_equal(img, data_set.preprocessor(5))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from tefla.core.base import Base
+from tefla.core.learning import SupervisedLearner
+from tefla.core.learningv2 import SupervisedLearner as QueuedSupervisedLearner
+
+
+@pytest.fixture(autouse=True)
+def _reset_graph():
+    tf.reset_default_graph()
+
+
+def _sgd_setup(accum_steps, clip_by_global_norm=False, max_norm=5):
+    learner = SupervisedLearner(None, {'accum_steps': accum_steps})
+    inputs = tf.placeholder(tf.float32, shape=(None, 2))
+    weights = tf.Variable(np.ones((2, 1), dtype=np.float32))
+    loss = tf.reduce_mean(tf.square(tf.matmul(inputs, weights)))
+    opt = tf.train.GradientDescentOptimizer(0.1)
+    accumulate_op, apply_op = learner._accumulate_gradients(
+        opt.compute_gradients(loss), opt, clip_by_global_norm=clip_by_global_norm, max_norm=max_norm)
+    return inputs, weights, loss, opt, accumulate_op, apply_op
+
+
+def test_accumulated_step_matches_large_batch_step():
+    X = np.random.RandomState(0).rand(6, 2).astype(np.float32)
+    inputs, weights, loss, opt, accumulate_op, apply_op = _sgd_setup(3)
+    large_batch_step = opt.minimize(loss)
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        sess.run(large_batch_step, feed_dict={inputs: X})
+        expected = sess.run(weights)
+
+        sess.run(tf.global_variables_initializer())
+        for Xb in np.split(X, 3):
+            sess.run(accumulate_op, feed_dict={inputs: Xb})
+        np.testing.assert_array_equal(sess.run(weights), np.ones((2, 1)))
+        sess.run(apply_op)
+        np.testing.assert_allclose(sess.run(weights), expected, rtol=1e-5)
+
+        # the accumulators are reset by the optimizer step
+        sess.run(apply_op)
+        np.testing.assert_allclose(sess.run(weights), expected, rtol=1e-5)
+
+
+def test_accumulated_gradients_are_clipped():
+    inputs, weights, _, _, accumulate_op, apply_op = _sgd_setup(2, clip_by_global_norm=True, max_norm=0.5)
+    with tf.Session() as sess:
+        sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+        for _ in range(2):
+            sess.run(accumulate_op, feed_dict={inputs: np.full((4, 2), 10, dtype=np.float32)})
+        sess.run(apply_op)
+        step = np.ones((2, 1)) - sess.run(weights)
+        np.testing.assert_allclose(np.linalg.norm(step), 0.1 * 0.5, rtol=1e-5)
+
+
+def test_accum_steps_must_be_positive():
+    with pytest.raises(ValueError):
+        SupervisedLearner(None, {'accum_steps': 0})
+
+
+def test_accum_steps_rejected_without_support():
+    for learner_cls in (Base, QueuedSupervisedLearner):
+        with pytest.raises(ValueError):
+            learner_cls(None, {'accum_steps': 2})
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
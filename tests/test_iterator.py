@@ -28,6 +28,43 @@ def test_batch_iter_with_shuffle():
     assert_array_equal(data, np.sort(data2, axis=0))
 
 
+def test_batch_iter_streaming_shuffle():
+    data = np.arange(42).reshape(14, 3)
+    labels = np.arange(14)
+    bi = iterator.BatchIterator(4, True, streaming=True)
+    batches = [(np.array(Xb), np.array(yb)) for Xb, yb in bi(data, labels)]
+    data2 = np.vstack([Xb for Xb, _ in batches])
+    labels2 = np.concatenate([yb for _, yb in batches])
+    assert_array_equal([4, 4, 4, 2], [len(Xb) for Xb, _ in batches])
+    assert_array_equal(data[labels2], data2)
+    assert_array_equal(labels, np.sort(labels2))
+    assert_equal(np.any(np.not_equal(labels, labels2)), True)
+
+
+def test_batch_iter_streaming_empty():
+    bi = iterator.BatchIterator(4, True, streaming=True)
+    assert list(bi(np.zeros((0, 3)), np.zeros(0))) == []
+
+
+def test_batch_iter_streaming_list():
+    data = [str(i) for i in range(10)]
+    bi = iterator.BatchIterator(4, True, streaming=True)
+    data2 = np.concatenate([np.array(Xb) for Xb, _ in bi(data)])
+    assert_array_equal(sorted(data), sorted(data2))
+
+
+def test_da_iter_streaming_shuffle():
+    data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+    labels = np.arange(12)
+    dai = iterator.DAIterator(4, True, no_op_preprocessor, (4, 4), is_training=False, streaming=True)
+    batches = [(np.array(Xb), np.array(yb)) for Xb, yb in dai(data, labels)]
+    assert dai.index_array is not None
+    data2 = np.vstack([Xb for Xb, _ in batches])
+    labels2 = np.concatenate([yb for _, yb in batches])
+    assert_array_equal(data[labels2].transpose(0, 2, 3, 1), data2)
+    assert_array_equal(labels, np.sort(labels2))
+
+
 def test_queued_iter():
     data = np.arange(36).reshape(12, 3)
     bi = iterator.QueuedIterator(4, False)
@@ -70,6 +107,50 @@ def test_parallel_da_iter_with_pre_processing():
     assert_array_equal(data.transpose(0, 2, 3, 1) * 2, data2)
 
 
+def test_da_iter_batch_warp():
+    data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+    dai = iterator.DAIterator(4, False, no_op_preprocessor, (4, 4), is_training=False, batch_warp=True)
+    data2 = np.vstack([items[0] for items in dai(data)])
+    assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+def test_parallel_da_iter_batch_warp():
+    data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+    dai = iterator.ParallelDAIterator(4, False, times_two_preprocessor, (4, 4), is_training=False, batch_warp=True)
+    data2 = np.vstack([items[0] for items in dai(data)])
+    assert_array_equal(data.transpose(0, 2, 3, 1) * 2, data2)
+
+
+def test_parallel_da_iter_zero_copy():
+    data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+    dai = iterator.ParallelDAIterator(4, False, no_op_preprocessor, (4, 4), is_training=False, num_slabs=2,
+                                      zero_copy=True)
+    for epoch in range(2):
+        data2 = np.vstack([np.array(items[0]) for items in dai(data)])
+        assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+def test_parallel_da_iter_abandoned():
+    data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+    dai = iterator.ParallelDAIterator(4, False, no_op_preprocessor, (4, 4), is_training=False, num_slabs=2,
+                                      zero_copy=True)
+    for Xb, yb in dai(data):
+        break
+    data2 = np.vstack([np.array(items[0]) for items in dai(data)])
+    assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
+@pytest.mark.parametrize('zero_copy', [False, True])
+def test_parallel_da_iter_prefetch(zero_copy):
+    data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+    dai = iterator.ParallelDAIterator(4, False, no_op_preprocessor, (4, 4), is_training=False, zero_copy=zero_copy,
+                                      prefetch=2)
+    for Xb, yb in dai(data):
+        break
+    data2 = np.vstack([np.array(items[0]) for items in dai(data)])
+    assert_array_equal(data.transpose(0, 2, 3, 1), data2)
+
+
 def test_balancing_da_iter():
     data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
     dai = iterator.BalancingDAIterator(4, False, no_op_preprocessor, (4, 4), False, np.array([1., 1.]),
@@ -78,5 +159,73 @@ def test_balancing_da_iter():
     assert_array_equal(data.transpose(0, 2, 3, 1), data2)
 
 
+def test_balancing_da_iter_labels():
+    data = np.arange(12 * 3 * 4 * 4).reshape(12, 3, 4, 4)
+    labels = np.array([0] * 10 + [1] * 2)
+    dai = iterator.BalancingQueuedDAIterator(4, True, no_op_preprocessor, (4, 4), False, np.array([1., 5.]),
+                                             np.array([1., 1.]), 0.5, balance_epoch_count=1)
+    items = list(dai(data, labels))
+    assert dai.count == 2
+    Xb = np.vstack([item[0] for item in items])
+    yb = np.hstack([item[1] for item in items])
+    assert_array_equal(labels[Xb[:, 0, 0, 0].astype(int) // (3 * 4 * 4)], yb)
+
+
+aug_params = {
+    'zoom_range': (1 / 1.2, 1.2),
+    'rotation_range': (-180, 180),
+    'shear_range': (0, 0),
+    'translation_range': (-2, 2),
+    'do_flip': True,
+    'allow_stretch': False,
+}
+
+
+@pytest.mark.parametrize('batch_warp', [False, True])
+def test_parallel_da_iter_seeded(batch_warp):
+    data = np.arange(12 * 3 * 8 * 8).reshape(12, 3, 8, 8)
+
+    def epochs(dai, n):
+        return [np.vstack([np.array(items[0]) for items in dai(data)]) for _ in range(n)]
+
+    serial = iterator.DAIterator(4, False, no_op_preprocessor, (8, 8), True, aug_params, seed=7)
+    parallel = iterator.ParallelDAIterator(4, False, no_op_preprocessor, (8, 8), True, aug_params,
+                                           batch_warp=batch_warp, seed=7)
+    epoch1, epoch2 = epochs(serial, 2)
+    assert_equal(np.any(np.not_equal(epoch1, epoch2)), True)
+    for expected, actual in zip([epoch1, epoch2], epochs(parallel, 2)):
+        assert_array_equal(expected, actual)
+    resumed = iterator.DAIterator(4, False, no_op_preprocessor, (8, 8), True, aug_params, seed=7, epoch_count=1)
+    assert_array_equal(epoch2, epochs(resumed, 1)[0])
+
+
+@pytest.mark.parametrize('maker', [iterator.DAIterator, iterator.ParallelDAIterator])
+def test_da_iter_multi_crop(maker):
+    data = np.arange(5 * 3 * 8 * 8).reshape(5, 3, 8, 8)
+    labels = np.arange(5)
+    bboxes = np.array([[0, 0, 4, 4, 0], [2, 3, 6, 7, 1], [4, 4, 8, 8, 1]])
+    dai = maker(7, False, no_op_preprocessor, (4, 4), False)
+    batches = [(np.array(Xb), np.array(yb)) for Xb, yb in dai(data, labels, crop_bbox=bboxes)]
+    assert_array_equal([6, 6, 3], [len(Xb) for Xb, _ in batches])
+    crops = np.vstack([Xb for Xb, _ in batches]).reshape(5, 3, 4, 4, 3)
+    assert_array_equal(np.repeat(labels, 3), np.concatenate([yb for _, yb in batches]))
+    for k, bbox in enumerate(bboxes):
+        expected = np.vstack([items[0] for items in dai(data, crop_bbox=bbox)])
+        assert_array_equal(expected, crops[:, k])
+
+
+@pytest.mark.parametrize('maker', [iterator.DAIterator, iterator.ParallelDAIterator])
+def test_da_iter_multi_transform(maker):
+    data = np.arange(5 * 3 * 8 * 8).reshape(5, 3, 8, 8)
+    xforms = [np.array([[np.cos(a), -np.sin(a), 1], [np.sin(a), np.cos(a), -1], [0, 0, 1]]) for a in (0, 0.5, 2)]
+    dai = maker(6, False, no_op_preprocessor, (6, 6), False)
+    batches = [np.array(items[0]) for items in dai(data, xform=xforms)]
+    assert_array_equal([6, 6, 3], [len(Xb) for Xb in batches])
+    variants = np.vstack(batches).reshape(5, 3, 6, 6, 3)
+    for k, xform in enumerate(xforms):
+        expected = np.vstack([items[0] for items in dai(data, xform=xform)])
+        assert_array_equal(expected, variants[:, k])
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
@@ -4,6 +4,7 @@ import pytest
 from numpy.testing import assert_array_almost_equal
 
 from tefla.core import metrics
+from tefla.utils import quadratic_weighted_kappa as qwk
 
 
 @pytest.fixture(autouse=True)
@@ -26,5 +27,122 @@ def test_kappav2_op():
     assert_array_almost_equal(_kappa_metric, kappa_metric_)
 
 
+def test_confusion_matrix_accumulator():
+    num_classes = 4
+    rng = np.random.RandomState(0)
+    preds = rng.randint(0, num_classes, size=(6, 16, 16))
+    gt = rng.randint(-1, num_classes, size=(6, 16, 16))
+    first, second = metrics.ConfusionMatrixAccumulator(num_classes), metrics.ConfusionMatrixAccumulator(num_classes)
+    for i in range(3):
+        first.update(preds[i], gt[i])
+    second.update(preds[3:], gt[3:])
+    accumulator = first.merge(second)
+    assert accumulator.hist.dtype == np.int64
+    assert accumulator.hist.sum() == (gt >= 0).sum()
+
+    valid = gt >= 0
+    p, g = preds[valid], gt[valid]
+    iou = np.array([((p == c) & (g == c)).sum() / float(((p == c) | (g == c)).sum()) for c in range(num_classes)])
+    freq = np.bincount(g, minlength=num_classes) / float(len(g))
+    results = accumulator.compute()
+    assert_array_almost_equal(results['per_class_iou'], iou)
+    assert_array_almost_equal(results['mean_iou'], iou.mean())
+    assert_array_almost_equal(results['pixel_accuracy'], (p == g).mean())
+    assert_array_almost_equal(results['freq_weighted_iou'], (freq * iou).sum())
+
+
+def test_confusion_matrix_accumulator_absent_class():
+    accumulator = metrics.ConfusionMatrixAccumulator(3)
+    accumulator.update(np.array([0, 1, 1]), np.array([0, 1, 0]))
+    iou = accumulator.per_class_iou()
+    assert np.isnan(iou[2])
+    assert_array_almost_equal(accumulator.mean_iou(), (0.5 + 0.5) / 2)
+
+
+def _loop_kappa(rater_a, rater_b, num_ratings):
+    conf_mat = np.zeros((num_ratings, num_ratings))
+    for a, b in zip(rater_a, rater_b):
+        conf_mat[a][b] += 1
+    hist_a = conf_mat.sum(axis=1)
+    hist_b = conf_mat.sum(axis=0)
+    numerator = denominator = 0.0
+    for i in range(num_ratings):
+        for j in range(num_ratings):
+            d = (i - j) ** 2 / float((num_ratings - 1) ** 2)
+            numerator += d * conf_mat[i][j]
+            denominator += d * hist_a[i] * hist_b[j] / len(rater_a)
+    return 1.0 - numerator / denominator
+
+
+def test_quadratic_weighted_kappa():
+    rng = np.random.RandomState(1)
+    rater_a = rng.randint(0, 5, size=1000)
+    rater_b = np.clip(rater_a + rng.randint(-1, 2, size=1000), 0, 4)
+    expected = _loop_kappa(rater_a, rater_b, 5)
+    assert_array_almost_equal(qwk.quadratic_weighted_kappa(rater_a, rater_b), expected)
+    assert_array_almost_equal(metrics.Kappa().metric(rater_a, rater_b, 5), expected)
+    assert_array_almost_equal(metrics.Kappa().metric(np.eye(5)[rater_a], rater_b, 5), expected)
+    assert qwk.confusion_matrix(rater_a, rater_b).sum() == 1000
+    assert list(qwk.histogram(rater_a, 0, 4)) == list(np.bincount(rater_a, minlength=5))
+    assert qwk.quadratic_weighted_kappa(np.zeros(10), np.zeros(10)) == 0.999
+
+
+def test_kappa_accumulator():
+    rng = np.random.RandomState(2)
+    predictions = rng.rand(300, 5)
+    targets = rng.randint(0, 5, size=300)
+    first, second = metrics.KappaAccumulator(5), metrics.KappaAccumulator(5)
+    for start in range(0, 200, 32):
+        first.update(predictions[start:min(start + 32, 200)], targets[start:min(start + 32, 200)])
+    second.update(predictions[200:], targets[200:])
+    assert_array_almost_equal(first.merge(second).compute(), metrics.Kappa().metric(predictions, targets, 5))
+
+
+def _accumulated(accumulator, predictions, targets, batch_size=64):
+    for start in range(0, len(targets), batch_size):
+        accumulator.update(predictions[start:start + batch_size], targets[start:start + batch_size])
+    return accumulator.compute()
+
+
+def test_metric_accumulators_match_whole_set_metrics():
+    rng = np.random.RandomState(3)
+    predictions = rng.rand(500, 2)
+    targets = (predictions[:, 1] + rng.rand(500) * 0.8 > 0.9).astype(int)
+    assert_array_almost_equal(_accumulated(metrics.AccuracyAccumulator(), predictions, targets),
+                              metrics.accuracy_op(predictions, targets))
+    assert_array_almost_equal(_accumulated(metrics.AurocAccumulator(), predictions, targets),
+                              metrics.Auroc().metric(predictions, targets))
+    assert_array_almost_equal(_accumulated(metrics.F1Accumulator(2), predictions, np.eye(2)[targets]),
+                              metrics.F1score().metric(predictions, targets))
+
+    predictions = rng.rand(500, 5)
+    targets = rng.randint(0, 4, size=500)
+    assert_array_almost_equal(_accumulated(metrics.F1Accumulator(5), predictions, targets),
+                              metrics.F1score().metric(predictions, targets))
+
+
+def test_metric_accumulators_merge_and_reset():
+    rng = np.random.RandomState(4)
+    predictions = rng.rand(200, 2)
+    targets = rng.randint(0, 2, size=200)
+    for make in (metrics.AccuracyAccumulator, metrics.AurocAccumulator, lambda: metrics.F1Accumulator(2),
+                 lambda: metrics.KappaAccumulator(2)):
+        whole = make().update(predictions, targets).compute()
+        merged = make().update(predictions[:50], targets[:50]).merge(make().update(predictions[50:], targets[50:]))
+        assert_array_almost_equal(merged.compute(), whole)
+        merged.reset()
+        assert_array_almost_equal(merged.update(predictions, targets).compute(), whole)
+
+
+def test_batch_average():
+    accumulator = metrics.as_accumulator(lambda targets, predictions: np.mean(targets == predictions))
+    assert isinstance(accumulator, metrics.BatchAverage)
+    accumulator.update(np.array([1, 1, 0]), np.array([1, 1, 1]))
+    accumulator.update(np.array([0]), np.array([0]))
+    assert_array_almost_equal(accumulator.compute(), 0.75)
+    kappa = metrics.KappaAccumulator(5)
+    assert metrics.as_accumulator(kappa) is kappa
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
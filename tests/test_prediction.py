@@ -0,0 +1,124 @@
+import threading
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal
+
+from tefla.core.prediction import EnsemblePredictor, PredictionAggregator, run_pipelined
+from tefla.da.iterator import BatchIterator
+
+
+@pytest.mark.parametrize('ensemble_type', ['mean', 'gmean', 'log_mean'])
+def test_prediction_aggregator(ensemble_type):
+    predictions = np.random.uniform(size=(7, 10, 5)).astype(np.float32)
+    predictions[0, 0, 0] = 0
+    aggregator = PredictionAggregator(10, ensemble_type)
+    # whole transforms, then several transforms of a batch of samples at once
+    aggregator.update(predictions[0])
+    aggregator.update(predictions[1])
+    aggregator.update(predictions[2:].transpose(1, 0, 2)[:4], start=0)
+    aggregator.update(predictions[2:].transpose(1, 0, 2)[4:], start=4)
+    assert aggregator.result().dtype == np.float32
+    with np.errstate(divide='ignore'):
+        expected = {
+            'mean': np.mean(predictions, axis=0),
+            'gmean': np.exp(np.mean(np.log(predictions), axis=0)),
+            'log_mean': np.mean(np.log(predictions + (predictions == 0)), axis=0),
+        }[ensemble_type]
+    assert_array_almost_equal(expected, aggregator.result())
+    assert_array_almost_equal(np.var(predictions, axis=0), aggregator.variance())
+
+
+def test_prediction_aggregator_missing_samples():
+    aggregator = PredictionAggregator(4)
+    with pytest.raises(ValueError):
+        aggregator.result()
+    aggregator.update(np.ones((3, 2)))
+    with pytest.raises(ValueError):
+        aggregator.result()
+    with pytest.raises(ValueError):
+        aggregator.variance()
+    aggregator.update(np.ones((1, 2)), start=3)
+    assert_array_almost_equal(np.ones((4, 2)), aggregator.result())
+
+
+class LinearPredictor(object):
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def predict(self, X):
+        return self.predict_batch(X)
+
+    def predict_batch(self, X):
+        return 1. / (1. + np.exp(-np.dot(X, self.weights)))
+
+
+def test_ensemble_predictor_shared_iterator():
+    X = np.random.normal(size=(10, 4))
+    predictors = [LinearPredictor(np.random.normal(size=(4, 3))) for _ in range(3)]
+    expected = EnsemblePredictor(predictors).predict(X, ensemble_type='gmean', return_variance=True)
+    num_threads = threading.active_count()
+    with EnsemblePredictor(predictors, BatchIterator(4, False)) as shared:
+        for expected_part, part in zip(expected, shared.predict(X, ensemble_type='gmean', return_variance=True)):
+            assert_array_almost_equal(expected_part, part)
+    assert shared.pool is None
+    assert threading.active_count() == num_threads
+
+
+def test_run_pipelined():
+    X = np.random.normal(size=(50, 4))
+    batches = BatchIterator(4, False, streaming=True)(X)
+    outputs = list(run_pipelined(batches, lambda Xb: Xb * 2, depth=1))
+    assert_array_almost_equal(X * 2, np.vstack(outputs))
+
+
+def test_run_pipelined_reused_buffer():
+    X = np.random.normal(size=(50, 4))
+    iterator = BatchIterator(4, True, streaming=True)
+    batches = iterator(X)
+    # shuffled streaming batches are gathered into one reused buffer
+    raw = [Xb for Xb, _ in batches]
+    assert np.shares_memory(raw[0], raw[1])
+    outputs = list(run_pipelined(batches, lambda Xb: Xb * 2, depth=3))
+    assert_array_almost_equal(X[iterator.index_array] * 2, np.vstack(outputs))
+
+
+def test_run_pipelined_error_stops_producer():
+    loaded = []
+
+    def batches():
+        for i in range(100):
+            loaded.append(i)
+            yield np.zeros((2, 3)), None
+
+    def run(Xb):
+        raise ValueError('bad batch')
+
+    with pytest.raises(ValueError):
+        list(run_pipelined(batches(), run, depth=1))
+    assert len(loaded) < 10
+
+
+def test_run_pipelined_abandoned():
+    def batches():
+        for i in range(100):
+            yield np.full((2, 3), i), None
+
+    num_threads = threading.active_count()
+    pipeline = run_pipelined(batches(), lambda Xb: Xb + 1, depth=1)
+    assert next(pipeline)[0, 0] == 1
+    pipeline.close()
+    assert threading.active_count() == num_threads
+
+
+def test_run_pipelined_error():
+    def run(Xb):
+        raise ValueError('bad batch')
+
+    with pytest.raises(ValueError):
+        list(run_pipelined(BatchIterator(4, False)(np.zeros((50, 4))), run))
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
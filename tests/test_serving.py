@@ -0,0 +1,71 @@
+import threading
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_almost_equal
+
+from tefla.core import serving
+
+
+class SumPredictor(object):
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict_batch(self, X):
+        self.batch_sizes.append(len(X))
+        return X.reshape(len(X), -1).sum(axis=1, keepdims=True)
+
+
+def test_micro_batcher():
+    predictor = SumPredictor()
+    batcher = serving.MicroBatcher(predictor.predict_batch, max_batch_size=4, max_wait_ms=200)
+    requests = [batcher.submit(np.full((2, 2), i, dtype=np.float32)) for i in range(10)]
+    for i, request in enumerate(requests):
+        prediction, latency = request.result(timeout=10)
+        assert_array_almost_equal([4 * i], prediction)
+        assert latency >= 0
+    batcher.close()
+    assert sum(predictor.batch_sizes) == 10
+    assert max(predictor.batch_sizes) <= 4
+    stats = batcher.stats()
+    assert stats['requests'] == 10
+    assert stats['queue_depth'] == 0
+    assert stats['batches'] == len(predictor.batch_sizes)
+
+
+def test_micro_batcher_error():
+    def predict_batch(X):
+        raise ValueError('bad batch')
+
+    batcher = serving.MicroBatcher(predict_batch, max_wait_ms=0)
+    with pytest.raises(ValueError):
+        batcher.predict(np.zeros(3), timeout=10)
+    batcher.close()
+
+
+def test_inference_server():
+    predictor = SumPredictor()
+    server = serving.InferenceServer(predictor, lambda image: np.full((2, 2), float(image)), max_batch_size=8,
+                                     max_wait_ms=50).start()
+    client = serving.InferenceClient(*server.address)
+    results = {}
+
+    def request(i):
+        results[i] = client.predict(str(i))
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(6):
+        assert_array_almost_equal([4 * i], results[i][0])
+    assert client.stats()['requests'] == 6
+    with pytest.raises(RuntimeError):
+        client.predict('not a number')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from tefla.core.staging import StagedInputs, closing_staged_inputs
+
+
+@pytest.fixture(autouse=True)
+def _reset_graph():
+    tf.reset_default_graph()
+
+
+def _batches(n):
+    for i in range(n):
+        yield np.full((2, 3), i, dtype=np.float32), np.array([i, i])
+
+
+def test_staged_inputs_epoch():
+    inputs = tf.placeholder(tf.float32, shape=(None, 3))
+    labels = tf.placeholder(tf.int64, shape=(None,))
+    staged = StagedInputs([inputs, labels], capacity=2)
+    staged_inputs, staged_labels = staged.outputs
+    assert staged_inputs.get_shape().as_list() == [None, 3]
+    total = tf.reduce_sum(staged_inputs) + tf.to_float(tf.reduce_sum(staged_labels))
+    with tf.Session() as sess:
+        for _ in range(2):
+            results = [(batch[1][0], sess.run(total)) for batch in staged.epoch(sess, _batches(5))]
+            assert results == [(i, 8.0 * i) for i in range(5)]
+        staged.close(sess)
+
+
+def test_staged_inputs_transform_and_errors():
+    inputs = tf.placeholder(tf.float32, shape=(None, 3))
+    staged = StagedInputs([inputs])
+    doubled = staged.outputs[0] * 2
+    with tf.Session() as sess:
+        batches = staged.epoch(sess, _batches(3), lambda Xb, yb: (Xb + 1,))
+        assert [sess.run(doubled)[0, 0] for _ in batches] == [2.0, 4.0, 6.0]
+
+        def failing():
+            yield np.zeros((1, 3)), None
+            raise ValueError('bad batch')
+        with pytest.raises(ValueError):
+            for _ in staged.epoch(sess, failing()):
+                sess.run(doubled)
+
+
+def test_staged_inputs_abandoned_epoch():
+    inputs = tf.placeholder(tf.float32, shape=(None, 3))
+    staged = StagedInputs([inputs], capacity=2)
+    first = staged.outputs[0][0, 0]
+    with tf.Session() as sess:
+        batches = staged.epoch(sess, _batches(10))
+        next(batches)
+        assert sess.run(first) == 0
+        # the feeder fills the staging queue, then waits for room
+        next(batches)
+        batches.close()
+        assert sess.run(staged.size_op) == 0
+        # the next epoch does not see the stale batches
+        results = [(batch[1][0], sess.run(first)) for batch in staged.epoch(sess, _batches(3))]
+        assert results == [(i, i) for i in range(3)]
+
+        batches = staged.epoch(sess, _batches(10))
+        next(batches)
+        staged.close(sess)
+        batches.close()
+        assert staged.closed
+
+
+def test_closing_staged_inputs():
+    inputs = tf.placeholder(tf.float32, shape=(None, 3))
+    staged = StagedInputs([inputs])
+    with tf.Session() as sess:
+        with pytest.raises(ValueError):
+            with closing_staged_inputs(staged, sess):
+                raise ValueError('training failed')
+        assert staged.closed
+        with closing_staged_inputs(None, sess):
+            pass
+
+
+def test_staged_inputs_reroute():
+    inputs = tf.placeholder(tf.float32, shape=(None, 3))
+    outputs = inputs + 1
+    staged = StagedInputs([inputs])
+    staged.reroute([inputs])
+    with tf.Session() as sess:
+        for Xb, _ in staged.epoch(sess, _batches(2)):
+            np.testing.assert_array_equal(sess.run(outputs), Xb + 1)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 import pytest
 from numpy.testing import assert_array_almost_equal
-from tefla.da.standardizer import AggregateStandardizer, AggregateStandardizerTF
+from tefla.da.standardizer import AggregateStandardizer, AggregateStandardizerTF, SamplewiseStandardizer
 
 
 @pytest.fixture(autouse=True)
@@ -52,6 +52,36 @@ def test_np_tf_aggregate():
     assert_array_almost_equal(im_st, im_)
 
 
+def _aggregate_standardizer(sigma):
+    return AggregateStandardizer(
+        mean=np.array([108.64628601, 75.86886597, 54.34005737], dtype=np.float32),
+        std=np.array([70.53946096, 51.71475228, 43.03428563], dtype=np.float32),
+        u=np.array([[-0.56543481, 0.71983482, 0.40240142],
+                    [-0.5989477, -0.02304967, -0.80036049],
+                    [-0.56694071, -0.6935729, 0.44423429]], dtype=np.float32),
+        ev=np.array([1.65513492, 0.48450358, 0.1565086], dtype=np.float32),
+        sigma=sigma
+    )
+
+
+@pytest.mark.parametrize('channels_last', [False, True])
+@pytest.mark.parametrize('standardizer', [
+    SamplewiseStandardizer(clip=6), SamplewiseStandardizer(clip=6, channel_wise=True), _aggregate_standardizer(0.5)])
+def test_standardize_batch(standardizer, channels_last):
+    imgs = np.random.uniform(0.0, 255.0, size=(4, 3, 16, 16)).astype(np.float32)
+    expected = np.array([standardizer(img, True, rng=np.random.RandomState(i))
+                         for i, img in enumerate(imgs.copy())])
+    rngs = [np.random.RandomState(i) for i in range(len(imgs))]
+    if channels_last:
+        batch = np.ascontiguousarray(imgs.transpose(0, 2, 3, 1))
+        out = standardizer.standardize_batch(batch, True, channels_last=True, rngs=rngs).transpose(0, 3, 1, 2)
+    else:
+        batch = imgs.copy()
+        out = standardizer.standardize_batch(batch, True, channels_last=False, rngs=rngs)
+    assert np.shares_memory(out, batch)
+    assert_array_almost_equal(expected, out, decimal=4)
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
     # test_np_tf_aggregate()
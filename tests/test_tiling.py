@@ -0,0 +1,64 @@
+from __future__ import division
+
+import numpy as np
+import pytest
+
+from tefla.utils import tiling
+
+
+def test_tile_starts():
+    assert tiling.tile_starts(100, 128) == [0]
+    assert tiling.tile_starts(128, 128) == [0]
+    assert tiling.tile_starts(100, 40) == [0, 40, 60]
+    assert tiling.tile_starts(100, 40, overlap=10) == [0, 30, 60]
+    with pytest.raises(ValueError):
+        tiling.tile_starts(100, 40, overlap=40)
+
+
+def test_gaussian_weights():
+    weights = tiling.gaussian_weights((9, 7))
+    assert weights.shape == (9, 7)
+    assert weights[4, 3] == 1.0
+    assert weights.min() >= 1e-3
+    np.testing.assert_allclose(weights, weights[::-1, ::-1])
+
+
+@pytest.mark.parametrize('blend', ['gaussian', 'mean'])
+@pytest.mark.parametrize('shape', [(50, 70), (20, 30), (32, 32)])
+def test_predict_tiled_reproduces_per_pixel_outputs(blend, shape):
+    img = np.random.rand(shape[0], shape[1], 3).astype(np.float32)
+    calls = []
+
+    def predict_batch(tiles):
+        calls.append(len(tiles))
+        return np.concatenate([tiles, tiles.sum(axis=3, keepdims=True)], axis=3)
+
+    stitched = tiling.predict_tiled(img, predict_batch, 32, overlap=8, batch_size=3, blend=blend)
+    assert stitched.shape == shape + (4,)
+    np.testing.assert_allclose(stitched[:, :, :3], img, rtol=1e-5)
+    np.testing.assert_allclose(stitched[:, :, 3], img.sum(axis=2), rtol=1e-5)
+    assert max(calls) <= 3
+
+
+def test_predict_tiled_blends_overlaps():
+    img = np.zeros((10, 16, 1))
+    tiles_seen = []
+
+    def predict_batch(tiles):
+        tiles_seen.append(len(tiles))
+        return np.ones(tiles.shape[:3] + (1,)) * len(tiles_seen)
+
+    stitched = tiling.predict_tiled(img, predict_batch, (10, 10), overlap=4, batch_size=1, blend='mean')
+    assert tiles_seen == [1, 1]
+    np.testing.assert_allclose(stitched[:, :6, 0], 1)
+    np.testing.assert_allclose(stitched[:, 6:10, 0], 1.5)
+    np.testing.assert_allclose(stitched[:, 10:, 0], 2)
+
+
+def test_predict_tiled_output_size_mismatch():
+    with pytest.raises(ValueError):
+        tiling.predict_tiled(np.zeros((40, 40, 3)), lambda tiles: tiles[:, ::2, ::2], 16)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from tefla.core.base import Base
+from tefla.core.lr_policy import AdaptiveDecayPolicy, StepDecayPolicy
+from tefla.core.validation_schedule import ValidationSchedule, stratified_indices
+
+
+def test_default_schedule_validates_every_epoch_fully():
+    schedule = ValidationSchedule()
+    X, y = np.arange(10), np.arange(10) % 2
+    for epoch in range(1, 6):
+        assert schedule.should_validate(epoch, 5)
+        assert schedule.validation_set(X, y, epoch, 5)[0] is X
+
+
+def test_is_default():
+    assert ValidationSchedule().is_default()
+    assert not ValidationSchedule(every=2).is_default()
+    assert not ValidationSchedule(subset_size=0.1).is_default()
+
+
+def test_learner_without_schedule_support_rejects_schedule():
+    with pytest.raises(ValueError):
+        Base(None, {'validation_schedule': ValidationSchedule(every=2)})
+    Base(None, {'validation_schedule': ValidationSchedule()})
+
+
+def test_every_n_epochs_and_last_epoch():
+    schedule = ValidationSchedule(every=3)
+    assert [epoch for epoch in range(1, 11) if schedule.should_validate(epoch, 10)] == [3, 6, 9, 10]
+
+
+def test_time_budget():
+    schedule = ValidationSchedule(time_budget=0.25)
+    schedule.record(10.0, 5.0)
+    assert not schedule.should_validate(2, 10)
+    schedule.record(10.0, 0.0)
+    assert schedule.should_validate(3, 10)
+    assert schedule.should_validate(10, 10)
+
+
+def test_stratified_indices():
+    y = np.array([0] * 80 + [1] * 15 + [2] * 5)
+    indices = stratified_indices(y, 20, np.random.RandomState(0))
+    assert len(indices) == 20
+    assert np.all(np.diff(indices) > 0)
+    assert list(np.bincount(y[indices])) == [16, 3, 1]
+    rare = stratified_indices(np.array([0] * 99 + [1]), 10, np.random.RandomState(0))
+    assert 99 in rare
+    assert len(stratified_indices(np.random.rand(50), 10, np.random.RandomState(0))) == 10
+
+
+def test_subset_with_full_pass():
+    schedule = ValidationSchedule(subset_size=0.2, full_every=4, seed=1)
+    X = ['img_%d' % i for i in range(50)]
+    y = np.arange(50) % 5
+    subset_X, subset_y = schedule.validation_set(X, y, 1, 10)
+    assert len(subset_X) == 10
+    assert list(np.bincount(subset_y)) == [2] * 5
+    assert all(X[int(name.split('_')[1])] == name for name in subset_X)
+    assert schedule.validation_set(X, y, 2, 10)[0] == subset_X
+    assert schedule.validation_set(X, y, 4, 10)[0] is X
+    assert schedule.validation_set(X, y, 10, 10)[0] is X
+
+
+def test_lr_policy_history():
+    schedule = ValidationSchedule(every=2)
+    history = [dict(epoch=1, training_loss=1.0),
+               dict(epoch=2, training_loss=0.9, validation_loss=0.8, validation_subset=True),
+               dict(epoch=3, training_loss=0.8)]
+    step_policy = StepDecayPolicy({0: 0.1})
+    assert schedule.lr_policy_history(step_policy, history) is history
+    adaptive_policy = AdaptiveDecayPolicy(0.1)
+    assert schedule.lr_policy_history(adaptive_policy, history) is None
+    history.append(dict(epoch=4, training_loss=0.7, validation_loss=0.6, validation_subset=False))
+    assert [epoch_info['epoch'] for epoch_info in schedule.lr_policy_history(adaptive_policy, history)] == [4]
+    history.append(dict(epoch=6, training_loss=0.6, validation_loss=0.7, validation_subset=True))
+    assert [epoch_info['epoch'] for epoch_info in schedule.lr_policy_history(adaptive_policy, history)] == [2, 6]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])